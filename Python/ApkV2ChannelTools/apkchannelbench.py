@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+this module benchmark channel apk generation with synthetic apk files
+"""
+
+__author__ = 'Jiasheng Lee'
+
+import os, sys, json, time, struct, getopt, platform, zipfile, \
+    tempfile, shutil, unittest
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from apkv2channeltools import ApkChannelTool, FileTools, _map_jobs, \
+    _write_channel_file, _parse_apk_layout, _read_eocd_of_file, \
+    _patch_eocd_central_dir_offset, _APK_SIGN_BLOCK_MAGIC, \
+    _APK_SIGNATURE_SCHEME_V2_BLOCK_ID, _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID
+
+# 生成测试数据时单次写入的大小
+_FILL_CHUNK_SIZE = 4 * 1024 * 1024
+# 单个zip条目的最大大小, 超出时拆分为多个条目
+_MAX_ENTRY_SIZE = 256 * 1024 * 1024
+# 大小参数的单位
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(size_str):
+    """
+    解析带单位的大小, 如10M, 2G
+    :param size_str: 大小字符串
+    :return: 返回字节数
+    """
+    size_str = size_str.strip().upper().rstrip('B')
+    unit = size_str[-1:] if size_str[-1:] in _SIZE_UNITS else ''
+    return int(float(size_str[:len(size_str) - len(unit)]) * _SIZE_UNITS[unit])
+
+
+def create_synthetic_apk(file_name, size, comment_length=0,
+                         sign_block_entries=2):
+    """
+    生成具有v2签名apk结构的测试文件, 数据以流式写入, 不占用与文件大小相当的内存
+    :param file_name: 生成的文件路径
+    :param size: zip条目数据的总大小
+    :param comment_length: zip注释长度
+    :param sign_block_entries: signing block中id-value的个数, 第一个为v2签名
+    :return: 返回生成的文件大小
+    """
+    fill = os.urandom(_FILL_CHUNK_SIZE)
+    with zipfile.ZipFile(file_name, 'w', zipfile.ZIP_STORED,
+                         allowZip64=True) as z:
+        index = 0
+        remaining = size
+        while remaining > 0 or index == 0:
+            entry_size = min(remaining, _MAX_ENTRY_SIZE)
+            with z.open('assets/data%d.bin' % index, 'w',
+                        force_zip64=entry_size >= _MAX_ENTRY_SIZE) as f:
+                left = entry_size
+                while left > 0:
+                    f.write(fill[:min(left, _FILL_CHUNK_SIZE)])
+                    left -= min(left, _FILL_CHUNK_SIZE)
+            remaining -= entry_size
+            index += 1
+        z.comment = b'c' * comment_length
+
+    pairs = bytearray()
+    for x in range(sign_block_entries):
+        key_id = bytearray(_APK_SIGNATURE_SCHEME_V2_BLOCK_ID) if x == 0 \
+            else bytearray(struct.pack('>I', 0x10000000 + x))
+        key_id.reverse()
+        value = fill[x * 64: x * 64 + 1024]
+        pairs.extend(struct.pack('<Q', len(value) + 4) + key_id + value)
+    block_size = struct.pack('<Q', len(pairs) + 24)
+    sign_block = block_size + pairs + block_size \
+        + bytes(reversed(_APK_SIGN_BLOCK_MAGIC))
+
+    with open(file_name, 'r+b') as f:
+        fd = f.fileno()
+        layout = _parse_apk_layout(fd)
+        central_dir = FileTools.pread(fd, layout.eocd_offset
+                                      - layout.central_dir_offset,
+                                      layout.central_dir_offset)
+        f.truncate(layout.central_dir_offset)
+        f.seek(layout.central_dir_offset)
+        f.write(sign_block)
+        f.write(central_dir)
+        f.write(_patch_eocd_central_dir_offset(
+            layout.eocd, layout.central_dir_offset + len(sign_block)))
+        return f.tell()
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS单位为字节, Linux为KB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _time_per_op(func, repeat):
+    start = time.perf_counter()
+    for x in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def run_benchmark(work_dir, size, comment_length=0, sign_block_entries=2,
+                  channels=20, jobs=1, clone=False, repeat=1000):
+    """
+    执行基准测试
+    :param work_dir: 测试文件保存目录
+    :param size: 测试apk的数据大小
+    :param comment_length: zip注释长度
+    :param sign_block_entries: signing block中id-value的个数
+    :param channels: 生成的渠道包个数
+    :param jobs: 生成渠道包的线程数
+    :param clone: 是否使用reflink
+    :param repeat: eocd查找和signing block解析的重复次数
+    :return: 返回结果字典
+    """
+    source = os.path.join(work_dir, 'bench-source.apk')
+    start = time.perf_counter()
+    file_size = create_synthetic_apk(source, size, comment_length,
+                                     sign_block_entries)
+    create_seconds = time.perf_counter() - start
+
+    fd = os.open(source, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        eocd_us = _time_per_op(lambda: _read_eocd_of_file(fd, file_size),
+                               repeat)
+        parse_us = _time_per_op(lambda: _parse_apk_layout(fd), repeat)
+    finally:
+        os.close(fd)
+
+    tools = ApkChannelTool(source)
+    layout = tools.layout
+    tail = tools.build_channel_tail(_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID,
+                                    'bench')
+    verify_us = _time_per_op(lambda: tools.has_v2_signature()
+                             and tools.get_channel(), repeat)
+    tools.release()
+
+    target_dir = os.path.join(work_dir, 'bench-output')
+    if not os.path.isdir(target_dir):
+        os.makedirs(target_dir)
+    channel_list = ['bench%d' % x for x in range(channels)]
+    rss_before = _peak_rss_kb()
+
+    tools = ApkChannelTool(source)
+    try:
+        start = time.perf_counter()
+        # 与generate_channel_files相同的写入流程, 共享同一个ApkChannelTool以
+        # 便从copy_stats汇总所有渠道包的拷贝统计
+        results = _map_jobs(lambda channel: _write_channel_file(
+            tools, os.path.join(target_dir, 'app-%s.apk' % channel),
+            _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID, channel, clone), channel_list,
+            jobs)
+        write_seconds = time.perf_counter() - start
+        stats = tools.copy_stats
+    finally:
+        tools.release()
+
+    written = sum(x.size for x in results if x.success)
+    shutil.rmtree(target_dir)
+    os.remove(source)
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'size': size, 'comment_length': comment_length,
+                   'sign_block_entries': sign_block_entries,
+                   'channels': channels, 'jobs': jobs, 'clone': clone,
+                   'repeat': repeat},
+        'file_size': file_size,
+        'sign_block_size': len(layout.sign_block),
+        'create_seconds': round(create_seconds, 6),
+        'eocd_discovery_us': round(eocd_us, 3),
+        'layout_parse_us': round(parse_us, 3),
+        'signing_block_lookup_us': round(verify_us, 3),
+        'channel_tail_size': len(tail.sign_block) + len(tail.eocd),
+        'write': {
+            'seconds': round(write_seconds, 6),
+            'succeeded': sum(1 for x in results if x.success),
+            'failed': sum(1 for x in results if not x.success),
+            'mb_per_second': round(written / 1024.0 / 1024.0
+                                   / max(write_seconds, 1e-9), 3),
+            'channels_per_second': round(len(results)
+                                         / max(write_seconds, 1e-9), 3),
+            'bytes_copied': stats.bytes_copied,
+            'bytes_cloned': stats.bytes_cloned,
+            'syscalls': stats.syscalls,
+            'syscalls_per_channel': round(stats.syscalls
+                                          / max(len(results), 1), 3),
+        },
+        'peak_rss_kb_before_write': rss_before,
+        'peak_rss_kb': _peak_rss_kb(),
+    }
+
+
+class ChannelBenchTest(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        work_dir = tempfile.mkdtemp()
+        try:
+            report = run_benchmark(work_dir, parse_size('1M'),
+                                   comment_length=1000, sign_block_entries=5,
+                                   channels=3, jobs=2, repeat=10)
+            self.assertEqual(3, report['write']['succeeded'])
+            self.assertEqual(5 * (12 + 1024) + 32, report['sign_block_size'])
+            self.assertGreater(report['write']['bytes_copied'],
+                               3 * parse_size('1M'))
+            self.assertEqual([], os.listdir(work_dir))
+        finally:
+            shutil.rmtree(work_dir)
+
+    def test_parse_size(self):
+        self.assertEqual(10 * 1024 * 1024, parse_size('10M'))
+        self.assertEqual(2 * 1024 ** 3, parse_size('2GB'))
+        self.assertEqual(512, parse_size('512'))
+
+
+if __name__ == '__main__':
+
+    _work_dir = None
+    _output = None
+    _params = {'size': parse_size('10M')}
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "",
+                                   ["size=", "comment-length=", "entries=",
+                                    "channels=", "jobs=", "clone", "repeat=",
+                                    "work-dir=", "output="])
+        for opt, arg in opts:
+            if opt == '--size':
+                _params['size'] = parse_size(arg)
+            elif opt == '--comment-length':
+                _params['comment_length'] = min(int(arg), 0xffff)
+            elif opt == '--entries':
+                _params['sign_block_entries'] = max(int(arg), 1)
+            elif opt == '--channels':
+                _params['channels'] = int(arg)
+            elif opt == '--jobs':
+                _params['jobs'] = int(arg)
+            elif opt == '--clone':
+                _params['clone'] = True
+            elif opt == '--repeat':
+                _params['repeat'] = int(arg)
+            elif opt == '--work-dir':
+                _work_dir = arg
+            elif opt == '--output':
+                _output = arg
+    except (getopt.GetoptError, ValueError):
+        print("apkchannelbench.py [--size=<10M>] [--comment-length=<n>]"
+              + " [--entries=<n>] [--channels=<n>] [--jobs=<n>] [--clone]"
+              + " [--repeat=<n>] [--work-dir=<dir>] [--output=<jsonFile>]")
+        sys.exit(1)
+
+    _tmp_dir = None
+    if not _work_dir:
+        _tmp_dir = tempfile.mkdtemp()
+        _work_dir = _tmp_dir
+    try:
+        _report = run_benchmark(_work_dir, **_params)
+    finally:
+        if _tmp_dir:
+            shutil.rmtree(_tmp_dir)
+
+    _data = json.dumps(_report, indent=2)
+    if _output:
+        with open(_output, 'wt', encoding='UTF-8') as f:
+            f.write(_data)
+    else:
+        print(_data)
+    sys.exit(0)
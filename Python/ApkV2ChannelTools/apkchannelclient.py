@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+this module send channel stamping requests to apkchanneldaemon, it imports
+nothing but socket and json so a one-shot client starts fast
+"""
+
+__author__ = 'Jiasheng Lee'
+
+import os, sys, json, socket
+
+_USAGE = ("apkchannelclient.py --socket=<socketPath>"
+          " --source-apk=<sourceApk> --channel=<channel>"
+          " --target=<targetApk> [--slot-size=<slotSize>]")
+
+
+class ChannelDaemonClient(object):
+    """
+    渠道守护进程客户端, 一个连接可发送多个请求
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(socket_path)
+        self._file = self._sock.makefile('rwb')
+
+    def request(self, data):
+        self._file.write(json.dumps(data, ensure_ascii=False).encode('utf-8')
+                         + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise IOError('connection closed by daemon')
+        return json.loads(line.decode('utf-8'))
+
+    def stamp(self, source_apk, channel, target_file, slot_size=None,
+              clone=False):
+        """
+        请求守护进程生成渠道包, 路径转换为绝对路径
+        :return: 返回结果字典, ok为False时error为失败原因
+        """
+        data = {'source': os.path.abspath(source_apk), 'channel': channel,
+                'target': os.path.abspath(target_file), 'clone': clone}
+        if slot_size is not None:
+            data['slot_size'] = slot_size
+        return self.request(data)
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+def _parse_args(argv):
+    """
+    解析--key=value格式的参数, 不使用getopt以减少导入的模块
+    :return: 返回参数字典, 参数无效时抛出ValueError
+    """
+    options = {}
+    for arg in argv:
+        key, sep, value = arg.partition('=')
+        if key not in ('--socket', '--source-apk', '--channel', '--target',
+                       '--slot-size') or not sep:
+            raise ValueError('unknown argument: %s' % arg)
+        options[key[2:]] = value
+    if not all(options.get(x) for x in ('socket', 'source-apk', 'channel',
+                                        'target')):
+        raise ValueError('missing arguments')
+    if 'slot-size' in options:
+        options['slot-size'] = int(options['slot-size'])
+    return options
+
+
+if __name__ == '__main__':
+
+    try:
+        _options = _parse_args(sys.argv[1:])
+    except ValueError:
+        print(_USAGE)
+        sys.exit(1)
+
+    try:
+        _client = ChannelDaemonClient(_options['socket'])
+        try:
+            _result = _client.stamp(_options['source-apk'],
+                                    _options['channel'], _options['target'],
+                                    _options.get('slot-size'))
+        finally:
+            _client.close()
+    except (OSError, ValueError) as e:
+        sys.stderr.write("request daemon fail: %s\n" % e)
+        sys.exit(2)
+    if not _result['ok']:
+        sys.stderr.write("stamp %s fail: %s\n"
+                         % (_options['channel'], _result['error']))
+        sys.exit(2)
+    sys.exit(0)
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+this module keep parsed apk resident and write channel apk for requests
+received over a unix socket
+"""
+
+__author__ = 'Jiasheng Lee'
+
+import os, sys, json, stat, errno, logging, getopt, threading, collections, \
+    time, unittest, tempfile, shutil
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+
+import apkv2channeltools
+from apkv2channeltools import ApkChannelTool, SignatureNotFoundError, \
+    _write_channel_file, _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID
+from apkchannelclient import ChannelDaemonClient
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s\t\t%(asctime)s'
+                    + '\t\tApkChannelDaemon\t%(message)s')
+
+# 默认常驻内存的源apk个数
+_DEFAULT_MAX_SOURCES = 8
+
+
+class _CachedTool(object):
+
+    def __init__(self, apk_tools):
+        self.apk_tools = apk_tools
+        self.ref_count = 0
+        self.evicted = False
+
+
+class ApkToolCache(object):
+    """
+    缓存已解析的ApkChannelTool, 以源apk路径和修改时间为key, 源apk变化后重新
+    解析; 超出个数时淘汰最近最少使用的, 正在使用的在使用结束后释放
+    """
+
+    def __init__(self, max_sources=_DEFAULT_MAX_SOURCES):
+        self._max_sources = max_sources
+        self._tools = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._parse_count = 0
+
+    @property
+    def parse_count(self):
+        return self._parse_count
+
+    def acquire(self, source_apk):
+        """
+        获取源apk对应的ApkChannelTool, 使用结束后需调用release
+        :param source_apk: 源apk的绝对路径
+        :return: 返回缓存项
+        """
+        stat = os.stat(source_apk)
+        key = (source_apk, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._tools.get(key)
+            if cached is not None:
+                self._tools.move_to_end(key)
+                cached.ref_count += 1
+                return cached
+
+        # 在锁外解析, 同一源apk并发首次请求时可能重复解析, 只保留一个
+        apk_tools = ApkChannelTool(source_apk)
+        with self._lock:
+            self._parse_count += 1
+            cached = self._tools.get(key)
+            if cached is None:
+                cached = _CachedTool(apk_tools)
+                self._tools[key] = cached
+                self._evict_locked()
+            else:
+                apk_tools.release()
+            cached.ref_count += 1
+            return cached
+
+    def release(self, cached):
+        with self._lock:
+            cached.ref_count -= 1
+            if cached.evicted and cached.ref_count == 0:
+                cached.apk_tools.release()
+
+    def _evict_locked(self):
+        # 同一路径的旧版本和超出个数的缓存都需淘汰
+        latest = {}
+        for key in self._tools:
+            latest[key[0]] = key
+        for key in [x for x in self._tools if latest[x[0]] != x]:
+            self._evict_key_locked(key)
+        while len(self._tools) > self._max_sources:
+            self._evict_key_locked(next(iter(self._tools)))
+
+    def _evict_key_locked(self, key):
+        cached = self._tools.pop(key)
+        cached.evicted = True
+        if cached.ref_count == 0:
+            cached.apk_tools.release()
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._tools):
+                self._evict_key_locked(key)
+
+
+class ChannelDaemonRequestHandler(StreamRequestHandler):
+    """
+    每行一个json请求, 每个请求返回一行json结果:
+    {"source": 源apk, "channel": 渠道, "target": 渠道包路径,
+     "slot_size": 可选, "clone": 可选}
+    {"command": "ping"}
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.handle_request_data(
+                    json.loads(line.decode('utf-8')))
+            except ValueError as e:
+                response = {'ok': False, 'error': 'invalid request: %s' % e}
+            self.wfile.write(json.dumps(response, ensure_ascii=False)
+                             .encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def _remove_stale_socket(socket_path):
+    """
+    删除之前的守护进程遗留的socket文件, 路径为其他类型的文件时抛出
+    FileExistsError
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, 'not a socket file', socket_path)
+    os.remove(socket_path)
+
+
+class ChannelDaemon(ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, max_sources=_DEFAULT_MAX_SOURCES,
+                 channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
+        _remove_stale_socket(socket_path)
+        ThreadingUnixStreamServer.__init__(self, socket_path,
+                                           ChannelDaemonRequestHandler)
+        self.socket_path = socket_path
+        self.tool_cache = ApkToolCache(max_sources)
+        self._channel_id = channel_id
+
+    def handle_request_data(self, request):
+        """
+        处理单个请求
+        :param request: 请求字典
+        :return: 返回结果字典
+        """
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'invalid request'}
+        if request.get('command') == 'ping':
+            return {'ok': True}
+
+        start_time = time.time()
+        try:
+            source_apk = request['source']
+            channel = request['channel']
+            target_file = request['target']
+        except (KeyError, TypeError) as e:
+            return {'ok': False, 'error': 'missing field: %s' % e}
+
+        try:
+            cached = self.tool_cache.acquire(source_apk)
+        except (Exception, SignatureNotFoundError) as e:
+            return {'ok': False, 'error': str(e)}
+
+        try:
+            if not cached.apk_tools.has_v2_signature():
+                return {'ok': False, 'error': '%s is not a apk signed by'
+                                              ' scheme v2' % source_apk}
+            result = _write_channel_file(
+                cached.apk_tools, target_file, self._channel_id, channel,
+                clone=bool(request.get('clone')),
+                slot_size=request.get('slot_size'))
+        finally:
+            self.tool_cache.release(cached)
+
+        if not result.success:
+            logging.error("stamp %s to %s fail: %s"
+                          % (channel, target_file, result.error))
+            return {'ok': False, 'error': str(result.error)}
+        logging.debug("stamp %s to %s success" % (channel, target_file))
+        return {'ok': True, 'size': result.size,
+                'elapsed_ms': round((time.time() - start_time) * 1000, 3)}
+
+    def server_close(self):
+        ThreadingUnixStreamServer.server_close(self)
+        self.tool_cache.clear()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class ChannelDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._source = os.path.join(self._tmp_dir, 'source.apk')
+        apkv2channeltools.ChannelToolsTest._create_v2_apk(self._source)
+        self._daemon = ChannelDaemon(os.path.join(self._tmp_dir, 'daemon.sock'))
+        threading.Thread(target=self._daemon.serve_forever,
+                         daemon=True).start()
+
+    def tearDown(self):
+        self._daemon.shutdown()
+        self._daemon.server_close()
+        shutil.rmtree(self._tmp_dir)
+
+    def test_stamp(self):
+        client = ChannelDaemonClient(self._daemon.socket_path)
+        try:
+            self.assertTrue(client.request({'command': 'ping'})['ok'])
+            for channel in ('a', 'b'):
+                target = os.path.join(self._tmp_dir, 'app-%s.apk' % channel)
+                self.assertTrue(client.stamp(self._source, channel,
+                                             target)['ok'])
+                self.assertEqual(channel,
+                                 apkv2channeltools.audit_apk(target).channel)
+            self.assertEqual(1, self._daemon.tool_cache.parse_count)
+
+            apkv2channeltools.ChannelToolsTest._create_v2_apk(self._source)
+            os.utime(self._source, ns=(0, 0))
+            self.assertTrue(client.stamp(
+                self._source, 'c', os.path.join(self._tmp_dir, 'c.apk'))['ok'])
+            self.assertEqual(2, self._daemon.tool_cache.parse_count)
+
+            self.assertFalse(client.stamp(
+                os.path.join(self._tmp_dir, 'missing.apk'), 'd',
+                os.path.join(self._tmp_dir, 'd.apk'))['ok'])
+        finally:
+            client.close()
+
+    def test_invalid_request(self):
+        client = ChannelDaemonClient(self._daemon.socket_path)
+        try:
+            for data in ([1], 'ping', 1, None):
+                self.assertEqual({'ok': False, 'error': 'invalid request'},
+                                 client.request(data))
+            # 连接仍然可用
+            self.assertTrue(client.request({'command': 'ping'})['ok'])
+        finally:
+            client.close()
+
+    def test_socket_path_not_socket(self):
+        path = os.path.join(self._tmp_dir, 'regular')
+        with open(path, 'wt') as f:
+            f.write('data')
+        with self.assertRaises(FileExistsError):
+            ChannelDaemon(path)
+        self.assertTrue(os.path.isfile(path))
+
+
+if __name__ == '__main__':
+
+    _socket_path = None
+    _serve = False
+    _max_sources = _DEFAULT_MAX_SOURCES
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "",
+                                   ["socket=", "serve", "max-sources="])
+        for opt, arg in opts:
+            if opt == '--socket':
+                _socket_path = arg
+            elif opt == '--serve':
+                _serve = True
+            elif opt == '--max-sources':
+                _max_sources = int(arg)
+        if not _socket_path or not _serve:
+            raise getopt.GetoptError('missing arguments')
+    except (getopt.GetoptError, ValueError):
+        print("apkchanneldaemon.py --socket=<socketPath> --serve"
+              + " [--max-sources=<maxSources>]")
+        print("requests are sent by apkchannelclient.py")
+        sys.exit(1)
+
+    try:
+        _daemon = ChannelDaemon(_socket_path, _max_sources)
+    except OSError as e:
+        logging.error("listen on %s fail: %s" % (_socket_path, e))
+        sys.exit(2)
+    logging.info("listen on %s" % _socket_path)
+    try:
+        _daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _daemon.server_close()
+    sys.exit(0)
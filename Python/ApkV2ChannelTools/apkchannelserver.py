@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+this module serve channel apk over http without writing them to disk
+"""
+
+__author__ = 'Jiasheng Lee'
+
+import os, sys, re, logging, getopt, threading, collections, unittest, \
+    tempfile, shutil, urllib.request, urllib.error, urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import apkv2channeltools
+from apkv2channeltools import ApkChannelTool, FileTools, \
+    SignatureNotFoundError, generate_channel_files, iter_channels, \
+    _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s\t\t%(asctime)s'
+                    + '\t\tApkChannelServer\t%(message)s')
+
+# 请求路径格式
+_APK_PATH_PATTERN = re.compile(r'^/apk/([^/?#]+)$')
+# Range请求头格式, 只支持单个区间
+_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+# 控制字符, 不能出现在渠道和响应头中
+_CONTROL_CHAR_PATTERN = re.compile(r'[\x00-\x1f\x7f]')
+# Content-Disposition中filename参数可直接使用的字符, 其余替换为'_'
+_UNSAFE_FILENAME_PATTERN = re.compile(r'[^\x20-\x7e]|["\\]')
+# 默认缓存的渠道尾部数据个数
+_DEFAULT_CACHE_SIZE = 256
+
+
+class ChannelApkSource(object):
+    """
+    渠道包的数据来源, 渠道包由源apk中signing block之前的数据和渠道对应的尾部
+    数据(新的signing block, Central Directory, eocd)组成. 各渠道的Central
+    Directory与源apk相同, 只按LRU缓存新的signing block和eocd
+    """
+
+    def __init__(self, source_apk, cache_size=_DEFAULT_CACHE_SIZE,
+                 channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
+        self._source_apk = source_apk
+        self._apk_tools = ApkChannelTool(source_apk)
+        if not self._apk_tools.has_v2_signature():
+            self._apk_tools.release()
+            raise SignatureNotFoundError('%s is not a apk signed by scheme v2'
+                                         % source_apk)
+        self._channel_id = channel_id
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def source_apk(self):
+        return self._source_apk
+
+    def fileno(self):
+        """
+        解析时打开的源apk文件描述符, 源apk在服务期间被替换时仍指向解析的文件
+        """
+        return self._apk_tools.fileno()
+
+    @property
+    def cache_info(self):
+        """
+        返回缓存命中次数, 未命中次数和当前缓存个数
+        """
+        with self._lock:
+            return self._hits, self._misses, len(self._cache)
+
+    def get_channel_apk(self, channel):
+        """
+        获取渠道包的组成信息
+        :param channel: 渠道信息字符串
+        :return: 返回ChannelTail
+        """
+        with self._lock:
+            tail = self._cache.get(channel)
+            if tail is not None:
+                self._cache.move_to_end(channel)
+                self._hits += 1
+                return tail
+            self._misses += 1
+
+        tail = self._apk_tools.build_channel_tail(self._channel_id, channel)
+
+        with self._lock:
+            self._cache[channel] = tail
+            self._cache.move_to_end(channel)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return tail
+
+    def release(self):
+        self._apk_tools.release()
+
+
+def check_channel(channel):
+    """
+    校验请求中的渠道, 规则与渠道文件相同, 且不能包含控制字符
+    :param channel: url解码后的渠道
+    :return: 返回渠道, 无效时抛出ValueError
+    """
+    if not channel or _CONTROL_CHAR_PATTERN.search(channel):
+        raise ValueError('invalid channel: %r' % channel)
+    return next(iter_channels([(0, channel)]))
+
+
+def _content_disposition(file_name):
+    """
+    生成Content-Disposition响应头, filename为替换了特殊字符的ascii文件名,
+    filename*为RFC 5987编码的完整文件名
+    """
+    return "attachment; filename=\"%s\"; filename*=UTF-8''%s" % (
+        _UNSAFE_FILENAME_PATTERN.sub('_', file_name),
+        urllib.parse.quote(file_name, safe=''))
+
+
+def _parse_range(range_header, size):
+    """
+    解析Range请求头
+    :param range_header: Range请求头, 可为None
+    :param size: 文件大小
+    :return: 返回[start, end]闭区间, 无Range请求时返回None, 区间无效时抛出
+    ValueError
+    """
+    if not range_header:
+        return None
+    match = _RANGE_PATTERN.match(range_header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        raise ValueError('invalid range: %s' % range_header)
+
+    if not match.group(1):
+        length = int(match.group(2))
+        if length == 0:
+            raise ValueError('invalid range: %s' % range_header)
+        return max(size - length, 0), size - 1
+
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        raise ValueError('invalid range: %s' % range_header)
+    return start, min(end, size - 1)
+
+
+class ChannelApkRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._handle(False)
+
+    def do_GET(self):
+        self._handle(True)
+
+    def _handle(self, send_body):
+        match = _APK_PATH_PATTERN.match(urllib.parse.urlsplit(self.path).path)
+        if not match:
+            self.send_error(404)
+            return
+        try:
+            channel = check_channel(urllib.parse.unquote(match.group(1)))
+        except ValueError as e:
+            logging.debug("bad request %s: %s" % (self.path, e))
+            self.send_error(400)
+            return
+
+        try:
+            tail = self.server.apk_source.get_channel_apk(channel)
+        except (Exception, SignatureNotFoundError) as e:
+            logging.error("build channel %r fail: %s" % (channel, e))
+            self.send_error(400)
+            return
+
+        size = tail.file_size
+        try:
+            content_range = _parse_range(self.headers.get('Range'), size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%d' % size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if content_range is None:
+            start, end = 0, size - 1
+            self.send_response(200)
+        else:
+            start, end = content_range
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        self.send_header('Content-Type', 'application/vnd.android.package-'
+                                         'archive')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Disposition', _content_disposition(
+            self.server.name_format % channel))
+        self.end_headers()
+
+        if send_body:
+            self._send_content(tail, start, end + 1)
+
+    def _send_content(self, tail, start, end):
+        # 共享前缀和Central Directory直接从源apk发送, 只有signing block和eocd
+        # 来自内存
+        segments = ((0, tail.sign_block_offset), tail.sign_block,
+                    (tail.central_dir_offset, tail.central_dir_size),
+                    tail.eocd)
+        position = 0
+        for segment in segments:
+            length = segment[1] if isinstance(segment, tuple) \
+                else len(segment)
+            lo, hi = max(start, position), min(end, position + length)
+            if lo < hi:
+                if isinstance(segment, tuple):
+                    self._send_source_range(segment[0] + lo - position,
+                                            hi - lo)
+                else:
+                    self.wfile.write(segment[lo - position: hi - position])
+            position += length
+
+    def _send_source_range(self, offset, size):
+        # 使用解析源apk时打开的文件描述符, 与缓存的尾部数据来自同一个文件;
+        # 支持时由内核通过sendfile完成, 指定偏移量不改变文件位置, 可多线程共享
+        fd = self.server.apk_source.fileno()
+        if not hasattr(os, 'sendfile'):
+            for data in FileTools.iter_range(fd, offset, size):
+                self.wfile.write(data)
+            return
+        sock_fd = self.connection.fileno()
+        while size > 0:
+            sent = os.sendfile(sock_fd, fd, offset, size)
+            if sent == 0:
+                raise IOError('unexpected end of file at %d' % offset)
+            offset += sent
+            size -= sent
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class ChannelApkServer(ThreadingMixIn, HTTPServer):
+    """
+    通过/apk/<channel>提供渠道包下载, 支持Range请求
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, apk_source, name_format='app-%s.apk'):
+        HTTPServer.__init__(self, address, ChannelApkRequestHandler)
+        self.apk_source = apk_source
+        self.name_format = name_format
+
+
+class ChannelApkServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp()
+        self._source = os.path.join(self._tmp_dir, 'source.apk')
+        apkv2channeltools.ChannelToolsTest._create_v2_apk(self._source)
+        self._apk_source = ChannelApkSource(self._source, cache_size=1)
+        self._server = ChannelApkServer(('127.0.0.1', 0), self._apk_source)
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        self._url = 'http://127.0.0.1:%d/apk/' % self._server.server_port
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._apk_source.release()
+        shutil.rmtree(self._tmp_dir)
+
+    def test_download_and_range(self):
+        expected = generate_channel_files(self._source, ['official'],
+                                          self._tmp_dir)[0]
+        with open(expected.target_file, 'rb') as f:
+            data = f.read()
+
+        with urllib.request.urlopen(self._url + 'official') as resp:
+            self.assertEqual(data, resp.read())
+            self.assertEqual(str(len(data)), resp.headers['Content-Length'])
+
+        for start, end in ((0, 99), (len(data) - 500, len(data) - 1),
+                           (1000, len(data) - 300)):
+            req = urllib.request.Request(
+                self._url + 'official',
+                headers={'Range': 'bytes=%d-%d' % (start, end)})
+            with urllib.request.urlopen(req) as resp:
+                self.assertEqual(206, resp.status)
+                self.assertEqual(data[start: end + 1], resp.read())
+
+        with urllib.request.urlopen(self._url + 'other') as resp:
+            resp.read()
+        self.assertEqual((3, 2, 1), self._apk_source.cache_info)
+
+        req = urllib.request.Request(self._url + 'official',
+                                     headers={'Range': 'bytes=%d-'
+                                                       % len(data)})
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(req)
+        self.assertEqual(416, cm.exception.code)
+
+    def test_source_replaced(self):
+        expected = generate_channel_files(self._source, ['official'],
+                                          self._tmp_dir)[0]
+        with open(expected.target_file, 'rb') as f:
+            data = f.read()
+        # 服务期间替换源apk, 仍发送解析时的文件
+        replacement = os.path.join(self._tmp_dir, 'replacement.apk')
+        with open(replacement, 'wb') as f:
+            f.write(b'\0' * len(data))
+        os.replace(replacement, self._source)
+
+        with urllib.request.urlopen(self._url + 'official') as resp:
+            self.assertEqual(data, resp.read())
+
+    def test_invalid_channel(self):
+        for channel in ('x%0D%0ASet-Cookie:%20pwned=1', 'a%2Fb', '..',
+                        'a%00b', 'a%09b'):
+            req = urllib.request.Request(self._url + channel, method='HEAD')
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                urllib.request.urlopen(req)
+            self.assertEqual(400, cm.exception.code)
+            self.assertIsNone(cm.exception.headers['Set-Cookie'])
+        self.assertEqual((0, 0, 0), self._apk_source.cache_info)
+
+        req = urllib.request.Request(self._url + '%E5%AE%98%E6%96%B9%22',
+                                     method='HEAD')
+        with urllib.request.urlopen(req) as resp:
+            self.assertEqual(
+                "attachment; filename=\"app-___.apk\"; "
+                "filename*=UTF-8''app-%E5%AE%98%E6%96%B9%22.apk",
+                resp.headers['Content-Disposition'])
+
+
+if __name__ == '__main__':
+
+    _source_apk = None
+    _host = '127.0.0.1'
+    _port = 8080
+    _format = 'app-%s.apk'
+    _cache_size = _DEFAULT_CACHE_SIZE
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "",
+                                   ["source-apk=", "host=", "port=",
+                                    "format=", "cache-size="])
+        for opt, arg in opts:
+            if opt == '--source-apk':
+                _source_apk = arg
+            elif opt == '--host':
+                _host = arg
+            elif opt == '--port':
+                _port = int(arg)
+            elif opt == '--format':
+                _format = arg
+            elif opt == '--cache-size':
+                _cache_size = int(arg)
+    except (getopt.GetoptError, ValueError):
+        print("apkchannelserver.py --source-apk=<sourceApk> [--host=<host>]"
+              + " [--port=<port>] [--format=<formatStr>]"
+              + " [--cache-size=<cacheSize>]")
+        sys.exit(1)
+
+    try:
+        _apk_source = ChannelApkSource(_source_apk, _cache_size)
+    except SignatureNotFoundError:
+        print("%s is not a apk signed by scheme v2" % _source_apk)
+        sys.exit(2)
+
+    _server = ChannelApkServer((_host, _port), _apk_source, _format)
+    logging.info("serve %s on http://%s:%d/apk/<channel>"
+                 % (_source_apk, _host, _server.server_port))
+    try:
+        _server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _server.server_close()
+        _apk_source.release()
+    sys.exit(0)
@@ -7,7 +7,14 @@ this module to write channel info to apk which signing with scheme v2
 
 __author__ = 'Jiasheng Lee'
 
-import os, unittest, logging, getopt, sys
+import os, unittest, logging, getopt, sys, errno, struct, threading, io, \
+    tempfile, zipfile, collections, json, csv, time, zlib, hashlib, shutil
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s\t\t%(asctime)s'
@@ -18,12 +25,26 @@ _UNIT16_MAX_VALUE = 0xffff
 _ZIP_EOCD_REC_MIN_SIZE = 22
 # eocd 部起始标示
 _ZIP_EOCD_REC_SIGN = bytearray(b'\x06\x05\x4b\x50')
+# eocd 部起始标示在文件中的字节序
+_ZIP_EOCD_REC_SIGN_IN_FILE = bytes(reversed(_ZIP_EOCD_REC_SIGN))
 # eocd comment length 字段在eocd中的偏移量
 _ZIP_EOCD_COMMENT_LENGTH_FIELD_OFFSET = 20
 # eocd locator 偏移量
 _ZIP64_EOCD_LOCATOR_SIZE = 20
 # eocd locator 起始标示
 _ZIP64_EOCD_LOCATOR_SIGN_REVERSE_BYTE_ORDER = 0x07064b50
+# zip64 eocd locator 中zip64 eocd record偏移量字段的偏移量
+_ZIP64_EOCD_LOCATOR_RECORD_OFFSET_FIELD_OFFSET = 8
+# zip64 eocd record 起始标示
+_ZIP64_EOCD_REC_SIGN_REVERSE_BYTE_ORDER = 0x06064b50
+# zip64 eocd record 最小大小
+_ZIP64_EOCD_REC_MIN_SIZE = 56
+# zip64 eocd record 中central directory 大小字段的偏移量
+_ZIP64_EOCD_CENTRAL_DIR_SIZE_FIELD_OFFSET = 40
+# zip64 eocd record 中central directory 偏移量字段的偏移量
+_ZIP64_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET = 48
+# eocd 中4字节字段的最大值, 超出时使用zip64 eocd record中的值
+_UINT32_MAX_VALUE = 0xffffffff
 # central directory 偏移量字段在eocd段中的偏移量
 _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET = 16
 # central directory 大小字段在eocd端中的偏移量
@@ -33,16 +54,98 @@ _SIGN_EXTRA_ID_LENGTH = 4
 # sign block magic
 _APK_SIGN_BLOCK_MAGIC = bytearray(b'\x32\x34\x20\x6b\x63\x6f\x6c\x42'
                                   b'\x20\x67\x69\x53\x20\x4b\x50\x41')
+# sign block magic在文件中的字节序
+_APK_SIGN_BLOCK_MAGIC_IN_FILE = bytes(reversed(_APK_SIGN_BLOCK_MAGIC))
 # signature scheme v2 block id
 _APK_SIGNATURE_SCHEME_V2_BLOCK_ID = bytearray(b'\x71\x09\x87\x1a')
 # signature scheme v2 channel id
 _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID = bytearray(b'\x71\x09\x87\x19')
+# verity padding block id, 用于填充渠道预留空间, 校验签名时会被忽略
+_APK_VERITY_PADDING_BLOCK_ID = bytearray(b'\x42\x72\x65\x77')
+# 渠道补丁文件起始标示
+_CHANNEL_PATCH_MAGIC = b'APKCHPT1'
+# 渠道补丁文件头: magic, 基础apk大小, 基础apk sha256, signing block偏移量,
+# Central Directory偏移量, Central Directory大小, signing block长度, eocd长度
+_CHANNEL_PATCH_HEADER = struct.Struct('<8sQ32sQQQII')
+# 分块拷贝时单次读写的大小
+_COPY_CHUNK_SIZE = 1024 * 1024
+# 内核拷贝单次调用的最大长度
+_KERNEL_COPY_MAX_SIZE = 0x40000000
+# 内核拷贝不可用时需要回退的错误码
+_KERNEL_COPY_UNSUPPORTED_ERRNO = frozenset(
+    getattr(errno, x) for x in ('ENOSYS', 'EXDEV', 'EINVAL', 'EOPNOTSUPP',
+                                'ENOTSUP', 'ENOTSOCK', 'EPERM')
+    if hasattr(errno, x))
+# FICLONERANGE ioctl, _IOW(0x94, 13, struct file_clone_range)
+_FICLONERANGE = 0x4020940d
+# 不支持reflink时需要回退的错误码
+_CLONE_UNSUPPORTED_ERRNO = _KERNEL_COPY_UNSUPPORTED_ERRNO | frozenset(
+    getattr(errno, x) for x in ('ENOTTY', 'EBADF', 'ETXTBSY')
+    if hasattr(errno, x))
+# 不支持pread时保证lseek + read的原子性
+_pread_lock = threading.Lock()
 
 
 class SignatureNotFoundError(BaseException):
     pass
 
 
+class ChannelPatchError(BaseException):
+    pass
+
+
+class CopyStats(object):
+    """
+    统计写渠道包时拷贝的字节数和系统调用次数, 可在多个线程中共享
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bytes_copied = 0
+        self._bytes_cloned = 0
+        self._syscalls = 0
+
+    @property
+    def bytes_copied(self):
+        return self._bytes_copied
+
+    @property
+    def bytes_cloned(self):
+        return self._bytes_cloned
+
+    @property
+    def syscalls(self):
+        return self._syscalls
+
+    def record(self, size, syscalls=1):
+        with self._lock:
+            self._bytes_copied += size
+            self._syscalls += syscalls
+
+    def record_clone(self, size):
+        with self._lock:
+            self._bytes_cloned += size
+            self._syscalls += 1
+
+    def __repr__(self):
+        return 'CopyStats(bytes_copied=%d, bytes_cloned=%d, syscalls=%d)' \
+               % (self._bytes_copied, self._bytes_cloned, self._syscalls)
+
+
+def _kernel_copy_by_copy_file_range(src_fd, dst_fd, offset, size):
+    return os.copy_file_range(src_fd, dst_fd, size, offset)
+
+
+def _kernel_copy_by_sendfile(src_fd, dst_fd, offset, size):
+    return os.sendfile(dst_fd, src_fd, offset, size)
+
+
+# 按优先级排列的内核拷贝方式
+_KERNEL_COPY_FUNCS = tuple(func for name, func in (
+    ('copy_file_range', _kernel_copy_by_copy_file_range),
+    ('sendfile', _kernel_copy_by_sendfile)) if hasattr(os, name))
+
+
 class FileTools(object):
 
     @staticmethod
@@ -70,6 +173,136 @@ class FileTools(object):
         data.reverse()
         return data
 
+    @staticmethod
+    def pread(fd, size, offset):
+        """
+        从文件指定位置读取数据, 不改变文件当前的读写位置
+        :param fd: 文件描述符
+        :param size: 读取长度
+        :param offset: 起始位置
+        :return:
+        """
+        if hasattr(os, 'pread'):
+            return os.pread(fd, size, offset)
+        with _pread_lock:
+            original_pos = os.lseek(fd, 0, os.SEEK_CUR)
+            try:
+                os.lseek(fd, offset, os.SEEK_SET)
+                return os.read(fd, size)
+            finally:
+                os.lseek(fd, original_pos, os.SEEK_SET)
+
+    @staticmethod
+    def write_fully(fd, data, stats=None):
+        """
+        将data完整写入fd的当前位置
+        :param fd: 文件描述符
+        :param data: 待写入数据
+        :param stats: 拷贝统计, 可为None
+        :return:
+        """
+        view = memoryview(data)
+        syscalls = 0
+        while view:
+            written = os.write(fd, view)
+            syscalls += 1
+            view = view[written:]
+        if stats is not None:
+            stats.record(len(data), syscalls)
+
+    @staticmethod
+    def copy_range(src_fd, dst_fd, offset, size, stats=None):
+        """
+        将src_fd中[offset, offset + size)的数据追加写入dst_fd,
+        优先使用copy_file_range/sendfile在内核中完成拷贝,
+        不支持时回退到固定大小的分块读写, 内存占用与文件大小无关
+        :param src_fd: 源文件描述符, 读取不改变其读写位置
+        :param dst_fd: 目标文件描述符, 从其当前位置开始写
+        :param offset: 源文件起始位置
+        :param size: 拷贝长度
+        :param stats: 拷贝统计, 可为None
+        :return:
+        """
+        copy_funcs = list(_KERNEL_COPY_FUNCS)
+        while size > 0:
+            if copy_funcs:
+                try:
+                    copied = copy_funcs[0](
+                        src_fd, dst_fd, offset,
+                        min(size, _KERNEL_COPY_MAX_SIZE))
+                except OSError as e:
+                    if e.errno not in _KERNEL_COPY_UNSUPPORTED_ERRNO:
+                        raise
+                    copy_funcs.pop(0)
+                    continue
+                if stats is not None:
+                    stats.record(copied)
+            else:
+                data = FileTools.pread(src_fd, min(size, _COPY_CHUNK_SIZE),
+                                       offset)
+                copied = len(data)
+                if stats is not None:
+                    stats.record(0)
+                FileTools.write_fully(dst_fd, data, stats)
+
+            if copied == 0:
+                raise IOError('unexpected end of file at %d' % offset)
+            offset += copied
+            size -= copied
+
+    @staticmethod
+    def iter_range(fd, offset, size, chunk_size=_COPY_CHUNK_SIZE):
+        """
+        分块读取文件中[offset, offset + size)的数据
+        :param fd: 文件描述符
+        :param offset: 起始位置
+        :param size: 读取长度
+        :param chunk_size: 单次读取的大小
+        :return: 数据块的生成器
+        """
+        while size > 0:
+            data = FileTools.pread(fd, min(size, chunk_size), offset)
+            if not data:
+                raise IOError('unexpected end of file at %d' % offset)
+            yield data
+            offset += len(data)
+            size -= len(data)
+
+    @staticmethod
+    def clone_range(src_fd, dst_fd, offset, size, stats=None):
+        """
+        将src_fd中[offset, offset + size)的数据追加到dst_fd, 按文件系统块对齐的
+        部分通过FICLONERANGE共享数据块(XFS/btrfs等支持reflink的文件系统),
+        剩余部分及不支持reflink时回退到copy_range
+        :param src_fd: 源文件描述符
+        :param dst_fd: 目标文件描述符, 从其当前位置开始写
+        :param offset: 源文件起始位置
+        :param size: 拷贝长度
+        :param stats: 拷贝统计, 可为None
+        :return:
+        """
+        dst_offset = os.lseek(dst_fd, 0, os.SEEK_CUR)
+        block_size = os.fstat(dst_fd).st_blksize or 4096
+        clone_size = size - size % block_size
+
+        if fcntl is not None and clone_size > 0 \
+                and offset % block_size == 0 and dst_offset % block_size == 0:
+            try:
+                fcntl.ioctl(dst_fd, _FICLONERANGE,
+                            struct.pack('=qQQQ', src_fd, offset, clone_size,
+                                        dst_offset))
+            except OSError as e:
+                if e.errno not in _CLONE_UNSUPPORTED_ERRNO:
+                    raise
+            else:
+                if stats is not None:
+                    stats.record_clone(clone_size)
+                os.lseek(dst_fd, dst_offset + clone_size, os.SEEK_SET)
+                offset += clone_size
+                size -= clone_size
+
+        FileTools.copy_range(src_fd, dst_fd, offset, size, stats)
+
     @staticmethod
     def read_config_file(file_name):
         try:
@@ -81,80 +314,90 @@ class FileTools(object):
             logging.error("read %s error: %s" % (file_name, e))
             raise e
 
+    @staticmethod
+    def iter_config_file(file_name):
+        """
+        逐行读取配置文件, 跳过空行和以'#'开头的注释行
+        :param file_name: 配置文件
+        :return: 返回(行号, 内容)的生成器
+        """
+        with open(file_name, 'rt', encoding='UTF-8') as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line_no, line
+
 
-def _get_eocd_offset_in_file(file):
+def _find_eocd_in_buffer(data):
     """
-    获取eocd部在zip文件中的偏移量
-    :param file: zip文件
-    :return:
+    在zip文件尾部数据中查找eocd部, 从后向前查找eocd起始标示, 并校验comment
+    长度恰好延伸到数据末尾
+    :param data: zip文件尾部数据
+    :return: 返回eocd在data中的偏移量, 未找到返回-1
     """
-    file_size = FileTools.get_file_size(file)
-    if file_size < _ZIP_EOCD_REC_MIN_SIZE:
-        return -1
-
-    max_comment_size = min(file_size - _ZIP_EOCD_REC_MIN_SIZE,
-                           _UNIT16_MAX_VALUE)
-    empty_comment_start_pos = file_size - _ZIP_EOCD_REC_MIN_SIZE
-
-    comment_length = 0
-    while comment_length < max_comment_size:
-        eocd_start_pos = empty_comment_start_pos - comment_length
+    end = len(data) - _ZIP_EOCD_REC_MIN_SIZE
+    pos = data.rfind(_ZIP_EOCD_REC_SIGN_IN_FILE, 0,
+                     end + len(_ZIP_EOCD_REC_SIGN_IN_FILE))
+    while pos >= 0:
+        comment_length = struct.unpack_from(
+            '<H', data, pos + _ZIP_EOCD_COMMENT_LENGTH_FIELD_OFFSET)[0]
+        if pos + _ZIP_EOCD_REC_MIN_SIZE + comment_length == len(data):
+            return pos
+        pos = data.rfind(_ZIP_EOCD_REC_SIGN_IN_FILE, 0,
+                         pos + len(_ZIP_EOCD_REC_SIGN_IN_FILE) - 1)
+    return -1
 
-        file.seek(eocd_start_pos, os.SEEK_SET)
-        tmp_data = FileTools.read_little_endian_data(file, 4)
 
-        if tmp_data == _ZIP_EOCD_REC_SIGN:
-            file.seek(_ZIP_EOCD_COMMENT_LENGTH_FIELD_OFFSET - 4,
-                      os.SEEK_CUR)
-            actual_comment_length = FileTools.read_int(file, 2)
+def _read_eocd_of_file(fd, file_size):
+    """
+    一次读取zip文件最后64KiB + 22字节, 并从中查找eocd部
+    :param fd: zip文件描述符
+    :param file_size: 文件大小
+    :return: 返回eocd在文件中的偏移量及eocd部数据, 未找到时返回(-1, None)
+    """
+    if file_size < _ZIP_EOCD_REC_MIN_SIZE:
+        return -1, None
 
-            if actual_comment_length == comment_length:
-                file.seek(0, os.SEEK_SET)
-                return eocd_start_pos
-            file.seek(eocd_start_pos, os.SEEK_SET)
+    tail_size = min(file_size, _UNIT16_MAX_VALUE + _ZIP_EOCD_REC_MIN_SIZE)
+    tail_offset = file_size - tail_size
+    tail = FileTools.pread(fd, tail_size, tail_offset)
 
-        comment_length += 1
-    return -1
+    pos = _find_eocd_in_buffer(tail)
+    if pos < 0:
+        return -1, None
+    return tail_offset + pos, memoryview(tail)[pos:]
 
 
-def _get_central_directory_offset_in_file(file, eocd_offset):
+def _get_central_directory_offset(eocd, eocd_offset):
     """
     返回Central Directory部在zip文件中的起始位置
-    :param file: zip文件
+    :param eocd: Central Directory之后的数据, zip64格式时以zip64 eocd record
+    开头
     :param eocd_offset: eocd在文件中的起始位置
     :return:
     """
-    file.seek(eocd_offset + _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET,
-              os.SEEK_SET)
-    central_dir_offset = FileTools.read_int(file, 4)
-
-    file.seek(eocd_offset + _ZIP_EOCD_CENTRAL_DIR_SIZE_FIELD_OFFSET,
-              os.SEEK_SET)
-    central_dir_size = FileTools.read_int(file, 4)
+    central_dir_size, central_dir_offset = _get_trailer_central_dir(eocd)
 
     if central_dir_offset + central_dir_size != eocd_offset:
         raise SignatureNotFoundError('ZIP Central Directory is not'
-                                     + 'immediately followed by End of' +
+                                     + ' immediately followed by End of' +
                                      ' Central Directory')
     return central_dir_offset
 
 
-def _is_zip64_end_of_central_directory_locator_present(file,
-                                                       ecod_offset):
+def _is_zip64_end_of_central_directory_locator_present(fd, ecod_offset):
     """
     判断文件是否zip64格式
-    :param file: 对应文件
+    :param fd: 对应文件描述符
     :param ecod_offset: eocd部在文件中的偏移量
     :return:
     """
-    locator_pos = ecod_offset - _ZIP_EOCD_COMMENT_LENGTH_FIELD_OFFSET
+    locator_pos = ecod_offset - _ZIP64_EOCD_LOCATOR_SIZE
 
     if locator_pos < 0:
         return False
 
-    file.seek(locator_pos, os.SEEK_SET)
-
-    return FileTools.read_int(file, 4) \
+    return struct.unpack('<I', FileTools.pread(fd, 4, locator_pos))[0] \
            == _ZIP64_EOCD_LOCATOR_SIGN_REVERSE_BYTE_ORDER
 
 
@@ -186,35 +429,95 @@ def _create_channel_data(channel_id, channel_str):
     return data
 
 
-def _get_sign_block_of_apk(file, central_dir_offset):
+def _get_sign_block_of_apk(fd, central_dir_offset):
     """
     提取apk的signing block部分数据
-    :param file: apk 文件
+    :param fd: apk 文件描述符
     :param central_dir_offset: apk Central Directory在文件中的偏移量
     :return:
     """
-    file_size = FileTools.get_file_size(file)
-
-    if central_dir_offset < 0:
-        raise SignatureNotFoundError('Central Directory offset invalid:'
-                                     + central_dir_offset)
-    if central_dir_offset > file_size - _ZIP_EOCD_REC_MIN_SIZE:
-        raise SignatureNotFoundError('central directory offset should not > ' +
-                                     file_size - _ZIP_EOCD_REC_MIN_SIZE)
+    if central_dir_offset < 24:
+        raise SignatureNotFoundError('Central Directory offset invalid: '
+                                     + str(central_dir_offset))
 
     # 校验signing block magic
-    file.seek(central_dir_offset - 16)
-    apk_magic = FileTools.read_little_endian_data(file, 16)
+    footer = FileTools.pread(fd, 24, central_dir_offset - 24)
+    if footer[8:] != _APK_SIGN_BLOCK_MAGIC_IN_FILE:
+        raise SignatureNotFoundError('apk signing block magic is invalid: '
+                                     + footer[8:].hex())
+
+    block_size = struct.unpack_from('<Q', footer)[0]
+    if block_size < 24 or block_size + 8 > central_dir_offset:
+        raise SignatureNotFoundError('apk signing block size out of range: '
+                                     + str(block_size))
+
+    sign_block = FileTools.pread(fd, block_size + 8,
+                                 central_dir_offset - block_size - 8)
+    if struct.unpack_from('<Q', sign_block)[0] != block_size:
+        raise SignatureNotFoundError('apk signing block size in header and'
+                                     + ' footer do not match')
+    return sign_block
+
+
+def _create_channel_slot_data(channel_id, channel_str, slot_size):
+    """
+    构建固定长度的渠道数据, 由渠道信息和紧随其后的padding组成, 修改渠道时只需
+    覆盖这部分数据, 不改变signing block的大小
+    :param channel_id: 渠道标示id, 字节数组
+    :param channel_str: 渠道信息字符串
+    :param slot_size: 预留空间的总长度
+    :return: 返回构建好的byte数组
+    """
+    data = _create_channel_data(channel_id, channel_str)
+    padding_len = slot_size - len(data) - 8 - _SIGN_EXTRA_ID_LENGTH
+    if padding_len < 0:
+        raise SignatureNotFoundError('channel %s is too long for slot size %d'
+                                     % (channel_str, slot_size))
+
+    padding_id = bytearray(_APK_VERITY_PADDING_BLOCK_ID)
+    padding_id.reverse()
+    data.extend((padding_len + _SIGN_EXTRA_ID_LENGTH).to_bytes(
+        8, 'little', signed=False))
+    data.extend(padding_id)
+    data.extend(bytes(padding_len))
+    return data
+
 
-    if apk_magic != _APK_SIGN_BLOCK_MAGIC:
-        raise SignatureNotFoundError('apk signing block magic is invalid:'
-                                     + apk_magic.hex())
+def _index_sign_block(sign_block):
+    """
+    解析signing block中的id-value列表, 建立id到value位置的索引
+    :param sign_block: sign block
+    :return: 返回id(与_APK_SIGNATURE_SCHEME_V2_BLOCK_ID等相同字节序)到
+    (value在sign block中的偏移量, value长度)的字典, id重复时保留第一个
+    """
+    index = {}
+    start_pos = 8
+    end_pos = len(sign_block) - 24
+    entry_count = 0
+
+    while start_pos < end_pos:
+        entry_count += 1
 
-    file.seek(central_dir_offset - 24)
-    block_size = FileTools.read_int(file, 8)
+        # length   (8 bytes)
+        # id       (4 bytes)
+        # content  (length - 4 bytes)
+        if end_pos - start_pos < 8:
+            raise SignatureNotFoundError('insufficient data to read size of'
+                                         + ' signing block entry #%d'
+                                         % entry_count)
+        values_len = struct.unpack_from('<Q', sign_block, start_pos)[0]
+        if values_len < _SIGN_EXTRA_ID_LENGTH \
+                or values_len > end_pos - start_pos - 8:
+            raise SignatureNotFoundError('signing block entry #%d size out of'
+                                         ' range: %d'
+                                         % (entry_count, values_len))
+
+        key_id = bytes(reversed(sign_block[start_pos + 8: start_pos + 12]))
+        index.setdefault(key_id, (start_pos + 12,
+                                  values_len - _SIGN_EXTRA_ID_LENGTH))
 
-    file.seek(central_dir_offset - block_size - 8)
-    return file.read(block_size + 8)
+        start_pos = start_pos + 8 + values_len
+    return index
 
 
 def _combine_sign_block_and_channel(sign_block, channel_data):
@@ -234,30 +537,8 @@ def _combine_sign_block_and_channel(sign_block, channel_data):
     # 新的 size of block
     new_sign_block.extend(new_size_data)
 
-    # 拼接signing block
-    key_value = sign_block[8: old_size - 24]
-    key_value_size = len(key_value)
-
-    entry_count = 0
-    start_pos = 0
-
-    while start_pos < key_value_size:
-        entry_count += 1
-
-        # length   (8 bytes)
-        # id       (4 bytes)
-        # content  (length bytes)
-        values_len = int.from_bytes(key_value[start_pos: start_pos + 8],
-                                    'little', signed=False)
-
-        key_id = bytearray(key_value[start_pos + 8: start_pos + 12])
-        data = key_value[start_pos + 12: start_pos + 12 + values_len]
-
-        new_sign_block.extend(values_len.to_bytes(8, 'little', signed=False))
-        new_sign_block.extend(key_id)
-        new_sign_block.extend(data)
-
-        start_pos = start_pos + 8 + values_len
+    # 拼接原有的id-value列表
+    new_sign_block.extend(memoryview(sign_block)[8: old_size - 24])
 
     # 拼接 channel info
     new_sign_block.extend(channel_data)
@@ -265,73 +546,266 @@ def _combine_sign_block_and_channel(sign_block, channel_data):
     # 拼接 size of block
     new_sign_block.extend(new_size_data)
     # 拼接magic
-    new_sign_block.extend(sign_block[old_size - 16: old_size])
+    new_sign_block.extend(memoryview(sign_block)[old_size - 16: old_size])
     return new_sign_block, new_size - old_size
 
 
-class ApkChannelTool(object):
+def _is_zip64_trailer(eocd):
+    """
+    判断Central Directory之后的数据是否以zip64 eocd record开头
+    :param eocd: Central Directory之后的数据
+    :return:
+    """
+    return len(eocd) >= _ZIP64_EOCD_REC_MIN_SIZE + _ZIP64_EOCD_LOCATOR_SIZE \
+        + _ZIP_EOCD_REC_MIN_SIZE and struct.unpack_from('<I', eocd)[0] \
+        == _ZIP64_EOCD_REC_SIGN_REVERSE_BYTE_ORDER
 
-    def __init__(self, file):
-        self._apk = open(file, 'rb')
-        self._file_size = FileTools.get_file_size(self._apk)
 
-        self._eocd_offset = _get_eocd_offset_in_file(self._apk)
-        if self._eocd_offset < 0 or self._eocd_offset > self._file_size \
-                or _is_zip64_end_of_central_directory_locator_present(
-            self._apk, self._eocd_offset):
-            self._central_dir_offset = -1
-        else:
-            try:
-                self._central_dir_offset = \
-                    _get_central_directory_offset_in_file(self._apk,
-                                                          self._eocd_offset)
-            except SignatureNotFoundError:
-                self._central_dir_offset = -1
+def _get_trailer_central_dir(eocd):
+    """
+    获取Central Directory之后的数据中记录的Central Directory大小和偏移量,
+    支持zip64
+    :param eocd: Central Directory之后的数据
+    :return: 返回(大小, 偏移量)
+    """
+    if _is_zip64_trailer(eocd):
+        return struct.unpack_from('<QQ', eocd,
+                                  _ZIP64_EOCD_CENTRAL_DIR_SIZE_FIELD_OFFSET)
+    return struct.unpack_from('<II', eocd,
+                              _ZIP_EOCD_CENTRAL_DIR_SIZE_FIELD_OFFSET)
 
-        if 0 <= self._central_dir_offset < self._eocd_offset:
-            try:
-                self._sign_block = _get_sign_block_of_apk(
-                    self._apk, self._central_dir_offset)
-            except SignatureNotFoundError:
-                self._sign_block = None
-        else:
-            self._sign_block = None
 
-    def has_extra_info_in_signing_block(self, key_id):
+def _build_zip64_trailer(eocd, central_dir_offset):
+    """
+    将普通的eocd转换为zip64 eocd record + zip64 eocd locator + eocd
+    :param eocd: 普通的eocd
+    :param central_dir_offset: 新的Central Directory偏移量
+    :return: 返回转换后的数据
+    """
+    disk, disk_with_cd, entries_on_disk, entries, central_dir_size = \
+        struct.unpack_from('<HHHHI', eocd, 4)
+    record = struct.pack('<IQHHIIQQQQ', _ZIP64_EOCD_REC_SIGN_REVERSE_BYTE_ORDER,
+                         _ZIP64_EOCD_REC_MIN_SIZE - 12, 45, 45, disk,
+                         disk_with_cd, entries_on_disk, entries,
+                         central_dir_size, central_dir_offset)
+    locator = struct.pack('<IIQI', _ZIP64_EOCD_LOCATOR_SIGN_REVERSE_BYTE_ORDER,
+                          disk_with_cd, central_dir_offset + central_dir_size,
+                          disk + 1)
+    eocd = bytearray(eocd)
+    struct.pack_into('<I', eocd, _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET,
+                     _UINT32_MAX_VALUE)
+    return bytearray(record + locator) + eocd
+
+
+def _patch_eocd_central_dir_offset(eocd, central_dir_offset):
+    """
+    修改eocd中Central Directory的偏移量, zip64格式时同时修改zip64 eocd record
+    和locator, 普通格式的偏移量超出4字节时转换为zip64格式
+    :param eocd: Central Directory之后的数据
+    :param central_dir_offset: 新的Central Directory偏移量
+    :return: 返回修改后的数据
+    """
+    if not _is_zip64_trailer(eocd):
+        if central_dir_offset >= _UINT32_MAX_VALUE:
+            return _build_zip64_trailer(eocd, central_dir_offset)
+        eocd = bytearray(eocd)
+        struct.pack_into('<I', eocd, _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET,
+                         central_dir_offset)
+        return eocd
+
+    eocd = bytearray(eocd)
+    record_size = struct.unpack_from('<Q', eocd, 4)[0] + 12
+    central_dir_size = struct.unpack_from(
+        '<Q', eocd, _ZIP64_EOCD_CENTRAL_DIR_SIZE_FIELD_OFFSET)[0]
+    struct.pack_into('<Q', eocd, _ZIP64_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET,
+                     central_dir_offset)
+    struct.pack_into('<Q', eocd, record_size
+                     + _ZIP64_EOCD_LOCATOR_RECORD_OFFSET_FIELD_OFFSET,
+                     central_dir_offset + central_dir_size)
+
+    eocd_pos = record_size + _ZIP64_EOCD_LOCATOR_SIZE
+    field_pos = eocd_pos + _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET
+    if struct.unpack_from('<I', eocd, field_pos)[0] != _UINT32_MAX_VALUE:
+        struct.pack_into('<I', eocd, field_pos,
+                         min(central_dir_offset, _UINT32_MAX_VALUE))
+    return eocd
+
+
+def _read_zip64_trailer(fd, eocd_offset, eocd):
+    """
+    读取zip64 eocd record, locator和eocd
+    :param fd: zip文件描述符
+    :param eocd_offset: eocd在文件中的偏移量
+    :param eocd: eocd部数据
+    :return: 返回zip64 eocd record在文件中的偏移量及其之后的全部数据
+    """
+    locator = FileTools.pread(fd, _ZIP64_EOCD_LOCATOR_SIZE,
+                              eocd_offset - _ZIP64_EOCD_LOCATOR_SIZE)
+    record_offset = struct.unpack_from(
+        '<Q', locator, _ZIP64_EOCD_LOCATOR_RECORD_OFFSET_FIELD_OFFSET)[0]
+    record_size = eocd_offset - _ZIP64_EOCD_LOCATOR_SIZE - record_offset
+    if record_size < _ZIP64_EOCD_REC_MIN_SIZE:
+        raise SignatureNotFoundError('zip64 eocd record offset out of range: '
+                                     + str(record_offset))
+
+    record = FileTools.pread(fd, record_size, record_offset)
+    if struct.unpack_from('<I', record)[0] \
+            != _ZIP64_EOCD_REC_SIGN_REVERSE_BYTE_ORDER \
+            or struct.unpack_from('<Q', record, 4)[0] + 12 != record_size:
+        raise SignatureNotFoundError('zip64 eocd record is invalid')
+    return record_offset, record + locator + bytes(eocd)
+
+
+# apk解析结果, 解析一次后可在多个线程间共享; eocd为Central Directory之后的
+# 全部数据, eocd_offset为其在文件中的偏移量, zip64格式时包含zip64 eocd record
+# 和locator
+ApkLayout = collections.namedtuple('ApkLayout', ['file_size', 'eocd_offset',
+                                                 'central_dir_offset',
+                                                 'sign_block', 'eocd',
+                                                 'sign_block_index'])
+
+
+class ChannelTail(collections.namedtuple('ChannelTail',
+                                         ['sign_block_offset', 'sign_block',
+                                          'central_dir_offset',
+                                          'central_dir_size', 'eocd'])):
+    """
+    渠道包中signing block之后不同于源apk的数据, sign_block_offset之前的数据
+    与源apk相同, central_dir_offset和central_dir_size为源apk中Central
+    Directory的位置
+    """
+
+    @property
+    def file_size(self):
         """
-        判断apk的signing block是否含有key_id
-        :param key_id:
-        :return:
+        渠道包的文件大小
         """
-        if self._sign_block:
-            sign_block = self._sign_block
-            key_value = sign_block[8:len(sign_block) - 24]
-            key_value_size = len(key_value)
-            entry_count = 0
+        return self.sign_block_offset + len(self.sign_block) \
+            + self.central_dir_size + len(self.eocd)
 
-            start_pos = 0
 
-            while start_pos < key_value_size:
-                entry_count += 1
+# 渠道预留空间在文件中的位置和长度
+ChannelSlot = collections.namedtuple('ChannelSlot', ['offset', 'size',
+                                                     'channel_id'])
 
-                # length   (8 bytes)
-                # id       (4 bytes)
-                # content  (length bytes)
-                values_len = key_value[start_pos: start_pos + 8]
-                tmp_key_id = bytearray(key_value[start_pos + 8: start_pos + 12])
-                tmp_key_id.reverse()
 
-                next_entry_pos = start_pos + 8 + int.from_bytes(values_len,
-                                                                'little',
-                                                                signed=False)
+class ChannelResult(collections.namedtuple('ChannelResult',
+                                           ['channel', 'target_file',
+                                            'error', 'digest', 'size',
+                                            'sha256'])):
+    """
+    单个渠道包的生成结果, error为None表示生成成功, digest为写入尾部数据的
+    校验值, sha256为整个渠道包的sha256, 未要求计算时为None
+    """
 
-                if tmp_key_id == key_id:
-                    return True
+    @property
+    def success(self):
+        return self.error is None
 
-                start_pos = next_entry_pos
 
-            return False
-        return False
+class AuditResult(collections.namedtuple('AuditResult',
+                                         ['path', 'size', 'v2_signed',
+                                          'channel', 'error'])):
+    """
+    单个apk的渠道检查结果
+    """
+    pass
+
+
+def _parse_apk_layout(fd):
+    """
+    解析apk的eocd, Central Directory偏移量和signing block, eocd通过一次读取
+    文件尾部获得, 其余字段直接从读取的数据中解析
+    :param fd: apk文件描述符
+    :return: 返回ApkLayout
+    """
+    file_size = os.fstat(fd).st_size
+
+    eocd_offset, eocd = _read_eocd_of_file(fd, file_size)
+    central_dir_offset = -1
+    if eocd_offset >= 0:
+        try:
+            if _is_zip64_end_of_central_directory_locator_present(
+                    fd, eocd_offset):
+                eocd_offset, eocd = _read_zip64_trailer(fd, eocd_offset,
+                                                        eocd)
+                eocd = memoryview(eocd)
+            central_dir_offset = _get_central_directory_offset(eocd,
+                                                               eocd_offset)
+        except SignatureNotFoundError:
+            central_dir_offset = -1
+
+    sign_block = None
+    sign_block_index = {}
+    if 0 <= central_dir_offset < eocd_offset:
+        try:
+            sign_block = _get_sign_block_of_apk(fd, central_dir_offset)
+            sign_block_index = _index_sign_block(sign_block)
+        except SignatureNotFoundError:
+            sign_block = None
+    return ApkLayout(file_size, eocd_offset, central_dir_offset, sign_block,
+                     eocd.tobytes() if eocd is not None else None,
+                     sign_block_index)
+
+
+class ApkChannelTool(object):
+
+    def __init__(self, file, layout=None):
+        """
+        :param file: apk文件
+        :param layout: 已解析的ApkLayout, 为None时重新解析
+        """
+        self._apk = open(file, 'rb')
+        self._copy_stats = CopyStats()
+        self._prefix_hashes = {}
+        self._prefix_hash_lock = threading.Lock()
+        if layout is None:
+            layout = _parse_apk_layout(self._apk.fileno())
+        self._layout = layout
+        self._file_size = layout.file_size
+        self._eocd_offset = layout.eocd_offset
+        self._central_dir_offset = layout.central_dir_offset
+        self._sign_block = layout.sign_block
+        self._eocd = layout.eocd
+
+    @property
+    def layout(self):
+        return self._layout
+
+    def fileno(self):
+        """
+        源apk的文件描述符, 只能用于pread等不改变读写位置的操作
+        :return:
+        """
+        return self._apk.fileno()
+
+    def has_extra_info_in_signing_block(self, key_id):
+        """
+        判断apk的signing block是否含有key_id
+        :param key_id:
+        :return:
+        """
+        return bytes(key_id) in self._layout.sign_block_index
+
+    def get_extra_info(self, key_id):
+        """
+        获取signing block中key_id对应的value, 不拷贝数据
+        :param key_id: 4字节的id
+        :return: 返回value的memoryview, 不存在时返回None
+        """
+        entry = self._layout.sign_block_index.get(bytes(key_id))
+        if entry is None:
+            return None
+        offset, length = entry
+        return memoryview(self._sign_block)[offset: offset + length]
+
+    def get_channel(self, channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
+        """
+        获取apk的渠道信息
+        :param channel_id: 渠道标示id, 字节数组
+        :return: 返回渠道信息的memoryview(utf-8编码), 不存在时返回None
+        """
+        return self.get_extra_info(channel_id)
 
     def has_v2_signature(self):
         """
@@ -341,36 +815,196 @@ class ApkChannelTool(object):
         return self.has_extra_info_in_signing_block(
             _APK_SIGNATURE_SCHEME_V2_BLOCK_ID)
 
-    def save_as_channel_file(self, target_file, channel_id, channel_str):
-        if self._sign_block:
+    @property
+    def copy_stats(self):
+        """
+        写渠道包时累计的拷贝字节数和系统调用次数
+        :return:
+        """
+        return self._copy_stats
+
+    def build_channel_tail(self, channel_id, channel_str, slot_size=None):
+        """
+        构建渠道包signing block之后不同于源apk的数据, 即新的signing block和
+        修改了Central Directory偏移量的eocd
+        :param channel_id: 渠道标示id, 字节数组
+        :param channel_str: 渠道信息字符串
+        :param slot_size: 不为None时为渠道预留固定长度的空间, 之后可通过
+        stamp_channel_slot原地修改渠道
+        :return: 返回ChannelTail
+        """
+        if not self._sign_block:
+            raise SignatureNotFoundError('this file not sign by v2')
+
+        if slot_size is None:
             channel_block = _create_channel_data(channel_id, channel_str)
-            new_sign_block, add_size = _combine_sign_block_and_channel(
-                self._sign_block, channel_block)
-            with open(target_file, 'w+b'):
-                pass
-
-            with open(target_file, 'r+b') as new_apk:
-                self._apk.seek(0, os.SEEK_SET)
-                pre_data = self._apk.read(self._central_dir_offset
-                                          - len(self._sign_block))
-                # 写signing block前置数据
-                new_apk.write(pre_data)
-
-                # 写new signing block
-                new_apk.write(new_sign_block)
-
-                # 写 Central Directory 及后置数据
-                self._apk.seek(self._central_dir_offset, os.SEEK_SET)
-                tmp = self._apk.read(self._file_size - self._central_dir_offset)
-                new_apk.write(tmp)
-
-                # 修改Central Directory在eocd中的偏移量
-                new_apk.seek(self._eocd_offset + add_size
-                             + _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET)
-                new_apk.write((self._central_dir_offset + add_size).to_bytes(
-                    4, 'little', signed=False))
-                return True
-        raise SignatureNotFoundError('this file not sign by v2')
+        else:
+            channel_block = _create_channel_slot_data(channel_id, channel_str,
+                                                      slot_size)
+        new_sign_block, add_size = _combine_sign_block_and_channel(
+            self._sign_block, channel_block)
+        eocd = _patch_eocd_central_dir_offset(
+            self._eocd, self._central_dir_offset + add_size)
+        return ChannelTail(self._central_dir_offset - len(self._sign_block),
+                           bytes(new_sign_block), self._central_dir_offset,
+                           self._eocd_offset - self._central_dir_offset,
+                           bytes(eocd))
+
+    def _update_hash_with_tail(self, hash_obj, tail):
+        hash_obj.update(tail.sign_block)
+        for data in FileTools.iter_range(self._apk.fileno(),
+                                         tail.central_dir_offset,
+                                         tail.central_dir_size):
+            hash_obj.update(data)
+        hash_obj.update(tail.eocd)
+        return hash_obj
+
+    def tail_digest(self, tail, algorithm='crc32'):
+        """
+        计算渠道包signing block起至文件末尾数据的校验值, Central Directory从
+        源apk中分块读取
+        :param tail: build_channel_tail返回的ChannelTail
+        :param algorithm: crc32或hashlib支持的算法名
+        :return: 返回16进制的校验值
+        """
+        if algorithm == 'crc32':
+            crc = zlib.crc32(tail.sign_block)
+            for data in FileTools.iter_range(self._apk.fileno(),
+                                             tail.central_dir_offset,
+                                             tail.central_dir_size):
+                crc = zlib.crc32(data, crc)
+            return '%08x' % (zlib.crc32(tail.eocd, crc) & 0xffffffff)
+        return self._update_hash_with_tail(hashlib.new(algorithm),
+                                           tail).hexdigest()
+
+    def prefix_hash(self, algorithm='sha256'):
+        """
+        计算signing block之前数据的hash, 各渠道包共享这部分数据, 只计算一次
+        :param algorithm: hashlib支持的算法名
+        :return: 返回hash对象, 使用时需先copy()
+        """
+        with self._prefix_hash_lock:
+            hash_obj = self._prefix_hashes.get(algorithm)
+            if hash_obj is None:
+                if not self._sign_block:
+                    raise SignatureNotFoundError('this file not sign by v2')
+                hash_obj = hashlib.new(algorithm)
+                for data in FileTools.iter_range(
+                        self._apk.fileno(), 0,
+                        self._central_dir_offset - len(self._sign_block)):
+                    hash_obj.update(data)
+                self._prefix_hashes[algorithm] = hash_obj
+            return hash_obj
+
+    def file_digest(self, tail, algorithm='sha256'):
+        """
+        计算整个渠道包的hash, signing block之前的部分复用prefix_hash的结果,
+        只需读取Central Directory
+        :param tail: build_channel_tail返回的ChannelTail
+        :param algorithm: hashlib支持的算法名
+        :return: 返回16进制的hash值
+        """
+        return self._update_hash_with_tail(
+            self.prefix_hash(algorithm).copy(), tail).hexdigest()
+
+    def source_digest(self, algorithm='sha256'):
+        """
+        计算源apk的hash, signing block之前的部分复用prefix_hash的结果
+        :param algorithm: hashlib支持的算法名
+        :return: 返回hash值
+        """
+        hash_obj = self.prefix_hash(algorithm).copy()
+        hash_obj.update(self._sign_block)
+        for data in FileTools.iter_range(
+                self._apk.fileno(), self._central_dir_offset,
+                self._file_size - self._central_dir_offset):
+            hash_obj.update(data)
+        return hash_obj.digest()
+
+    def copy_source_file(self, target_file, stats=None, clone=False):
+        """
+        完整拷贝源apk
+        :param target_file: 目标文件路径
+        :param stats: 拷贝统计, 为None时累计到copy_stats
+        :param clone: 是否以reflink方式共享数据块
+        :return:
+        """
+        copy_func = FileTools.clone_range if clone else FileTools.copy_range
+        with open(target_file, 'wb') as f:
+            copy_func(self._apk.fileno(), f.fileno(), 0, self._file_size,
+                      self._copy_stats if stats is None else stats)
+
+    def write_channel_patch(self, patch_file, channel_id, channel_str,
+                            base_digest=None, slot_size=None):
+        """
+        生成渠道补丁文件, 只包含新的signing block, eocd及其在基础apk(即源apk)
+        中的拼接位置, 通过apply_channel_patch可还原出完整的渠道包
+        :param patch_file: 补丁文件路径
+        :param channel_id: 渠道标示id, 字节数组
+        :param channel_str: 渠道信息字符串
+        :param base_digest: 源apk的sha256, 为None时重新计算
+        :param slot_size: 不为None时为渠道预留固定长度的空间
+        :return: 返回写入的ChannelTail
+        """
+        tail = self.build_channel_tail(channel_id, channel_str, slot_size)
+        if base_digest is None:
+            base_digest = self.source_digest()
+
+        with open(patch_file, 'wb') as f:
+            f.write(_CHANNEL_PATCH_HEADER.pack(
+                _CHANNEL_PATCH_MAGIC, self._file_size, base_digest,
+                tail.sign_block_offset, tail.central_dir_offset,
+                tail.central_dir_size, len(tail.sign_block), len(tail.eocd)))
+            f.write(tail.sign_block)
+            f.write(tail.eocd)
+        return tail
+
+    def write_channel_file(self, target_file, channel_id, channel_str,
+                           stats=None, clone=False, slot_size=None):
+        """
+        生成带渠道信息的apk, signing block前的数据和Central Directory以流式
+        拷贝的方式写入, 内存占用与apk大小无关
+        :param target_file: 生成的渠道包路径
+        :param channel_id: 渠道标示id, 字节数组
+        :param channel_str: 渠道信息字符串
+        :param stats: 拷贝统计, 为None时累计到copy_stats
+        :param clone: 是否以reflink方式共享signing block前的数据块,
+        不支持时回退到普通拷贝
+        :param slot_size: 不为None时为渠道预留固定长度的空间
+        :return: 返回写入的ChannelTail
+        """
+        tail = self.build_channel_tail(channel_id, channel_str, slot_size)
+        if stats is None:
+            stats = self._copy_stats
+
+        src_fd = self._apk.fileno()
+        with open(target_file, 'wb') as new_apk:
+            dst_fd = new_apk.fileno()
+            # 写signing block前置数据
+            copy_func = FileTools.clone_range if clone \
+                else FileTools.copy_range
+            copy_func(src_fd, dst_fd, 0, tail.sign_block_offset, stats)
+
+            # 写new signing block
+            FileTools.write_fully(dst_fd, tail.sign_block, stats)
+
+            # 写 Central Directory
+            FileTools.copy_range(src_fd, dst_fd, tail.central_dir_offset,
+                                 tail.central_dir_size, stats)
+
+            # 写修改了Central Directory偏移量的eocd
+            FileTools.write_fully(dst_fd, tail.eocd, stats)
+        return tail
+
+    def save_as_channel_file(self, target_file, channel_id, channel_str,
+                             stats=None, clone=False):
+        """
+        生成带渠道信息的apk, 参数同write_channel_file
+        :return: 成功返回True
+        """
+        self.write_channel_file(target_file, channel_id, channel_str, stats,
+                                clone)
+        return True
 
     def release(self):
         """
@@ -380,8 +1014,987 @@ class ApkChannelTool(object):
         self._apk.close()
 
 
+def find_channel_slot(file_name,
+                      channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
+    """
+    查找以预留空间方式写入的渠道数据在文件中的位置, 只读取文件尾部; 由同一模板
+    拷贝出的文件位置相同, 只需查找一次
+    :param file_name: 带预留空间的渠道包
+    :param channel_id: 渠道标示id, 字节数组
+    :return: 返回ChannelSlot
+    """
+    fd = os.open(file_name, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        layout = _parse_apk_layout(fd)
+    finally:
+        os.close(fd)
+
+    entry = layout.sign_block_index.get(bytes(channel_id))
+    if entry is None:
+        raise SignatureNotFoundError('channel info not found in %s'
+                                     % file_name)
+
+    sign_block = layout.sign_block
+    entry_start = entry[0] - 8 - _SIGN_EXTRA_ID_LENGTH
+    padding_start = entry[0] + entry[1]
+    padding_id = bytes(reversed(_APK_VERITY_PADDING_BLOCK_ID))
+    if padding_start + 12 > len(sign_block) - 24 \
+            or sign_block[padding_start + 8: padding_start + 12] != padding_id:
+        raise SignatureNotFoundError('channel slot not found in %s'
+                                     % file_name)
+
+    padding_len = struct.unpack_from('<Q', sign_block, padding_start)[0]
+    return ChannelSlot(layout.central_dir_offset - len(sign_block)
+                       + entry_start,
+                       padding_start + 8 + padding_len - entry_start,
+                       bytes(channel_id))
+
+
+def stamp_channel_slot(file_name, slot, channel_str):
+    """
+    原地修改渠道包预留空间中的渠道信息, 只写入slot.size字节, 不改变文件大小,
+    Central Directory和eocd保持不变
+    :param file_name: 由模板拷贝出的渠道包
+    :param slot: find_channel_slot返回的ChannelSlot
+    :param channel_str: 新的渠道信息字符串
+    :return:
+    """
+    data = _create_channel_slot_data(slot.channel_id, channel_str, slot.size)
+    fd = os.open(file_name, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        if hasattr(os, 'pwrite'):
+            written = os.pwrite(fd, data, slot.offset)
+        else:
+            os.lseek(fd, slot.offset, os.SEEK_SET)
+            written = os.write(fd, data)
+        if written != len(data):
+            raise IOError('write channel slot to %s fail' % file_name)
+    finally:
+        os.close(fd)
+
+
+def read_channel_patch(patch_file):
+    """
+    读取渠道补丁文件
+    :param patch_file: 补丁文件路径
+    :return: 返回基础apk大小, 基础apk sha256及ChannelTail
+    """
+    with open(patch_file, 'rb') as f:
+        header = f.read(_CHANNEL_PATCH_HEADER.size)
+        if len(header) != _CHANNEL_PATCH_HEADER.size:
+            raise ChannelPatchError('%s is not a channel patch' % patch_file)
+        magic, base_size, base_digest, sign_block_offset, central_dir_offset, \
+            central_dir_size, sign_block_len, eocd_len = \
+            _CHANNEL_PATCH_HEADER.unpack(header)
+        if magic != _CHANNEL_PATCH_MAGIC:
+            raise ChannelPatchError('%s is not a channel patch' % patch_file)
+
+        sign_block = f.read(sign_block_len)
+        eocd = f.read(eocd_len)
+        if len(sign_block) != sign_block_len or len(eocd) != eocd_len:
+            raise ChannelPatchError('%s is truncated' % patch_file)
+    return base_size, base_digest, ChannelTail(
+        sign_block_offset, sign_block, central_dir_offset, central_dir_size,
+        eocd)
+
+
+def apply_channel_patch(base_file, patch_file, target_file, stats=None,
+                        verify_base=False):
+    """
+    将渠道补丁应用到基础apk, 流式生成完整的渠道包
+    :param base_file: 生成补丁时使用的源apk
+    :param patch_file: 补丁文件路径
+    :param target_file: 生成的渠道包路径
+    :param stats: 拷贝统计, 可为None
+    :param verify_base: 是否校验基础apk的sha256, 需要完整读取基础apk
+    :return: 返回ChannelTail
+    """
+    base_size, base_digest, tail = read_channel_patch(patch_file)
+
+    with open(base_file, 'rb') as base:
+        src_fd = base.fileno()
+        if os.fstat(src_fd).st_size != base_size:
+            raise ChannelPatchError('base apk size mismatch: %s' % base_file)
+        if verify_base:
+            hash_obj = hashlib.sha256()
+            for data in FileTools.iter_range(src_fd, 0, base_size):
+                hash_obj.update(data)
+            if hash_obj.digest() != base_digest:
+                raise ChannelPatchError('base apk sha256 mismatch: %s'
+                                        % base_file)
+
+        with open(target_file, 'wb') as new_apk:
+            dst_fd = new_apk.fileno()
+            FileTools.copy_range(src_fd, dst_fd, 0, tail.sign_block_offset,
+                                 stats)
+            FileTools.write_fully(dst_fd, tail.sign_block, stats)
+            FileTools.copy_range(src_fd, dst_fd, tail.central_dir_offset,
+                                 tail.central_dir_size, stats)
+            FileTools.write_fully(dst_fd, tail.eocd, stats)
+    return tail
+
+
+def _verify_channel_tail(tail, channel_id, channel_str):
+    """
+    校验渠道包尾部数据: signing block结构完整, 含有对应的渠道信息, 且eocd中的
+    Central Directory偏移量指向新signing block之后, 校验失败时抛出
+    SignatureNotFoundError
+    :param tail: ChannelTail
+    :param channel_id: 渠道标示id, 字节数组
+    :param channel_str: 渠道信息字符串
+    :return:
+    """
+    sign_block = tail.sign_block
+    block_size = len(sign_block)
+    if block_size < 32 \
+            or sign_block[block_size - 16:] != _APK_SIGN_BLOCK_MAGIC_IN_FILE \
+            or struct.unpack_from('<Q', sign_block)[0] != block_size - 8 \
+            or struct.unpack_from('<Q', sign_block, block_size - 24)[0] \
+            != block_size - 8:
+        raise SignatureNotFoundError('new signing block is invalid')
+
+    central_dir_size, central_dir_offset = _get_trailer_central_dir(
+        tail.eocd)
+    if central_dir_offset != tail.sign_block_offset + block_size \
+            or central_dir_size != tail.central_dir_size:
+        raise SignatureNotFoundError('central directory offset in eocd is'
+                                     + ' invalid: ' + str(central_dir_offset))
+
+    entry = _index_sign_block(sign_block).get(bytes(channel_id))
+    if entry is None or sign_block[entry[0]: entry[0] + entry[1]] \
+            != channel_str.encode('utf-8'):
+        raise SignatureNotFoundError('channel info not found in new signing'
+                                     + ' block')
+
+
+def _write_channel_file(apk_tools, target_file, channel_id, channel,
+                        clone=False, digest=None, sha256=False,
+                        slot_size=None):
+    """
+    生成单个渠道包, 并用刚写入的尾部数据校验渠道信息, 无需重新打开渠道包
+    :return: 返回ChannelResult, 失败时error为对应异常
+    """
+    try:
+        tail = apk_tools.write_channel_file(target_file, channel_id, channel,
+                                            clone=clone, slot_size=slot_size)
+        _verify_channel_tail(tail, channel_id, channel)
+        return ChannelResult(channel, target_file, None,
+                             apk_tools.tail_digest(tail, digest)
+                             if digest else None, tail.file_size,
+                             apk_tools.file_digest(tail) if sha256 else None)
+    except (Exception, SignatureNotFoundError) as e:
+        return ChannelResult(channel, target_file, e, None, None, None)
+
+
+def write_channel_manifest(results, manifest_file):
+    """
+    将生成成功的渠道包信息(文件名, 大小, sha256, 渠道)写入json格式的清单文件
+    :param results: ChannelResult列表, 需计算sha256
+    :param manifest_file: 清单文件路径
+    :return:
+    """
+    files = [collections.OrderedDict([
+        ('name', os.path.basename(x.target_file)), ('size', x.size),
+        ('sha256', x.sha256), ('channel', x.channel)])
+        for x in results if x.success]
+    with open(manifest_file, 'wt', encoding='UTF-8') as f:
+        json.dump({'files': files}, f, ensure_ascii=False, indent=2)
+
+
+def iter_channels(lines):
+    """
+    校验渠道并去重, 渠道需可作为文件名的一部分
+    :param lines: (行号, 渠道)的可迭代对象, 如FileTools.iter_config_file
+    :return: 按首次出现顺序返回渠道的生成器, 渠道无效时抛出ValueError
+    """
+    seen = set()
+    for line_no, channel in lines:
+        if '/' in channel or os.sep in channel or '\0' in channel \
+                or channel in ('.', '..'):
+            raise ValueError('invalid channel at line %d: %s'
+                             % (line_no, channel))
+        if channel not in seen:
+            seen.add(channel)
+            yield channel
+
+
+def read_channels(file_name):
+    """
+    读取渠道文件, 校验并去重
+    :param file_name: 渠道文件, 一行为一个渠道, 以'#'开头的行为注释
+    :return: 返回渠道列表
+    """
+    return list(iter_channels(FileTools.iter_config_file(file_name)))
+
+
+class ChannelCheckpoint(object):
+    """
+    记录已生成并校验通过的渠道包, 以json lines格式追加写入; 第一行记录源apk的
+    sha256, 源apk变化后之前的记录全部失效. 中断时写了一半的记录及其之后的内容
+    被丢弃, 之前的记录仍然有效
+    """
+
+    def __init__(self, file_name, source_digest):
+        self._file_name = file_name
+        self._source_digest = source_digest
+        self._lock = threading.Lock()
+        self._entries = {}
+
+        valid_size = self._load() if os.path.isfile(file_name) else None
+        if valid_size is None:
+            self._file = open(file_name, 'wt', encoding='UTF-8')
+            self._write_line({'source_sha256': source_digest})
+        else:
+            # 截掉无效的内容, 之后追加的记录从完整的行开始
+            os.truncate(file_name, valid_size)
+            self._file = open(file_name, 'at', encoding='UTF-8')
+
+    def _load(self):
+        """
+        读取记录文件
+        :return: 返回有效内容的长度, 源apk不同或文件头无效时返回None
+        """
+        with open(self._file_name, 'rb') as f:
+            header = f.readline()
+            try:
+                if not header.endswith(b'\n') or json.loads(
+                        header.decode('UTF-8')).get('source_sha256') \
+                        != self._source_digest:
+                    return None
+            except (ValueError, AttributeError) as e:
+                logging.info("ignore checkpoint %s: %s"
+                             % (self._file_name, e))
+                return None
+
+            valid_size = len(header)
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('incomplete line')
+                    entry = json.loads(line.decode('UTF-8'))
+                    # get_result需要的字段缺失或类型错误时同样视为无效行
+                    if not isinstance(entry['file'], str) \
+                            or not isinstance(entry['size'], int):
+                        raise TypeError('invalid entry: %s' % line)
+                    self._entries[entry['channel']] = entry
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.info("checkpoint %s truncated at %d: %s"
+                                 % (self._file_name, valid_size, e))
+                    break
+                valid_size += len(line)
+            return valid_size
+
+    def _write_line(self, data):
+        self._file.write(json.dumps(data, ensure_ascii=False))
+        self._file.write('\n')
+        self._file.flush()
+
+    def get_result(self, channel, target_file,
+                   channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
+        """
+        渠道包已生成且仍然有效时返回对应的ChannelResult, 只读取渠道包尾部校验
+        文件大小和渠道信息
+        :return: 返回ChannelResult, 需要重新生成时返回None
+        """
+        entry = self._entries.get(channel)
+        if entry is None or entry['file'] != os.path.basename(target_file):
+            return None
+        audit = audit_apk(target_file, channel_id)
+        if audit.size != entry['size'] or audit.channel != channel:
+            return None
+        return ChannelResult(channel, target_file, None, None, entry['size'],
+                             entry.get('sha256'))
+
+    def record(self, result):
+        """
+        记录生成成功的渠道包
+        :param result: ChannelResult
+        :return:
+        """
+        entry = collections.OrderedDict([
+            ('channel', result.channel),
+            ('file', os.path.basename(result.target_file)),
+            ('size', result.size), ('sha256', result.sha256)])
+        with self._lock:
+            self._entries[result.channel] = entry
+            self._write_line(entry)
+
+    def close(self):
+        self._file.close()
+
+
+def _map_jobs(func, items, jobs):
+    """
+    在线程池中执行func, 返回与items顺序一致的结果列表
+    """
+    if jobs <= 1:
+        return [func(x) for x in items]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(func, items))
+
+
+def generate_channel_files(source_apk, channels, target_dir,
+                           name_format='app-%s.apk', jobs=1,
+                           channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID,
+                           clone=False, digest=None, manifest=None,
+                           slot_size=None, checkpoint=None):
+    """
+    批量生成渠道包, 源apk只解析一次, 解析结果由线程池中的各个写线程共享
+    :param source_apk: 使用scheme v2签名的apk
+    :param channels: 渠道列表
+    :param target_dir: 渠道包保存目录
+    :param name_format: 渠道包文件名格式
+    :param jobs: 并发写渠道包的线程数
+    :param channel_id: 渠道标示id, 字节数组
+    :param clone: 是否以reflink方式共享signing block前的数据块
+    :param digest: 计算写入尾部数据校验值的算法, crc32或hashlib支持的算法名,
+    为None时不计算
+    :param manifest: 清单文件路径, 不为None时计算每个渠道包的sha256并写入
+    清单, 所有渠道包共享signing block之前数据的hash
+    :param slot_size: 不为None时为渠道预留固定长度的空间, 生成的渠道包可作为
+    模板, 通过stamp_channel_slot原地修改渠道
+    :param checkpoint: 断点记录文件路径, 不为None时跳过源apk相同且已生成并
+    校验通过的渠道包
+    :return: 返回与channels顺序一致的ChannelResult列表
+    """
+    apk_tools = ApkChannelTool(source_apk)
+    ckpt = None
+    try:
+        if not apk_tools.has_v2_signature():
+            raise SignatureNotFoundError('%s is not a apk signed by scheme v2'
+                                         % source_apk)
+        if checkpoint is not None:
+            ckpt = ChannelCheckpoint(checkpoint,
+                                     apk_tools.source_digest().hex())
+
+        def write(channel):
+            target_file = os.path.join(target_dir, name_format % channel)
+            if ckpt is not None:
+                result = ckpt.get_result(channel, target_file, channel_id)
+                if result is not None and (manifest is None or result.sha256):
+                    logging.debug("skip %s, already generated" % channel)
+                    return result
+
+            result = _write_channel_file(
+                apk_tools, target_file, channel_id, channel, clone, digest,
+                manifest is not None, slot_size)
+            if ckpt is not None and result.success:
+                ckpt.record(result)
+            return result
+
+        results = _map_jobs(write, channels, jobs)
+        if manifest is not None:
+            write_channel_manifest(results, manifest)
+        return results
+    finally:
+        if ckpt is not None:
+            ckpt.close()
+        apk_tools.release()
+
+
+def _write_channel_patch(apk_tools, patch_file, channel_id, channel,
+                         base_digest, slot_size=None):
+    """
+    生成单个渠道补丁并校验渠道信息
+    :return: 返回ChannelResult, 失败时error为对应异常
+    """
+    try:
+        tail = apk_tools.write_channel_patch(patch_file, channel_id, channel,
+                                             base_digest, slot_size)
+        _verify_channel_tail(tail, channel_id, channel)
+        return ChannelResult(channel, patch_file, None, None,
+                             os.path.getsize(patch_file), None)
+    except (Exception, SignatureNotFoundError) as e:
+        return ChannelResult(channel, patch_file, e, None, None, None)
+
+
+def generate_channel_patches(source_apk, channels, target_dir,
+                             name_format='app-%s.apk', jobs=1,
+                             channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID,
+                             slot_size=None, clone=False):
+    """
+    生成一个基础apk和每个渠道对应的补丁文件(<渠道包文件名>.patch), 基础apk为
+    源apk的拷贝, 通过apply_channel_patch可还原出完整的渠道包
+    :param source_apk: 使用scheme v2签名的apk
+    :param channels: 渠道列表
+    :param target_dir: 基础apk和补丁文件保存目录
+    :param name_format: 渠道包文件名格式
+    :param jobs: 并发写补丁的线程数
+    :param channel_id: 渠道标示id, 字节数组
+    :param slot_size: 不为None时为渠道预留固定长度的空间
+    :param clone: 是否以reflink方式拷贝基础apk
+    :return: 返回基础apk路径和与channels顺序一致的ChannelResult列表
+    """
+    apk_tools = ApkChannelTool(source_apk)
+    try:
+        if not apk_tools.has_v2_signature():
+            raise SignatureNotFoundError('%s is not a apk signed by scheme v2'
+                                         % source_apk)
+
+        base_file = os.path.join(target_dir, os.path.basename(source_apk))
+        if not os.path.exists(base_file) \
+                or not os.path.samefile(base_file, source_apk):
+            apk_tools.copy_source_file(base_file, clone=clone)
+        base_digest = apk_tools.source_digest()
+
+        def write(channel):
+            return _write_channel_patch(
+                apk_tools,
+                os.path.join(target_dir, name_format % channel + '.patch'),
+                channel_id, channel, base_digest, slot_size)
+
+        return base_file, _map_jobs(write, channels, jobs)
+    finally:
+        apk_tools.release()
+
+
+class MatrixReport(collections.namedtuple('MatrixReport',
+                                          ['results', 'bytes_written',
+                                           'elapsed'])):
+    """
+    批量任务的执行结果, results为源apk到ChannelResult列表的有序字典
+    """
+
+    @property
+    def channel_count(self):
+        return sum(len(x) for x in self.results.values())
+
+    @property
+    def channels_per_second(self):
+        return self.channel_count / max(self.elapsed, 1e-6)
+
+    @property
+    def mb_per_second(self):
+        return self.bytes_written / 1024.0 / 1024.0 / max(self.elapsed, 1e-6)
+
+
+def run_channel_matrix(spec, base_dir='.'):
+    """
+    执行多个源apk x 多个渠道的批量任务, 每个源apk只解析一次. 每个目标设备有
+    独立的任务队列和writers_per_device个写线程, 不同设备同时写入; 同一设备上
+    按源apk依次执行, 使其signing block之前的数据保持在page cache中
+    :param spec: 任务描述字典:
+    {
+        "sources": [{"apk": 源apk, "target_dir": 保存目录, "format": 文件名格式}],
+        "channels": 渠道文件路径或渠道列表,
+        "output": "apk"(完整渠道包) 或 "delta"(基础apk + 补丁),
+        "writers_per_device": 每个设备同时写入的线程数, 默认为2,
+        "jobs": 所有设备同时写入的总数上限, 默认为writers_per_device x 设备数,
+        "clone": 是否使用reflink, "slot_size": 渠道预留空间,
+        "manifest": 清单文件名, 写入每个源apk的保存目录
+    }
+    :param base_dir: spec中相对路径的起始目录
+    :return: 返回MatrixReport
+    """
+    channels = spec['channels']
+    if isinstance(channels, str):
+        channels = read_channels(os.path.join(base_dir, channels))
+    else:
+        channels = list(iter_channels(enumerate(channels, 1)))
+
+    output = spec.get('output', 'apk')
+    if output not in ('apk', 'delta'):
+        raise ValueError('unsupported output: %s' % output)
+    writers_per_device = int(spec.get('writers_per_device', 2))
+    clone = bool(spec.get('clone', False))
+    slot_size = spec.get('slot_size')
+    manifest = spec.get('manifest') if output == 'apk' else None
+
+    start_time = time.time()
+    sources = []
+    devices = []
+    bytes_written = 0
+    try:
+        for entry in spec['sources']:
+            source_apk = os.path.join(base_dir, entry['apk'])
+            target_dir = os.path.join(base_dir, entry.get('target_dir', '.'))
+            name_format = entry.get('format', 'app-%s.apk')
+            # 文件名格式无效时抛出TypeError
+            name_format % 'test'
+
+            apk_tools = ApkChannelTool(source_apk)
+            sources.append((source_apk, apk_tools, target_dir, name_format))
+            if not apk_tools.has_v2_signature():
+                raise SignatureNotFoundError('%s is not a apk signed by '
+                                             'scheme v2' % source_apk)
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            device = os.stat(target_dir).st_dev
+            if device not in devices:
+                devices.append(device)
+
+        # 每个设备一个任务队列, 队列中按源apk依次排列
+        tasks = []
+        device_queues = collections.OrderedDict(
+            (x, collections.deque()) for x in devices)
+        for source_apk, apk_tools, target_dir, name_format in sources:
+            queue = device_queues[os.stat(target_dir).st_dev]
+            base_digest = None
+            if output == 'delta':
+                base_file = os.path.join(target_dir,
+                                         os.path.basename(source_apk))
+                if not os.path.exists(base_file) \
+                        or not os.path.samefile(base_file, source_apk):
+                    apk_tools.copy_source_file(base_file, clone=clone)
+                    bytes_written += apk_tools.layout.file_size
+                base_digest = apk_tools.source_digest()
+            for channel in channels:
+                queue.append(len(tasks))
+                tasks.append((source_apk, apk_tools,
+                              os.path.join(target_dir, name_format % channel),
+                              channel, base_digest))
+
+        jobs = int(spec.get('jobs', writers_per_device * len(devices)))
+        job_semaphore = threading.BoundedSemaphore(max(jobs, 1))
+        task_results = [None] * len(tasks)
+
+        def run(task):
+            source_apk, apk_tools, target_file, channel, base_digest = task
+            with job_semaphore:
+                if output == 'delta':
+                    return _write_channel_patch(
+                        apk_tools, target_file + '.patch',
+                        _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID, channel,
+                        base_digest, slot_size)
+                return _write_channel_file(
+                    apk_tools, target_file,
+                    _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID, channel, clone,
+                    sha256=manifest is not None, slot_size=slot_size)
+
+        def run_device(queue):
+            # 同一设备的写线程共享队列, 不会等待其他设备的任务
+            while True:
+                try:
+                    index = queue.popleft()
+                except IndexError:
+                    return
+                task_results[index] = run(tasks[index])
+
+        workers = min(max(writers_per_device, 1), max(jobs, 1))
+        with ThreadPoolExecutor(max_workers=workers * len(devices)) \
+                as executor:
+            futures = [executor.submit(run_device, x)
+                       for x in device_queues.values() for _ in range(workers)]
+            for x in futures:
+                x.result()
+
+        results = collections.OrderedDict((x[0], []) for x in sources)
+        for task, result in zip(tasks, task_results):
+            results[task[0]].append(result)
+            if result.success:
+                bytes_written += result.size
+        if manifest is not None:
+            for source_apk, apk_tools, target_dir, name_format in sources:
+                write_channel_manifest(results[source_apk],
+                                       os.path.join(target_dir, manifest))
+        return MatrixReport(results, bytes_written, time.time() - start_time)
+    finally:
+        for x in sources:
+            x[1].release()
+
+
+def audit_apk(file_name, channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
+    """
+    检查apk的v2签名和渠道信息, 只读取文件尾部的eocd和signing block
+    :param file_name: apk文件
+    :param channel_id: 渠道标示id, 字节数组
+    :return: 返回AuditResult
+    """
+    try:
+        fd = os.open(file_name, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            layout = _parse_apk_layout(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        return AuditResult(file_name, None, False, None, str(e))
+
+    entry = layout.sign_block_index.get(bytes(channel_id))
+    channel = None
+    if entry is not None:
+        offset, length = entry
+        channel = bytes(memoryview(layout.sign_block)[offset: offset + length])\
+            .decode('utf-8', errors='replace')
+    return AuditResult(file_name, layout.file_size,
+                       bytes(_APK_SIGNATURE_SCHEME_V2_BLOCK_ID)
+                       in layout.sign_block_index, channel, None)
+
+
+def scan_apk_files(directory):
+    """
+    遍历目录树, 返回其中所有的apk文件
+    :param directory: 起始目录
+    :return: apk文件路径的生成器
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.apk'):
+                yield os.path.join(root, name)
+
+
+def audit_apk_files(files, jobs=1,
+                    channel_id=_APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
+    """
+    并发检查多个apk的渠道信息, 结果按输入顺序逐个返回
+    :param files: apk文件路径的可迭代对象, 可以是生成器
+    :param jobs: 并发线程数
+    :param channel_id: 渠道标示id, 字节数组
+    :return: AuditResult的生成器
+    """
+    if jobs <= 1:
+        for x in files:
+            yield audit_apk(x, channel_id)
+        return
+
+    # 限制未完成任务的数量, 使结果可以边遍历边输出
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for x in files:
+            pending.append(executor.submit(audit_apk, x, channel_id))
+            if len(pending) >= jobs * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_audit_results(results, output, output_format='jsonl'):
+    """
+    将检查结果以json lines或csv格式逐行写入output
+    :param results: AuditResult的可迭代对象
+    :param output: 文本输出流
+    :param output_format: jsonl 或 csv
+    :return: 返回写入的结果数
+    """
+    count = 0
+    if output_format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(AuditResult._fields)
+        for x in results:
+            writer.writerow(x)
+            count += 1
+    elif output_format == 'jsonl':
+        for x in results:
+            output.write(json.dumps(x._asdict(), ensure_ascii=False))
+            output.write('\n')
+            count += 1
+    else:
+        raise ValueError('unsupported output format: %s' % output_format)
+    return count
+
+
 class ChannelToolsTest(unittest.TestCase):
 
+    @staticmethod
+    def _create_v2_apk(file_name, comment=b'', zip64=False):
+        """
+        生成带有v2签名块结构的测试apk
+        :param file_name: 生成的apk路径
+        :param comment: zip注释
+        :param zip64: 是否使用zip64 eocd record和locator
+        :return:
+        """
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as z:
+            z.writestr('AndroidManifest.xml', os.urandom(4096))
+            z.writestr('classes.dex', os.urandom(3 * _COPY_CHUNK_SIZE + 17))
+            z.comment = comment
+        data = bytearray(buf.getvalue())
+
+        v2_id = bytearray(_APK_SIGNATURE_SCHEME_V2_BLOCK_ID)
+        v2_id.reverse()
+        pairs = struct.pack('<Q', 4 + 64) + v2_id + os.urandom(64) \
+            + struct.pack('<Q', 4 + 32) + b'werB' + bytes(32)
+        block_size = struct.pack('<Q', len(pairs) + 24)
+        magic = bytearray(_APK_SIGN_BLOCK_MAGIC)
+        magic.reverse()
+        sign_block = block_size + pairs + block_size + magic
+
+        eocd_offset = len(data) - _ZIP_EOCD_REC_MIN_SIZE - len(comment)
+        central_dir_offset = struct.unpack_from(
+            '<I', data, eocd_offset + _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET)[0]
+        struct.pack_into('<I', data,
+                         eocd_offset + _ZIP_EOCD_CENTRAL_DIR_OFFSET_FIELD_OFFSET,
+                         central_dir_offset + len(sign_block))
+        data[central_dir_offset:central_dir_offset] = sign_block
+        if zip64:
+            eocd_offset += len(sign_block)
+            entries, central_dir_size = struct.unpack_from(
+                '<HI', data, eocd_offset + 10)
+            record = struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                                 entries, entries, central_dir_size,
+                                 central_dir_offset + len(sign_block))
+            locator = struct.pack('<IIQI', 0x07064b50, 0, eocd_offset, 1)
+            struct.pack_into('<I', data, eocd_offset + 16, 0xffffffff)
+            data[eocd_offset:eocd_offset] = record + locator
+        with open(file_name, 'wb') as f:
+            f.write(data)
+        return central_dir_offset
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_save_channel_file_streaming(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        target = os.path.join(self._tmp_dir.name, 'app-official.apk')
+        self._create_v2_apk(source, b'comment')
+
+        tools = ApkChannelTool(source)
+        self.assertTrue(tools.has_v2_signature())
+        tools.save_as_channel_file(target, _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID,
+                                   'official')
+        tools.release()
+
+        self.assertEqual(os.path.getsize(source) + 12 + len('official'),
+                         tools.copy_stats.bytes_copied)
+        self.assertGreater(tools.copy_stats.syscalls, 0)
+
+        with zipfile.ZipFile(target) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(b'comment', z.comment)
+
+        new_tools = ApkChannelTool(target)
+        self.assertTrue(new_tools.has_extra_info_in_signing_block(
+            _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID))
+        self.assertEqual(b'official', new_tools.get_channel())
+        self.assertEqual(64, len(new_tools.get_extra_info(
+            _APK_SIGNATURE_SCHEME_V2_BLOCK_ID)))
+        self.assertEqual(bytes(32), new_tools.get_extra_info(b'Brew'))
+        self.assertIsNone(new_tools.get_extra_info(b'none'))
+        new_tools.release()
+
+    def test_parse_layout_with_large_comment(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        comment = (b'PK\x05\x06' + b'\x00' * 28) * 1800
+        self._create_v2_apk(source, comment)
+
+        tools = ApkChannelTool(source)
+        layout = tools.layout
+        tools.release()
+
+        self.assertEqual(layout.file_size - _ZIP_EOCD_REC_MIN_SIZE
+                         - len(comment), layout.eocd_offset)
+        self.assertEqual(_ZIP_EOCD_REC_MIN_SIZE + len(comment),
+                         len(layout.eocd))
+        self.assertTrue(tools.has_v2_signature())
+
+    def test_zip64_channel_file(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        target = os.path.join(self._tmp_dir.name, 'app-zip64.apk')
+        self._create_v2_apk(source, b'comment', zip64=True)
+
+        tools = ApkChannelTool(source)
+        self.assertTrue(tools.has_v2_signature())
+        tools.save_as_channel_file(target, _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID,
+                                   'zip64')
+        tools.release()
+
+        with zipfile.ZipFile(target) as z:
+            self.assertIsNone(z.testzip())
+        self.assertEqual('zip64', audit_apk(target).channel)
+
+        eocd = bytearray(_ZIP_EOCD_REC_MIN_SIZE)
+        struct.pack_into('<IHHHHII', eocd, 0, 0x06054b50, 0, 0, 3, 3, 100,
+                         1000)
+        trailer = _patch_eocd_central_dir_offset(eocd, 5 << 30)
+        self.assertEqual((100, 5 << 30), _get_trailer_central_dir(trailer))
+        self.assertEqual(((5 << 30) + 100, 0xffffffff), struct.unpack_from(
+            '<QI', trailer, 56 + 8)[:1] + struct.unpack_from(
+            '<I', trailer, 56 + 20 + 16))
+
+    def test_save_channel_file_clone(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        copied = os.path.join(self._tmp_dir.name, 'copied.apk')
+        cloned = os.path.join(self._tmp_dir.name, 'cloned.apk')
+        self._create_v2_apk(source)
+
+        tools = ApkChannelTool(source)
+        tools.save_as_channel_file(copied, _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID,
+                                   'official')
+        stats = CopyStats()
+        tools.save_as_channel_file(cloned, _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID,
+                                   'official', stats=stats, clone=True)
+        tools.release()
+
+        with open(copied, 'rb') as f1, open(cloned, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+        self.assertEqual(os.path.getsize(cloned),
+                         stats.bytes_copied + stats.bytes_cloned)
+
+    def test_generate_channel_files_parallel(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        sign_block_offset = self._create_v2_apk(source)
+        channels = ['c%d' % x for x in range(8)] + ['missing/bad']
+
+        results = generate_channel_files(source, channels, self._tmp_dir.name,
+                                         jobs=4, digest='sha256')
+
+        self.assertEqual(channels, [x.channel for x in results])
+        self.assertTrue(all(x.success for x in results[:-1]))
+        self.assertFalse(results[-1].success)
+        target = os.path.join(self._tmp_dir.name, 'app-c7.apk')
+        with open(target, 'rb') as f:
+            f.seek(sign_block_offset)
+            self.assertEqual(hashlib.sha256(f.read()).hexdigest(),
+                             results[7].digest)
+
+    def test_channel_manifest(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        manifest = os.path.join(self._tmp_dir.name, 'manifest.json')
+        self._create_v2_apk(source)
+
+        results = generate_channel_files(source, ['a', 'b'],
+                                         self._tmp_dir.name, jobs=2,
+                                         manifest=manifest)
+        with open(manifest, 'rt', encoding='UTF-8') as f:
+            files = json.load(f)['files']
+
+        self.assertEqual(['app-a.apk', 'app-b.apk'], [x['name'] for x in files])
+        for result, entry in zip(results, files):
+            with open(result.target_file, 'rb') as f:
+                data = f.read()
+            self.assertEqual(hashlib.sha256(data).hexdigest(), entry['sha256'])
+            self.assertEqual(len(data), entry['size'])
+            self.assertEqual(result.channel, entry['channel'])
+
+    def test_stamp_channel_slot(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        copied = os.path.join(self._tmp_dir.name, 'copied.apk')
+        self._create_v2_apk(source)
+
+        result = generate_channel_files(source, ['template'],
+                                        self._tmp_dir.name, slot_size=64)[0]
+        self.assertTrue(result.success)
+        slot = find_channel_slot(result.target_file)
+        self.assertEqual(64, slot.size)
+
+        shutil.copyfile(result.target_file, copied)
+        stamp_channel_slot(copied, slot, 'channel-after-stamp')
+
+        self.assertEqual(os.path.getsize(result.target_file),
+                         os.path.getsize(copied))
+        self.assertEqual('channel-after-stamp', audit_apk(copied).channel)
+        with zipfile.ZipFile(copied) as z:
+            self.assertIsNone(z.testzip())
+        with self.assertRaises(SignatureNotFoundError):
+            stamp_channel_slot(copied, slot, 'x' * 41)
+
+    def test_channel_patch(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        target_dir = os.path.join(self._tmp_dir.name, 'delta')
+        os.mkdir(target_dir)
+        self._create_v2_apk(source)
+
+        base_file, results = generate_channel_patches(source, ['a', 'b'],
+                                                      target_dir, jobs=2)
+        self.assertTrue(all(x.success for x in results))
+        self.assertLess(results[0].size, 1024)
+
+        full = generate_channel_files(source, ['b'], self._tmp_dir.name)[0]
+        patched = os.path.join(self._tmp_dir.name, 'patched.apk')
+        apply_channel_patch(base_file, results[1].target_file, patched,
+                            verify_base=True)
+        with open(full.target_file, 'rb') as f1, open(patched, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        with open(base_file, 'ab') as f:
+            f.write(b'changed')
+        with self.assertRaises(ChannelPatchError):
+            apply_channel_patch(base_file, results[1].target_file, patched)
+
+    def test_read_channels(self):
+        channels_file = os.path.join(self._tmp_dir.name, 'channels.txt')
+        with open(channels_file, 'wt', encoding='UTF-8') as f:
+            f.write('# comment\na\n\n b \na\nc\n')
+        self.assertEqual(['a', 'b', 'c'], read_channels(channels_file))
+
+        with open(channels_file, 'at', encoding='UTF-8') as f:
+            f.write('../evil\n')
+        with self.assertRaises(ValueError):
+            read_channels(channels_file)
+
+    def test_generate_with_checkpoint(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        checkpoint = os.path.join(self._tmp_dir.name, 'checkpoint.jsonl')
+        self._create_v2_apk(source)
+
+        generate_channel_files(source, ['a', 'b'], self._tmp_dir.name,
+                               checkpoint=checkpoint)
+        target_a = os.path.join(self._tmp_dir.name, 'app-a.apk')
+        target_b = os.path.join(self._tmp_dir.name, 'app-b.apk')
+        mtime_a = os.stat(target_a).st_mtime_ns
+        with open(target_b, 'r+b') as f:
+            f.truncate(100)
+
+        results = generate_channel_files(source, ['a', 'b', 'c'],
+                                         self._tmp_dir.name,
+                                         checkpoint=checkpoint)
+        self.assertTrue(all(x.success for x in results))
+        self.assertEqual(mtime_a, os.stat(target_a).st_mtime_ns)
+        self.assertEqual('b', audit_apk(target_b).channel)
+
+        # 中断时写了一半的记录不影响之前的记录
+        mtimes = [os.stat(os.path.join(self._tmp_dir.name, 'app-%s.apk' % x))
+                  .st_mtime_ns for x in 'abc']
+        with open(checkpoint, 'at', encoding='UTF-8') as f:
+            f.write('{"channel": "c"}\n{"channel": "d", "fi')
+        generate_channel_files(source, ['a', 'b', 'c', 'd'],
+                               self._tmp_dir.name, checkpoint=checkpoint)
+        self.assertEqual(mtimes, [os.stat(os.path.join(
+            self._tmp_dir.name, 'app-%s.apk' % x)).st_mtime_ns for x in 'abc'])
+        with open(checkpoint, 'rt', encoding='UTF-8') as f:
+            entries = [json.loads(x) for x in f]
+        self.assertEqual('d', entries[-1]['channel'])
+
+    def test_run_channel_matrix(self):
+        for name in ('arm64', 'x86_64'):
+            self._create_v2_apk(os.path.join(self._tmp_dir.name,
+                                             '%s.apk' % name))
+        spec = {
+            'sources': [{'apk': '%s.apk' % x, 'target_dir': 'out/%s' % x,
+                         'format': '%s-%%s.apk' % x}
+                        for x in ('arm64', 'x86_64')],
+            'channels': ['a', 'b', 'c', 'a'],
+            'writers_per_device': 2,
+            'manifest': 'manifest.json'
+        }
+
+        report = run_channel_matrix(spec, self._tmp_dir.name)
+
+        self.assertEqual(6, report.channel_count)
+        self.assertEqual(['a', 'b', 'c'], [
+            x.channel for x in report.results[
+                os.path.join(self._tmp_dir.name, 'x86_64.apk')]])
+        self.assertTrue(all(x.success for y in report.results.values()
+                            for x in y))
+        self.assertGreater(report.bytes_written, 0)
+        self.assertEqual('c', audit_apk(os.path.join(
+            self._tmp_dir.name, 'out', 'arm64', 'arm64-c.apk')).channel)
+        self.assertTrue(os.path.isfile(os.path.join(
+            self._tmp_dir.name, 'out', 'x86_64', 'manifest.json')))
+
+    def test_audit_apk_files(self):
+        source = os.path.join(self._tmp_dir.name, 'source.apk')
+        self._create_v2_apk(source)
+        generate_channel_files(source, ['a', 'b'], self._tmp_dir.name)
+        with open(os.path.join(self._tmp_dir.name, 'broken.apk'), 'wb') as f:
+            f.write(b'not a zip')
+
+        output = io.StringIO()
+        count = write_audit_results(
+            audit_apk_files(scan_apk_files(self._tmp_dir.name), jobs=2),
+            output)
+        records = [json.loads(x) for x in output.getvalue().splitlines()]
+
+        self.assertEqual(4, count)
+        self.assertEqual(['a', 'b', None, None],
+                         [x['channel'] for x in records])
+        self.assertEqual([True, True, False, True],
+                         [x['v2_signed'] for x in records])
+
     def test_has_v2_sign(self):
         current_dir = os.path.dirname(os.path.realpath(__file__))
         apk_file_path = os.path.join(current_dir, 'app-release_v2.apk')
@@ -415,17 +2028,47 @@ if __name__ == '__main__':
     _format = 'app-%s.apk'
     _target_dir = None
     _source_apk = None
+    _jobs = 1
+    _clone = False
+    _audit_dir = None
+    _audit_format = 'jsonl'
+    _tail_digest = None
+    _manifest = None
+    _slot_size = None
+    _stamp_file = None
+    _stamp_channel = None
+    _delta = False
+    _patch_file = None
+    _base_apk = None
+    _output_file = None
+    _checkpoint = None
+    _job_spec = None
 
     _channels_list = []
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], "",
                                    ["channels=", "source-apk=", "target-dir=",
-                                    "format="])
+                                    "format=", "jobs=", "clone", "audit=",
+                                    "audit-format=", "tail-digest=",
+                                    "manifest=", "slot-size=", "stamp=",
+                                    "channel=", "delta", "apply-patch=",
+                                    "base=", "output=", "checkpoint=",
+                                    "job-spec="])
     except getopt.GetoptError:
         print("apkv2channeltools.py --source-apk=<sourceApk>"
               + " --channels=<channelsFile> [--target-dir=<targetDir>]"
-              + " --format=[targetApkFileNameFormat]")
+              + " --format=[targetApkFileNameFormat] [--jobs=<jobs>]"
+              + " [--clone] [--tail-digest=<crc32|sha256>]"
+              + " [--manifest=<manifestFile>] [--slot-size=<slotSize>]"
+              + " [--delta] [--checkpoint=<checkpointFile>]")
+        print("apkv2channeltools.py --stamp=<templateApk>"
+              + " --channel=<channel>")
+        print("apkv2channeltools.py --job-spec=<jobSpecFile>")
+        print("apkv2channeltools.py --apply-patch=<patchFile>"
+              + " --base=<baseApk> --output=<targetApk>")
+        print("apkv2channeltools.py --audit=<apkDir>"
+              + " [--audit-format=<jsonl|csv>] [--jobs=<jobs>]")
         sys.exit(1)
 
     for opt, arg in opts:
@@ -437,9 +2080,109 @@ if __name__ == '__main__':
             _target_dir = arg
         elif opt == '--format':
             _format = arg
+        elif opt == '--jobs':
+            try:
+                _jobs = int(arg)
+            except ValueError:
+                print("jobs must be a number")
+                sys.exit(1)
+        elif opt == '--clone':
+            _clone = True
+        elif opt == '--audit':
+            _audit_dir = arg
+        elif opt == '--audit-format':
+            _audit_format = arg
+        elif opt == '--tail-digest':
+            if arg != 'crc32' and arg not in hashlib.algorithms_available:
+                print("unsupported digest algorithm: %s" % arg)
+                sys.exit(1)
+            _tail_digest = arg
+        elif opt == '--manifest':
+            _manifest = arg
+        elif opt == '--slot-size':
+            try:
+                _slot_size = int(arg)
+            except ValueError:
+                print("slot size must be a number")
+                sys.exit(1)
+        elif opt == '--stamp':
+            _stamp_file = arg
+        elif opt == '--channel':
+            _stamp_channel = arg
+        elif opt == '--delta':
+            _delta = True
+        elif opt == '--apply-patch':
+            _patch_file = arg
+        elif opt == '--base':
+            _base_apk = arg
+        elif opt == '--output':
+            _output_file = arg
+        elif opt == '--checkpoint':
+            _checkpoint = arg
+        elif opt == '--job-spec':
+            _job_spec = arg
+
+    if _job_spec:
+        try:
+            with open(_job_spec, 'rt', encoding='UTF-8') as f:
+                _report = run_channel_matrix(
+                    json.load(f), os.path.dirname(os.path.abspath(_job_spec)))
+        except (Exception, SignatureNotFoundError) as e:
+            logging.error("run job spec %s fail: %s" % (_job_spec, e))
+            sys.exit(2)
+
+        _failed = 0
+        for _source, _source_results in _report.results.items():
+            for result in _source_results:
+                if not result.success:
+                    _failed += 1
+                    logging.error("generate %s apk from %s fail: %s"
+                                  % (result.channel, _source, result.error))
+        logging.info("generate %d apk (%d failed) in %.3fs, %.1f channels/s,"
+                     " %.1f MB/s" % (_report.channel_count, _failed,
+                                     _report.elapsed,
+                                     _report.channels_per_second,
+                                     _report.mb_per_second))
+        sys.exit(0)
+
+    if _patch_file:
+        if not _base_apk or not _output_file:
+            print("--apply-patch requires --base and --output")
+            sys.exit(1)
+        try:
+            apply_channel_patch(_base_apk, _patch_file, _output_file)
+        except (Exception, ChannelPatchError) as e:
+            logging.error("apply %s fail: %s" % (_patch_file, e))
+            sys.exit(2)
+        logging.info("apply %s to %s success" % (_patch_file, _output_file))
+        sys.exit(0)
+
+    if _stamp_file:
+        try:
+            stamp_channel_slot(_stamp_file, find_channel_slot(_stamp_file),
+                               _stamp_channel or '')
+        except (Exception, SignatureNotFoundError) as e:
+            logging.error("stamp %s fail: %s" % (_stamp_file, e))
+            sys.exit(2)
+        logging.info("stamp %s to %s success" % (_stamp_channel, _stamp_file))
+        sys.exit(0)
+
+    if _audit_dir:
+        if not os.path.isdir(_audit_dir) \
+                or _audit_format not in ('jsonl', 'csv'):
+            print("audit directory or format invalid")
+            sys.exit(1)
+        _start_time = time.time()
+        _count = write_audit_results(
+            audit_apk_files(scan_apk_files(_audit_dir), _jobs),
+            sys.stdout, _audit_format)
+        _elapsed = max(time.time() - _start_time, 1e-6)
+        logging.info("audit %d apk in %.3fs, %.1f files/s"
+                     % (_count, _elapsed, _count / _elapsed))
+        sys.exit(0)
 
     try:
-        _channels_list = FileTools.read_config_file(_channels_file)
+        _channels_list = read_channels(_channels_file)
     except BaseException as e:
         print('read channels file error %s' % e)
         sys.exit(1)
@@ -457,23 +2200,34 @@ if __name__ == '__main__':
         print("target directory invalid")
         sys.exit(1)
 
-    apk_tools = ApkChannelTool(_source_apk)
-
-    if apk_tools.has_v2_signature():
-        for channel in _channels_list:
-            target_name = _format % channel
-            target_file = os.path.join(_target_dir, target_name)
+    if _manifest:
+        _manifest = os.path.join(_target_dir, _manifest)
 
-            if apk_tools.save_as_channel_file(
-                    target_file, _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID, channel):
-                target_tools = ApkChannelTool(target_file)
-                if target_tools.has_extra_info_in_signing_block(
-                        _APK_SIGNATURE_SCHEME_V2_CHANNEL_ID):
-                    logging.info("generate %s apk success" % channel)
-                    continue
-            logging.error("generate %s apk fail" % channel)
-    else:
+    try:
+        if _delta:
+            _base_file, _results = generate_channel_patches(
+                _source_apk, _channels_list, _target_dir, _format, _jobs,
+                slot_size=_slot_size, clone=_clone)
+            logging.info("base apk: %s" % _base_file)
+        else:
+            _results = generate_channel_files(_source_apk, _channels_list,
+                                              _target_dir, _format, _jobs,
+                                              clone=_clone,
+                                              digest=_tail_digest,
+                                              manifest=_manifest,
+                                              slot_size=_slot_size,
+                                              checkpoint=_checkpoint)
+    except SignatureNotFoundError:
         print("%s is not a apk signed by scheme v2" % _source_apk)
-        apk_tools.release()
         sys.exit(2)
+
+    for result in _results:
+        if result.success and result.digest:
+            logging.info("generate %s apk success, tail %s: %s"
+                         % (result.channel, _tail_digest, result.digest))
+        elif result.success:
+            logging.info("generate %s apk success" % result.channel)
+        else:
+            logging.error("generate %s apk fail: %s" % (result.channel,
+                                                        result.error))
     sys.exit(0)
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+optimize images with asyncio, the number of uploads in flight is set by a
+concurrency limit instead of the cpu count
+"""
+
+__author__ = 'Jiasheng Lee'
+
+
+import asyncio, logging, os, time, collections, base64, unittest, tempfile, \
+    shutil
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from optimizeimage import NetworkError, TINIFY_SHRINK_URL, _HEADER, \
+    _CHUNK_SIZE, AuthTokenError, TokenExhaustedError, ThrottleError, \
+    ServerError, RetryPolicy, CircuitBreaker, classify_response
+from imagemark import MarkCheckFactory, ImageFormatError, sniff_image, \
+    split_image_info
+from optimizecache import file_hash, NOT_HASHED
+from tokenpool import TokenPool, NoValidTokenError
+
+# uploads and downloads in flight
+_CONCURRENCY = 64
+# connections per host, 0 for no limit
+_PER_HOST = 16
+# threads for file reading, writing and marking
+_IO_WORKERS = 4
+
+_const_mark = b'mark&tiny'
+
+
+def _auth_header(token):
+    return {'Authorization': 'Basic ' + base64.b64encode(
+        ('api:%s' % token).encode('UTF-8')).decode('ascii')}
+
+
+def _remove_file(file_name):
+    if os.path.isfile(file_name):
+        os.remove(file_name)
+
+
+class AsyncImageOptimizer(object):
+    """
+    upload an image to the tiny server and download the optimized one with a
+    shared aiohttp session, the file io runs in the executor
+    """
+
+    def __init__(self, session, executor, shrinkUrl=TINIFY_SHRINK_URL,
+                 proxy=None, retryPolicy=None, breaker=None):
+        self._session = session
+        self._executor = executor
+        self._shrinkUrl = shrinkUrl
+        self._proxy = proxy
+        self._retryPolicy = retryPolicy or RetryPolicy()
+        self._breaker = breaker or CircuitBreaker()
+
+    def run_in_executor(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self._executor, func,
+                                                        *args)
+
+    async def _retry(self, func, *args):
+        '''
+            await func(*args) until it does not fail with a transient error or
+            the retries are used up, the same as ImageOptimizer._retry
+        '''
+        attempt = 0
+        while True:
+            delay = self._breaker.wait_time()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self._breaker.wait_time()
+            try:
+                result = await func(*args)
+                self._breaker.record_success()
+                return result
+            except ThrottleError as e:
+                self._breaker.pause(e.retryAfter)
+                error = e
+            except ServerError as e:
+                self._breaker.record_failure()
+                error = e
+            except NetworkError:
+                self._breaker.record_success()
+                raise
+            if attempt >= self._retryPolicy.maxRetries:
+                raise error
+            delay = self._retryPolicy.delay(attempt, error)
+            logging.debug('request for %s fail: %s, retry in %.2fs'
+                          % (args[0], error.message, delay))
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def optimize_image(self, file_path, token):
+        '''
+            upload image to tiny server, return the url of the optimized image
+            and the Compression-Count of the token
+        '''
+        return await self._retry(self._upload, file_path, token)
+
+    async def _upload(self, file_path, token):
+        # the body is streamed from the file instead of read into memory
+        f = await self.run_in_executor(open, file_path, 'rb')
+        try:
+            async with self._session.post(
+                    self._shrinkUrl, data=f, proxy=self._proxy,
+                    headers=_auth_header(token)) as resp:
+                logging.debug('request for %s, the response code is %d'
+                              % (file_path, resp.status))
+                await resp.read()
+                if resp.status >= 400:
+                    raise classify_response(resp.status, resp.reason,
+                                            resp.headers)
+                count = resp.headers.get('Compression-Count')
+                return resp.headers['Location'], int(count) if count else None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ServerError(str(e) or type(e).__name__)
+        finally:
+            f.close()
+
+    async def download_file(self, url, file_path, token):
+        '''
+            download the optimzed image to <file_path>.opt, return the
+            downloaded file name
+        '''
+        return await self._retry(self._download, file_path, url, token)
+
+    async def _download(self, file_path, url, token):
+        opt_file = file_path + '.opt'
+        try:
+            async with self._session.get(
+                    url, proxy=self._proxy,
+                    headers=_auth_header(token)) as resp:
+                if resp.status >= 400:
+                    raise classify_response(
+                        resp.status, 'download image fail, result %d'
+                        % resp.status, resp.headers)
+                # written chunk by chunk as the response arrives
+                f = await self.run_in_executor(open, opt_file, 'wb')
+                try:
+                    async for chunk in resp.content.iter_chunked(_CHUNK_SIZE):
+                        await self.run_in_executor(f.write, chunk)
+                finally:
+                    f.close()
+            return opt_file
+        except BaseException as e:
+            await self.run_in_executor(_remove_file, opt_file)
+            if isinstance(e, (aiohttp.ClientError, asyncio.TimeoutError)):
+                raise ServerError(str(e) or type(e).__name__)
+            raise
+
+    async def sniff(self, origin_file):
+        """
+        :return: ImageInfo of the file, raise ImageFormatError if it is not
+        png or jpg
+        """
+        info = await self.run_in_executor(sniff_image, origin_file,
+                                          _const_mark)
+        if info.format is None:
+            raise ImageFormatError("unsupport image type: %s" % origin_file,
+                                   _const_mark)
+        return info
+
+    async def optimize_file(self, origin_file, tokens, info=None):
+        """
+        optimize and mark the file unless it is marked already
+        :param info: ImageInfo of the file sniffed already, None to sniff it
+        :return: True if optimized, False if it is marked already, None if
+        marking the optimized image fails, raise ImageFormatError if it is not
+        png or jpg, AuthTokenError or TokenExhaustedError if the token can not
+        be used, other NetworkError if the image can not be optimized after
+        the retries, NoValidTokenError if there is no token to upload with
+        """
+        if info is None:
+            info = await self.sniff(origin_file)
+        if info.marked:
+            return False
+        token = tokens.acquire()
+        try:
+            url, count = await self.optimize_image(origin_file, token)
+            opt_file = await self.download_file(url, origin_file, token)
+        except (AuthTokenError, TokenExhaustedError) as e:
+            tokens.report_failure(token, e.statusCode)
+            raise
+        except NetworkError:
+            tokens.report_failure(token)
+            raise
+        except BaseException:
+            tokens.release(token)
+            raise
+        tokens.report_success(token, count)
+        marker = await self.run_in_executor(MarkCheckFactory.get_marker,
+                                            opt_file, _const_mark)
+        if await self.run_in_executor(marker.mark):
+            await self.run_in_executor(os.replace, opt_file, origin_file)
+            return True
+        logging.error("mark file error: %s" % opt_file)
+        return None
+
+    async def optimize_cached_file(self, origin_file, tokens, cache,
+                                   info=None):
+        """
+        optimize the file with an OptimizeCache, the unchanged files are
+        skipped and identical images are uploaded only once
+        :param info: ImageInfo of the file sniffed already, None to sniff it
+        :return: True if the file is uploaded, False if it is skipped
+        """
+        if await self.run_in_executor(cache.is_unchanged, origin_file):
+            return False
+        # the files which are not uploaded are never hashed
+        try:
+            if info is None:
+                info = await self.sniff(origin_file)
+        except ImageFormatError:
+            await self.run_in_executor(cache.record_file, origin_file,
+                                       NOT_HASHED)
+            raise
+        if info.marked:
+            await self.run_in_executor(cache.record_file, origin_file,
+                                       NOT_HASHED)
+            return False
+        content_hash = await self.run_in_executor(file_hash, origin_file)
+        while True:
+            if await self.run_in_executor(cache.apply_result, content_hash,
+                                          origin_file):
+                return False
+            event = cache.claim(content_hash)
+            if event is None:
+                break
+            # wait out of the io executor, the owner needs it to finish
+            await asyncio.get_event_loop().run_in_executor(None, event.wait)
+        try:
+            optimized = await self.optimize_file(origin_file, tokens, info)
+            if optimized:
+                await self.run_in_executor(cache.store_result, content_hash,
+                                           origin_file)
+            return bool(optimized)
+        finally:
+            cache.release(content_hash)
+
+
+async def _optimize_all(files, tokens, concurrency, per_host, shrink_url,
+                        proxy, executor, stats, cache, retry_policy, breaker):
+    counter = collections.Counter()
+    file_iter = iter(files)
+    file_lock = asyncio.Lock()
+    loop = asyncio.get_event_loop()
+
+    async def next_file():
+        # the file iterator may block on the directory walk
+        async with file_lock:
+            return await loop.run_in_executor(executor, next, file_iter, None)
+
+    retry_policy = retry_policy or RetryPolicy()
+    connect_timeout, read_timeout = retry_policy.timeout
+    connector = aiohttp.TCPConnector(limit=concurrency,
+                                     limit_per_host=per_host)
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                    sock_read=read_timeout)
+    async with aiohttp.ClientSession(connector=connector, headers=_HEADER,
+                                     timeout=timeout) as session:
+        optimizer = AsyncImageOptimizer(session, executor, shrink_url, proxy,
+                                        retry_policy, breaker)
+        no_token = []
+
+        async def worker(name):
+            item = await next_file()
+            while item is not None:
+                origin_file, info = split_image_info(item)
+                start = time.time()
+                try:
+                    if cache is not None:
+                        optimized = await optimizer.optimize_cached_file(
+                            origin_file, tokens, cache, info)
+                    else:
+                        optimized = await optimizer.optimize_file(
+                            origin_file, tokens, info)
+                    if optimized:
+                        counter['optimized'] += 1
+                    else:
+                        counter['skipped'] += 1
+                except (AuthTokenError, TokenExhaustedError) as e:
+                    # the token state is updated, retry with another token
+                    logging.debug("token fail %s" % e.message)
+                    continue
+                except NetworkError as e:
+                    logging.error("optimize %s fail: %s"
+                                  % (origin_file, e.message))
+                    counter['failed'] += 1
+                except NoValidTokenError as e:
+                    no_token.append(e)
+                    return
+                except ImageFormatError as e:
+                    logging.debug("file type unknown: %s" % e)
+                    counter['skipped'] += 1
+                if stats is not None:
+                    stats.record(time.time() - start, name)
+                item = await next_file()
+
+        await asyncio.gather(*[worker('async-%d' % x)
+                               for x in range(concurrency)])
+
+    if no_token:
+        logging.error(no_token[0].message)
+        if hasattr(files, 'cancel'):
+            files.cancel()
+    return counter
+
+
+def optimize_files_async(files, tokens, concurrency=_CONCURRENCY,
+                         per_host=_PER_HOST, shrink_url=TINIFY_SHRINK_URL,
+                         proxy=None, io_workers=_IO_WORKERS, stats=None,
+                         cache=None, retry_policy=None, breaker=None):
+    """
+    optimize the files in an event loop, up to concurrency files in flight
+    :param files: iterable of file paths or ImageInfo of the files sniffed
+    already, can be a WalkQueue
+    :param tokens: TokenPool or list of tokens
+    :param concurrency: files optimized at the same time
+    :param per_host: connections per host, 0 for no limit
+    :param shrink_url: url to upload the images to
+    :param proxy: http proxy url, can be None
+    :param io_workers: threads for file reading, writing and marking
+    :param stats: WorkerStats to record the busy time of every coroutine, can
+    be None
+    :param cache: OptimizeCache to skip unchanged files and upload identical
+    images once, can be None
+    :param retry_policy: RetryPolicy of the requests, None for the default one
+    :param breaker: CircuitBreaker shared by the coroutines, None for a new one
+    :return: Counter of optimized, skipped and failed files
+    """
+    if aiohttp is None:
+        raise ImportError('aiohttp is required by the asyncio engine')
+    if not isinstance(tokens, TokenPool):
+        tokens = TokenPool(tokens)
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(io_workers)
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(_optimize_all(
+            files, tokens, concurrency, per_host, shrink_url, proxy, executor,
+            stats, cache, retry_policy, breaker))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+        executor.shutdown()
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncOptimizerTest(unittest.TestCase):
+
+    def setUp(self):
+        import tinifyserver
+        self._server = tinifyserver.TinifyServer(tokens=['token'],
+                                                 connect_delay=0.01).start()
+        self._dir = tempfile.mkdtemp()
+        base_dir = os.path.dirname(os.path.realpath(__file__))
+        self._files = []
+        for x in range(20):
+            name = 'test_optimize_origin.png' if x % 2 else 'startup.jpg'
+            self._files.append(os.path.join(
+                self._dir, '%d%s' % (x, os.path.splitext(name)[1])))
+            shutil.copyfile(os.path.join(base_dir, name), self._files[-1])
+
+    def tearDown(self):
+        self._server.stop()
+        shutil.rmtree(self._dir)
+
+    def test_optimize_files(self):
+        result = optimize_files_async(self._files, ['error_token', 'token'],
+                                      concurrency=8, per_host=4,
+                                      shrink_url=self._server.shrink_url)
+        self.assertEqual(20, result['optimized'])
+        self.assertLessEqual(self._server.connections, 4 + 1)
+        for x in self._files:
+            self.assertTrue(MarkCheckFactory.get_checker(
+                x, _const_mark).has_mark())
+
+        # marked files are not uploaded again
+        requests = self._server.requests
+        result = optimize_files_async(self._files, ['token'],
+                                      shrink_url=self._server.shrink_url)
+        self.assertEqual(20, result['skipped'])
+        self.assertEqual(requests, self._server.requests)
+
+    def test_optimize_with_cache(self):
+        from optimizecache import OptimizeCache
+        cache = OptimizeCache(os.path.join(self._dir, 'cache'))
+        try:
+            result = optimize_files_async(self._files, ['token'],
+                                          concurrency=8,
+                                          shrink_url=self._server.shrink_url,
+                                          cache=cache)
+            # one png and one jpg, the copies take the cached results
+            self.assertEqual(2, result['optimized'])
+            self.assertEqual(4, self._server.requests)
+            for x in self._files:
+                self.assertTrue(cache.is_unchanged(x))
+        finally:
+            cache.close()
+
+    def test_token_quota(self):
+        import tinifyserver
+        server = tinifyserver.TinifyServer(monthly_limit=10).start()
+        try:
+            tokens = TokenPool(['first', 'second'], monthly_limit=10)
+            result = optimize_files_async(self._files, tokens, concurrency=4,
+                                          shrink_url=server.shrink_url)
+            self.assertEqual(20, result['optimized'])
+            # the exhaustion is predicted from Compression-Count, no upload
+            # is rejected by the server
+            self.assertEqual(40, server.requests)
+            self.assertEqual([('exhausted', 10), ('exhausted', 10)],
+                             [tokens.state(x) for x in ['first', 'second']])
+        finally:
+            server.stop()
+
+    def test_retry_faults(self):
+        import tinifyserver
+        self._server.inject_fault(503, count=3)
+        self._server.inject_fault(tinifyserver.FAULT_DROP)
+        self._server.inject_fault(429, headers={'Retry-After': '0'})
+        policy = RetryPolicy(maxRetries=6, baseDelay=0.01)
+        result = optimize_files_async(self._files, ['token'], concurrency=4,
+                                      shrink_url=self._server.shrink_url,
+                                      retry_policy=policy)
+        self.assertEqual(20, result['optimized'])
+        self.assertEqual(40 + 5, self._server.requests)
+
+        # a file is skipped when the retries are used up, the token is kept
+        for x in self._files[:2]:
+            shutil.copyfile(os.path.join(os.path.dirname(
+                os.path.realpath(__file__)), 'startup.jpg'), x)
+        self._server.inject_fault(500, count=2)
+        tokens = TokenPool(['token'])
+        result = optimize_files_async(self._files[:2], tokens, concurrency=1,
+                                      shrink_url=self._server.shrink_url,
+                                      retry_policy=RetryPolicy(1, 0.01))
+        self.assertEqual(1, result['failed'])
+        self.assertEqual(1, result['optimized'])
+        self.assertEqual('valid', tokens.state('token')[0])
+
+    def test_no_valid_token(self):
+        result = optimize_files_async(self._files, ['error_token'],
+                                      concurrency=4,
+                                      shrink_url=self._server.shrink_url)
+        self.assertEqual(0, result['optimized'])
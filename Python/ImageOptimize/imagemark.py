@@ -11,8 +11,12 @@ import struct
 import os
 import shutil
 import unittest
-import imghdr
+import collections
+import itertools
+import functools
+import tempfile
 import piexif
+from concurrent.futures import ProcessPoolExecutor
 
 
 # png 文件默认结尾
@@ -21,6 +25,19 @@ _png_end = bytes(b'\x00\x00\x00\x00\x49\x45\x4E\x44\xAE\x42\x60\x82')
 # 图片标记
 _const_mark = b'mark&tiny'
 
+# 判断图片格式时读取的文件头大小
+_SNIFF_SIZE = 32
+
+# exif中Copyright的tag
+_EXIF_COPYRIGHT_TAG = 0x8298
+
+# 批量检查时每个进程一次处理的文件数
+_SNIFF_CHUNK_SIZE = 64
+
+# 图片格式检查结果, format为png, jpeg或None
+ImageInfo = collections.namedtuple('ImageInfo', ['file_name', 'format',
+                                                 'marked'])
+
 class ImageFormatError(BaseException):
     """
     error when check image format or check mark sign
@@ -39,6 +56,134 @@ class ImageFormatError(BaseException):
         return self._marker
 
 
+def _image_format(head):
+    """
+    与imghdr相同的规则判断图片格式
+    :param head: 文件头
+    :return: png, jpeg或None
+    """
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[6:10] in (b'JFIF', b'Exif') or head[:4] == b'\xff\xd8\xff\xdb':
+        return 'jpeg'
+    return None
+
+
+def _tiff_copyright(tiff):
+    """
+    读取tiff结构(exif)中0th IFD的Copyright, 与piexif.load的结果相同
+    :return: Copyright的内容, 不存在时返回None
+    """
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return None
+    ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+    count = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+    for x in range(count):
+        entry = tiff[ifd + 2 + 12 * x: ifd + 14 + 12 * x]
+        tag, value_type, length = struct.unpack(endian + 'HHI', entry[:8])
+        if tag != _EXIF_COPYRIGHT_TAG:
+            continue
+        if length > 4:
+            pointer = struct.unpack(endian + 'I', entry[8:12])[0]
+            return tiff[pointer: pointer + length - 1]
+        return entry[8: 8 + length - 1]
+    return None
+
+
+def _jpeg_copyright(f):
+    """
+    依次跳过jpeg的各个segment, 只读取exif所在的APP1
+    :param f: 以二进制方式打开的jpeg文件
+    :return: Copyright的内容, 不存在时返回None
+    """
+    f.seek(2)
+    while True:
+        header = f.read(4)
+        # SOS之后为图片数据, exif只会出现在之前
+        if len(header) < 4 or header[0] != 0xFF or header[1] in (0xDA, 0xD9):
+            return None
+        length = struct.unpack('>H', header[2:4])[0]
+        if header[1] == 0xE1:
+            data = f.read(length - 2)
+            if data.startswith(b'Exif\x00\x00'):
+                return _tiff_copyright(data[6:])
+        else:
+            f.seek(length - 2, os.SEEK_CUR)
+
+
+def sniff_image(filename, marksign=_const_mark):
+    """
+    只打开一次文件, 读取文件头判断格式, png读取文件尾, jpeg读取exif所在的APP1
+    判断是否已打标识, 不需要解析整个图片
+    :param filename: 文件
+    :param marksign: 标识
+    :return: ImageInfo, 不是png或jpeg图片及读取失败时format为None
+    """
+    try:
+        with open(filename, 'rb') as f:
+            img_format = _image_format(f.read(_SNIFF_SIZE))
+            if 'png' == img_format:
+                png_mark = MarkCheckFactory._generate_png_mark(marksign)
+                size = len(_png_end) + len(png_mark)
+                f.seek(0, os.SEEK_END)
+                if f.tell() < size:
+                    return ImageInfo(filename, img_format, False)
+                f.seek(-size, os.SEEK_END)
+                return ImageInfo(filename, img_format,
+                                 f.read(len(png_mark)) == png_mark)
+            elif 'jpeg' == img_format:
+                try:
+                    copyright = _jpeg_copyright(f)
+                except struct.error:
+                    copyright = None
+                return ImageInfo(filename, img_format, copyright == marksign)
+            return ImageInfo(filename, None, False)
+    except OSError as e:
+        logging.debug("read file error : %s" % e)
+        return ImageInfo(filename, None, False)
+
+
+def sniff_images(filenames, marksign=_const_mark, processes=None,
+                 chunk_size=_SNIFF_CHUNK_SIZE):
+    """
+    批量检查图片格式和标识
+    :param filenames: 文件列表, 可为迭代器
+    :param marksign: 标识
+    :param processes: 进程数, 不大于1时在当前线程中检查
+    :param chunk_size: 每个进程一次处理的文件数
+    :return: 与filenames顺序一致的ImageInfo迭代器
+    """
+    if not processes or processes <= 1:
+        for x in filenames:
+            yield sniff_image(x, marksign)
+        return
+
+    func = functools.partial(sniff_image, marksign=marksign)
+    filenames = iter(filenames)
+    with ProcessPoolExecutor(processes) as executor:
+        while True:
+            batch = list(itertools.islice(filenames, chunk_size * processes))
+            if not batch:
+                return
+            for x in executor.map(func, batch, chunksize=chunk_size):
+                yield x
+
+
+def split_image_info(item):
+    """
+    拆分待处理的文件, 已检查过的文件以ImageInfo传递, 不需要再次打开检查
+    :param item: 文件路径或ImageInfo
+    :return: (文件路径, ImageInfo), 未检查过时ImageInfo为None
+    """
+    if isinstance(item, ImageInfo):
+        return item.file_name, item
+    return item, None
+
+
 class MarkChecker(object):
 
     def has_mark(self):
@@ -72,7 +217,8 @@ class MarkCheckFactory(object):
         when no MarkChecker and Marker not fount
         """
         try:
-            img_format = imghdr.what(filename)
+            with open(filename, 'rb') as f:
+                img_format = _image_format(f.read(_SNIFF_SIZE))
             logging.debug("%s format is %s" % (filename, img_format))
             if 'png' == img_format:
                 png_mark = MarkCheckFactory._generate_png_mark(marksign)
@@ -95,7 +241,8 @@ class MarkCheckFactory(object):
         :return:
         """
         try:
-            image_format = imghdr.what(filename)
+            with open(filename, 'rb') as f:
+                image_format = _image_format(f.read(_SNIFF_SIZE))
             if image_format == 'png':
                 png_mark = MarkCheckFactory._generate_png_mark(marksign)
                 return PNGMarker(filename, png_mark)
@@ -129,11 +276,11 @@ class JPGMarkChecker(MarkChecker):
         :return: marked for True, otherwise for False, raise
          ImageFormatError if this file is not normal image
         """
-        exif_dict = piexif.load(self._fileName)
-        if exif_dict is not 0 and '0th' in exif_dict and \
-                piexif.ImageIFD.Copyright in exif_dict['0th']:
-            return self._marker == exif_dict['0th'][piexif.ImageIFD.Copyright]
-        return False
+        with open(self._fileName, 'rb') as f:
+            try:
+                return self._marker == _jpeg_copyright(f)
+            except struct.error:
+                return False
 
 
 class JPGMarker(Marker):
@@ -293,6 +440,37 @@ class TestImageMark(unittest.TestCase):
         if os.path.isfile(self._test_file):
             os.remove(self._test_file)
 
+    def test_sniff(self):
+        base_dir = os.path.dirname(os.path.realpath(__file__))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            files = []
+            for x in ['startup.jpg', 'test_optimize_origin.png', 'ignore.txt']:
+                for prefix in ['origin_', 'mark_']:
+                    files.append(os.path.join(tmp_dir, prefix + x))
+                    shutil.copyfile(os.path.join(base_dir, x), files[-1])
+                    if prefix == 'mark_' and not x.endswith('.txt'):
+                        MarkCheckFactory.get_marker(files[-1],
+                                                    _const_mark).mark()
+
+            expected = [('jpeg', False), ('jpeg', True), ('png', False),
+                        ('png', True), (None, False), (None, False)]
+            for processes in [None, 2]:
+                infos = list(sniff_images(files, _const_mark, processes, 1))
+                self.assertEqual(files, [x.file_name for x in infos])
+                self.assertEqual(expected, [(x.format, x.marked)
+                                            for x in infos])
+
+            # the same copyright as piexif reads it
+            exif_dict = piexif.load(files[1])
+            with open(files[1], 'rb') as f:
+                self.assertEqual(exif_dict['0th'][piexif.ImageIFD.Copyright],
+                                 _jpeg_copyright(f))
+            self.assertEqual(ImageInfo(files[0] + '.none', None, False),
+                             sniff_image(files[0] + '.none'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
 if '__main__' == __name__:
     unittest.main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+cache of optimized images keyed by content hash, so identical images are
+uploaded once and unchanged files are skipped with a single stat
+"""
+
+__author__ = 'Jiasheng Lee'
+
+
+import logging, os, sqlite3, threading, hashlib, shutil, time, tempfile, \
+    unittest
+
+# total size of the optimized images kept in the cache
+_MAX_SIZE = 512 * 1024 * 1024
+
+_HASH_CHUNK_SIZE = 64 * 1024
+
+# hash recorded for the files skipped without reading them through, the ones
+# which are not png or jpg images or are marked already
+NOT_HASHED = ''
+
+_SCHEMA = [
+    # the content hash of a file, valid as long as its stat does not change
+    'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER,'
+    ' mtime_ns INTEGER, inode INTEGER, hash TEXT)',
+    # the optimized result of a content hash, an optimized image is its own
+    # result
+    'CREATE TABLE IF NOT EXISTS results (hash TEXT PRIMARY KEY, result TEXT)',
+    'CREATE INDEX IF NOT EXISTS results_result ON results (result)',
+    # the optimized images stored in the cache directory
+    'CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER,'
+    ' used REAL)',
+]
+
+
+def file_hash(file_name):
+    """
+    :param file_name: the file
+    :return: sha256 of the file content in hex
+    """
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class OptimizeCache(object):
+    """
+    sqlite database and the optimized images in a cache directory, shared by
+    the worker threads, other processes can use the same directory at the
+    same time
+    """
+
+    def __init__(self, cache_dir, max_size=_MAX_SIZE):
+        """
+        :param cache_dir: directory of the database and the optimized images
+        :param max_size: total size of the optimized images, the least
+        recently used ones are evicted when it is exceeded
+        """
+        self._blob_dir = os.path.join(cache_dir, 'blobs')
+        if not os.path.isdir(self._blob_dir):
+            os.makedirs(self._blob_dir)
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'cache.db'),
+                                     timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        for x in _SCHEMA:
+            self._conn.execute(x)
+        # content hashes being optimized by a worker of this process
+        self._pending = {}
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _blob_file(self, content_hash):
+        return os.path.join(self._blob_dir, content_hash)
+
+    def is_unchanged(self, file_name):
+        """
+        check with a single stat if the file is not changed since it was
+        recorded, which means it is optimized already or not an image
+        :param file_name: the file
+        :return: True if the file can be skipped
+        """
+        try:
+            st = os.stat(file_name)
+        except OSError:
+            return False
+        rows = self._execute('SELECT size, mtime_ns, inode FROM files'
+                             ' WHERE path = ?', (file_name,))
+        return bool(rows) and rows[0] == (st.st_size, st.st_mtime_ns,
+                                          st.st_ino)
+
+    def record_file(self, file_name, content_hash):
+        """
+        record the current stat of an optimized file or a file which is not
+        an image, so it is skipped next time
+        :param file_name: the file
+        :param content_hash: content hash of the file, NOT_HASHED if it is
+        not an image or is marked already
+        :return:
+        """
+        st = os.stat(file_name)
+        self._execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                      (file_name, st.st_size, st.st_mtime_ns, st.st_ino,
+                       content_hash))
+
+    def apply_result(self, content_hash, file_name):
+        """
+        replace the file with the cached optimized image of the same content
+        :param content_hash: content hash of the file
+        :param file_name: the file
+        :return: True if the file is optimized already or replaced by the
+        cached result, False if it has to be optimized
+        """
+        rows = self._execute('SELECT result FROM results WHERE hash = ?',
+                             (content_hash,))
+        if not rows:
+            return False
+        result = rows[0][0]
+        if result != content_hash:
+            tmp_file = file_name + '.opt'
+            try:
+                shutil.copyfile(self._blob_file(result), tmp_file)
+            except OSError as e:
+                logging.debug("cached result of %s missing: %s"
+                              % (file_name, e))
+                if os.path.isfile(tmp_file):
+                    os.remove(tmp_file)
+                return False
+            os.replace(tmp_file, file_name)
+        self._execute('UPDATE blobs SET used = ? WHERE hash = ?',
+                      (time.time(), result))
+        self.record_file(file_name, result)
+        return True
+
+    def store_result(self, content_hash, file_name):
+        """
+        keep the optimized and marked file as the result of content_hash
+        :param content_hash: content hash of the file before optimizing
+        :param file_name: the optimized file
+        :return: content hash of the optimized file
+        """
+        result = file_hash(file_name)
+        blob_file = self._blob_file(result)
+        if not os.path.isfile(blob_file):
+            fd, tmp_file = tempfile.mkstemp(dir=self._blob_dir)
+            os.close(fd)
+            shutil.copyfile(file_name, tmp_file)
+            os.replace(tmp_file, blob_file)
+        self._execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)',
+                      (result, os.path.getsize(blob_file), time.time()))
+        self._execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                      (content_hash, result))
+        self._execute('INSERT OR REPLACE INTO results VALUES (?, ?)',
+                      (result, result))
+        self.record_file(file_name, result)
+        self._evict()
+        return result
+
+    def _evict(self):
+        if self.blob_size <= self._max_size:
+            return
+        rows = self._execute('SELECT hash, size FROM blobs ORDER BY used DESC')
+        total = 0
+        for content_hash, size in rows:
+            total += size
+            if total <= self._max_size:
+                continue
+            self._execute('DELETE FROM blobs WHERE hash = ?', (content_hash,))
+            # the optimized image still maps to itself, it is never uploaded
+            # again even after the blob is evicted
+            self._execute('DELETE FROM results WHERE result = ? AND hash != ?',
+                          (content_hash, content_hash))
+            try:
+                os.remove(self._blob_file(content_hash))
+            except OSError:
+                pass
+
+    @property
+    def blob_size(self):
+        return self._execute('SELECT COALESCE(SUM(size), 0) FROM blobs')[0][0]
+
+    def claim(self, content_hash):
+        """
+        claim the content hash before optimizing it, so the identical images
+        of the other workers wait for the result instead of uploading again
+        :param content_hash: content hash of the file
+        :return: None if the caller owns the hash and must call release,
+        otherwise a threading.Event set when the owner releases it
+        """
+        with self._lock:
+            event = self._pending.get(content_hash)
+            if event is None:
+                self._pending[content_hash] = threading.Event()
+            return event
+
+    def release(self, content_hash):
+        with self._lock:
+            event = self._pending.pop(content_hash, None)
+        if event is not None:
+            event.set()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class OptimizeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._cache = OptimizeCache(os.path.join(self._dir, 'cache'),
+                                    max_size=20)
+
+    def tearDown(self):
+        self._cache.close()
+        shutil.rmtree(self._dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self._dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_dedupe(self):
+        first = self._write('a.png', b'origin')
+        second = self._write('b.png', b'origin')
+        source_hash = file_hash(first)
+        self.assertFalse(self._cache.apply_result(source_hash, first))
+
+        self._write('a.png', b'optimized')
+        self._cache.store_result(source_hash, first)
+        self.assertTrue(self._cache.is_unchanged(first))
+        self.assertFalse(self._cache.is_unchanged(second))
+
+        self.assertTrue(self._cache.apply_result(source_hash, second))
+        with open(second, 'rb') as f:
+            self.assertEqual(b'optimized', f.read())
+        self.assertTrue(self._cache.is_unchanged(second))
+        # an optimized image copied elsewhere is recognized by its content
+        third = self._write('c.png', b'optimized')
+        self.assertTrue(self._cache.apply_result(file_hash(third), third))
+
+        self._write('a.png', b'changed')
+        self.assertFalse(self._cache.is_unchanged(first))
+
+    def test_evict(self):
+        for x in range(3):
+            path = self._write('%d.png' % x, b'origin%d' % x)
+            source_hash = file_hash(path)
+            self._write('%d.png' % x, b'optimized%d' % x)
+            self._cache.store_result(source_hash, path)
+        self.assertLessEqual(self._cache.blob_size, 20)
+        self.assertEqual(2, len(os.listdir(os.path.join(self._dir, 'cache',
+                                                        'blobs'))))
+        # the evicted result has to be optimized again
+        self.assertFalse(self._cache.apply_result(
+            file_hash(self._write('x.png', b'origin0')),
+            os.path.join(self._dir, 'x.png')))
+
+    def test_claim(self):
+        self.assertIsNone(self._cache.claim('hash'))
+        event = self._cache.claim('hash')
+        self.assertFalse(event.is_set())
+        self._cache.release('hash')
+        self.assertTrue(event.is_set())
+        self.assertIsNone(self._cache.claim('hash'))
@@ -8,41 +8,290 @@ __author__ = 'Jiasheng Lee'
 
 import logging
 import requests
+import requests.adapters
 import json
-import unittest, os
+import threading
+import time
+import random
+import email.utils
+import unittest, os, tempfile, shutil
 
 
-class AuthTokenError (BaseException):
-    def __init__(self, message):
-        self._message = message
+TINIFY_SHRINK_URL = 'https://api.tinify.com/shrink'
 
-    @property
-    def message(self):
-        return self._message
+# connections kept alive per host
+_POOL_SIZE = 10
+# number of hosts with a connection pool, the api and its output storage
+_POOL_HOSTS = 4
+# size of the chunks the optimized image is written to disk in
+_CHUNK_SIZE = 64 * 1024
+
+_HEADER = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X'
+           + '10_13_3) AppleWebKit/537.36 (KHTML, like Gecko) Chr'
+           + 'ome/64.0.3282.140 Safari/537.36"'}
+
+# retries of a request failed with a transient error
+_MAX_RETRIES = 4
+# base and max of the exponential backoff between retries in seconds
+_BASE_DELAY = 0.5
+_MAX_DELAY = 30.0
+# connect and read timeout of a request in seconds
+_TIMEOUT = (10, 60)
+# transient failures in a row to open the circuit breaker and seconds to keep
+# it open
+_FAILURE_THRESHOLD = 5
+_RESET_TIMEOUT = 30.0
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def create_session(pool_size=_POOL_SIZE, proxies=None):
+    """
+    create a session keeping connections alive, it can be shared by all the
+    ImageOptimizer of the worker threads
+    :param pool_size: connections kept alive per host, should not be less
+    than the number of worker threads
+    :param proxies: proxies applied to every request, like requests proxies
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=_POOL_HOSTS,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(_HEADER)
+    if proxies:
+        session.proxies.update(proxies)
+    return session
+
+
+def default_session():
+    """
+    :return: the session shared by the ImageOptimizer created without session
+    """
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = create_session()
+        return _default_session
 
 
 class NetworkError (BaseException):
-    def __init__(self, message):
+    def __init__(self, message, statusCode=None):
         self._message = message
+        self._statusCode = statusCode
 
     @property
     def message(self):
         return self._message
 
+    @property
+    def statusCode(self):
+        '''
+            status code of the response, None if there is no response
+        '''
+        return self._statusCode
+
+
+class AuthTokenError (NetworkError):
+    '''
+        the token is rejected by the server (401)
+    '''
+    def __init__(self, message, statusCode=401):
+        super(AuthTokenError, self).__init__(message, statusCode)
+
+
+class TokenExhaustedError (NetworkError):
+    '''
+        the monthly limit of the token is exceeded (429 without Retry-After)
+    '''
+    def __init__(self, message, statusCode=429):
+        super(TokenExhaustedError, self).__init__(message, statusCode)
+
+
+class ThrottleError (NetworkError):
+    '''
+        the server asks to slow down (429 with Retry-After)
+    '''
+    def __init__(self, message, statusCode=429, retryAfter=0):
+        super(ThrottleError, self).__init__(message, statusCode)
+        self._retryAfter = retryAfter
+
+    @property
+    def retryAfter(self):
+        return self._retryAfter
+
+
+class ServerError (NetworkError):
+    '''
+        transient failure: 5xx, timeout or a broken connection
+    '''
+    pass
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header, seconds or a http date
+    :return: seconds to wait, None if the header is absent or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.mktime_tz(email.utils.parsedate_tz(value))
+                   - time.time(), 0)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def classify_response(statusCode, reason, headers):
+    """
+    :param statusCode: status code of the response
+    :param reason: reason of the response
+    :param headers: headers of the response
+    :return: None for success, otherwise the NetworkError to raise
+    """
+    if statusCode < 400:
+        return None
+    if statusCode == 401:
+        return AuthTokenError(reason, statusCode)
+    if statusCode == 429:
+        retryAfter = parse_retry_after(headers.get('Retry-After'))
+        if retryAfter is None:
+            return TokenExhaustedError(reason, statusCode)
+        return ThrottleError(reason, statusCode, retryAfter)
+    if statusCode >= 500 or statusCode == 408:
+        return ServerError(reason, statusCode)
+    return NetworkError(reason, statusCode)
+
+
+class RetryPolicy(object):
+    '''
+        retries and jittered exponential backoff of the transient failures
+    '''
+
+    def __init__(self, maxRetries=_MAX_RETRIES, baseDelay=_BASE_DELAY,
+                 maxDelay=_MAX_DELAY, timeout=_TIMEOUT):
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.timeout = timeout
+
+    def delay(self, attempt, error=None):
+        '''
+            seconds to wait before the retry after attempt failed with error,
+            a throttled request waits for Retry-After in the circuit breaker,
+            only a small jitter is added here
+        '''
+        if isinstance(error, ThrottleError):
+            return random.uniform(0, self.baseDelay)
+        return random.uniform(0, min(self.maxDelay,
+                                     self.baseDelay * (2 ** attempt)))
+
+
+class CircuitBreaker(object):
+    '''
+        shared by all the workers, it opens after failureThreshold transient
+        failures in a row and all requests wait until resetTimeout passes,
+        then a single failure opens it again until a request succeeds
+    '''
+
+    def __init__(self, failureThreshold=_FAILURE_THRESHOLD,
+                 resetTimeout=_RESET_TIMEOUT):
+        self._lock = threading.Lock()
+        self._failureThreshold = failureThreshold
+        self._resetTimeout = resetTimeout
+        self._failures = 0
+        self._openUntil = 0.0
+
+    def wait_time(self):
+        '''
+            seconds to wait before sending a request, 0 when closed
+        '''
+        with self._lock:
+            return max(self._openUntil - time.time(), 0)
+
+    @property
+    def isOpen(self):
+        return self.wait_time() > 0
+
+    def wait(self):
+        while True:
+            delay = self.wait_time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures < self._failureThreshold:
+                return
+            now = time.time()
+            if self._openUntil <= now:
+                logging.warning("server unavailable, pause %.1fs"
+                                % self._resetTimeout)
+            self._openUntil = max(self._openUntil, now + self._resetTimeout)
+            # half open, the next failure opens it again
+            self._failures = self._failureThreshold - 1
+
+    def pause(self, seconds):
+        '''
+            hold all requests for seconds, for the Retry-After of throttling
+        '''
+        with self._lock:
+            self._openUntil = max(self._openUntil, time.time() + seconds)
+
 
 class ImageOptimizer(object):
 
-    def __init__(self, filePath, authToken):
+    def __init__(self, filePath, authToken, session=None,
+                 shrinkUrl=TINIFY_SHRINK_URL, retryPolicy=None, breaker=None):
+        '''
+            session is the requests.Session to send requests with, see
+            create_session, the process wide default_session when None.
+            transient failures are retried by retryPolicy. breaker pauses the
+            requests when the server is unavailable, pass the same one to the
+            optimizers of all the workers to share it, a new one when None
+        '''
         self._filePath = filePath
         self._authToken = authToken
-        self._header = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X'
-                        + '10_13_3) AppleWebKit/537.36 (KHTML, like Gecko) Chr'
-                        + 'ome/64.0.3282.140 Safari/537.36"'}
+        self._header = dict(_HEADER)
         self._proxy = {}
+        self._session = session if session is not None else default_session()
+        self._shrinkUrl = shrinkUrl
+        self._compressionCount = None
+        self._retryPolicy = retryPolicy if retryPolicy is not None \
+            else RetryPolicy()
+        self._breaker = breaker if breaker is not None else CircuitBreaker()
 
     def add_proxy(self, key, value):
         self._proxy[key] = value
 
+    @property
+    def session(self):
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    @property
+    def compressionCount(self):
+        '''
+            compressions of the token this month, from the Compression-Count
+            header of the upload response, None if not uploaded
+        '''
+        return self._compressionCount
+
     @property
     def authToken(self):
         return self._authToken
@@ -51,49 +300,107 @@ class ImageOptimizer(object):
     def authToken(self, authToken):
         self._authToken = authToken
 
-    def optimizeImage(self):
+    def _retry(self, func):
         '''
-            upload image to tiny server and download it to current folder,
-            return upload success or fail.
+            call func until it does not fail with a transient error or the
+            retries are used up, raise the classified NetworkError
         '''
-        logging.debug(self._header['User-Agent'])
-        urlStr = 'https://api.tinify.com/shrink'
-        with open(self._filePath, 'rb') as f:
-            logging.debug('open file name %s' % f.name)
-            body = f.read()
+        attempt = 0
+        while True:
+            self._breaker.wait()
+            try:
+                result = func()
+                self._breaker.record_success()
+                return result
+            except ThrottleError as e:
+                self._breaker.pause(e.retryAfter)
+                error = e
+            except ServerError as e:
+                self._breaker.record_failure()
+                error = e
+            except NetworkError:
+                # the server is up, retrying does not help
+                self._breaker.record_success()
+                raise
+            if attempt >= self._retryPolicy.maxRetries:
+                raise error
+            delay = self._retryPolicy.delay(attempt, error)
+            logging.debug('request for %s fail: %s, retry in %.2fs'
+                          % (self._filePath, error.message, delay))
+            time.sleep(delay)
+            attempt += 1
 
+    def _request(self, method, url, **kwargs):
         authDic = ('api', self._authToken)
-        req = requests.request('POST', urlStr, data=body, headers=self._header,
-                               auth=authDic, proxies=self._proxy)
+        try:
+            return self._session.request(method, url, headers=self._header,
+                                         auth=authDic, proxies=self._proxy,
+                                         timeout=self._retryPolicy.timeout,
+                                         **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise ServerError(str(e))
+
+    def _upload(self):
+        # the body is streamed from the file instead of read into memory
+        with open(self._filePath, 'rb') as f:
+            logging.debug('open file name %s' % f.name)
+            req = self._request('POST', self._shrinkUrl, data=f)
         logging.debug('request for %s, the response code is %d'
                       % (self._filePath, req.status_code))
 
-        if req.ok:
-            self._optimzeUrl = req.headers['Location']
-            jsonObject = json.loads(req.text)
-            self._optimzeFileSize = jsonObject['input']['size']
-            self._optimzeFileType = jsonObject['input']['type']
-            return True
-        else:
+        error = classify_response(req.status_code, req.reason, req.headers)
+        if error is not None:
             logging.debug("update image fail, result %d" % req.status_code)
-            raise NetworkError(req.reason)
+            raise error
+        self._optimzeUrl = req.headers['Location']
+        count = req.headers.get('Compression-Count')
+        self._compressionCount = int(count) if count else None
+        jsonObject = json.loads(req.text)
+        self._optimzeFileSize = jsonObject['input']['size']
+        self._optimzeFileType = jsonObject['input']['type']
+        return True
+
+    def _download(self):
+        req = self._request('GET', self._optimzeUrl, stream=True)
+        optFile = self._filePath + '.opt'
+        try:
+            error = classify_response(req.status_code,
+                                      'download image fail, result %d'
+                                      % req.status_code, req.headers)
+            if error is not None:
+                raise error
+            # written chunk by chunk as the response arrives
+            with open(optFile, 'wb') as f:
+                for chunk in req.iter_content(_CHUNK_SIZE):
+                    f.write(chunk)
+                return f.name
+        except requests.RequestException as e:
+            if os.path.isfile(optFile):
+                os.remove(optFile)
+            raise ServerError(str(e))
+        except BaseException:
+            if os.path.isfile(optFile):
+                os.remove(optFile)
+            raise
+        finally:
+            req.close()
+
+    def optimizeImage(self):
+        '''
+            upload image to tiny server and download it to current folder,
+            return upload success or fail. transient failures are retried,
+            raise AuthTokenError or TokenExhaustedError when the token can not
+            be used, other NetworkError when the image can not be optimized
+        '''
+        logging.debug(self._header['User-Agent'])
+        return self._retry(self._upload)
 
     def downloadFile(self):
         '''
             download the optimzed image from server, return the downloaded file
             name
         '''
-        authDic = ('api', self._authToken)
-        req = requests.request('GET', self._optimzeUrl, headers=self._header,
-                               auth=authDic, proxies=self._proxy)
-
-        if req.ok:
-            with open(self._filePath + '.opt', 'wb') as f:
-                f.write(req.content)
-                return f.name
-        else:
-            raise NetworkError('download image fail, result %d'
-                               % req.status_code)
+        return self._retry(self._download)
 
 
 class TestImageOptimizer(unittest.TestCase):
@@ -105,7 +412,8 @@ class TestImageOptimizer(unittest.TestCase):
         if os.path.isfile(self._origin_file + '.opt'):
             os.remove(self._origin_file + '.opt')
         self._optimizer_success = ImageOptimizer(
-            self._origin_file, 'd7q_GnylgjNEg6BtyWcsrHcsNQqP8eiU')
+            self._origin_file, 'd7q_GnylgjNEg6BtyWcsrHcsNQqP8eiU',
+            breaker=CircuitBreaker())
         self._optimizer_success.optimizeImage()
         opt_file = self._optimizer_success.downloadFile()
         self.assertTrue(self._origin_file + '.opt' == opt_file
@@ -119,6 +427,139 @@ class TestImageOptimizer(unittest.TestCase):
             'test_optimize_origin.png')
         if os.path.isfile(self._origin_file + '.opt'):
             os.remove(self._origin_file + '.opt')
-        self._optimizer_fail = ImageOptimizer(self._origin_file, 'error_token')
+        self._optimizer_fail = ImageOptimizer(self._origin_file, 'error_token',
+                                              breaker=CircuitBreaker())
         with self.assertRaises(NetworkError):
             self._optimizer_fail.optimizeImage()
+
+    def test_shared_session(self):
+        import tinifyserver
+        server = tinifyserver.TinifyServer(tokens=['token']).start()
+        origin_file = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            'test_optimize_origin.png')
+        try:
+            session = create_session(pool_size=2)
+            for x in range(3):
+                optimizer = ImageOptimizer(origin_file, 'token', session,
+                                           server.shrink_url)
+                self.assertTrue(optimizer.optimizeImage())
+                opt_file = optimizer.downloadFile()
+                self.assertEqual(os.path.getsize(origin_file),
+                                 os.path.getsize(opt_file))
+                os.remove(opt_file)
+            # upload and download of every image on one kept alive connection
+            self.assertEqual(1, server.connections)
+            self.assertEqual(6, server.requests)
+
+            with self.assertRaises(NetworkError):
+                ImageOptimizer(origin_file, 'error_token', session,
+                               server.shrink_url).optimizeImage()
+        finally:
+            server.stop()
+
+    def test_streaming_download(self):
+        import tinifyserver
+        server = tinifyserver.TinifyServer(chunk_size=16 * 1024,
+                                           chunk_delay=0.05).start()
+        tmp_dir = tempfile.mkdtemp()
+        origin_file = os.path.join(tmp_dir, 'big.png')
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                               'test_optimize_origin.png'), 'rb') as f:
+            data = f.read()
+        with open(origin_file, 'wb') as f:
+            f.write(data + os.urandom(256 * 1024))
+        try:
+            optimizer = ImageOptimizer(origin_file, 'token', create_session(),
+                                       server.shrink_url)
+            optimizer.optimizeImage()
+
+            sizes = []
+            done = threading.Event()
+
+            def watch():
+                while not done.wait(0.02):
+                    if os.path.isfile(origin_file + '.opt'):
+                        sizes.append(os.path.getsize(origin_file + '.opt'))
+
+            watcher = threading.Thread(target=watch)
+            watcher.start()
+            try:
+                opt_file = optimizer.downloadFile()
+            finally:
+                done.set()
+                watcher.join()
+            with open(opt_file, 'rb') as f:
+                self.assertEqual(data, f.read()[:len(data)])
+            self.assertEqual(os.path.getsize(origin_file),
+                             os.path.getsize(opt_file))
+            # the file grows while the response is still arriving
+            self.assertTrue(any(0 < x < os.path.getsize(opt_file)
+                                for x in sizes))
+
+            optimizer._optimzeUrl = server.url + '/output/0'
+            os.remove(opt_file)
+            with self.assertRaises(NetworkError):
+                optimizer.downloadFile()
+            self.assertFalse(os.path.exists(opt_file))
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+
+    def test_error_classification(self):
+        import tinifyserver
+        server = tinifyserver.TinifyServer(tokens=['token']).start()
+        origin_file = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            'test_optimize_origin.png')
+        policy = RetryPolicy(maxRetries=3, baseDelay=0.01, timeout=0.5)
+        session = create_session()
+
+        def optimizer(token='token', breaker=None):
+            return ImageOptimizer(origin_file, token, session,
+                                  server.shrink_url, policy,
+                                  breaker or CircuitBreaker())
+        try:
+            # 5xx, dropped connections and timeouts are retried
+            server.inject_fault(503, 2).inject_fault(tinifyserver.FAULT_DROP)
+            uploader = optimizer()
+            self.assertTrue(uploader.optimizeImage())
+            server.inject_fault(None, delay=1)
+            os.remove(uploader.downloadFile())
+            self.assertEqual(6, server.requests)
+
+            # throttled requests wait for Retry-After
+            server.inject_fault(429, headers={'Retry-After': '0.3'})
+            start = time.time()
+            self.assertTrue(optimizer().optimizeImage())
+            self.assertGreaterEqual(time.time() - start, 0.3)
+
+            # auth failures and exceeded limits are not retried
+            requests_before = server.requests
+            with self.assertRaises(AuthTokenError):
+                optimizer('error_token').optimizeImage()
+            server.inject_fault(429)
+            with self.assertRaises(TokenExhaustedError):
+                optimizer().optimizeImage()
+            self.assertEqual(requests_before + 2, server.requests)
+
+            # the breaker opens after the failures in a row and pauses the
+            # requests of the other optimizers sharing it
+            breaker = CircuitBreaker(failureThreshold=3, resetTimeout=0.5)
+            server.inject_fault(500, 4)
+            with self.assertRaises(ServerError):
+                optimizer(breaker=breaker).optimizeImage()
+            self.assertTrue(breaker.isOpen)
+            start = time.time()
+            self.assertTrue(optimizer(breaker=breaker).optimizeImage())
+            self.assertGreaterEqual(time.time() - start, 0.3)
+            self.assertFalse(breaker.isOpen)
+        finally:
+            server.stop()
+
+    def test_parse_retry_after(self):
+        self.assertEqual(2, parse_retry_after('2'))
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+        date = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertTrue(50 < parse_retry_after(date) <= 60)
@@ -8,18 +8,46 @@ iterate all files in the directory and optimize the image(format png & jpg)
 __author__ = 'Jiasheng Lee'
 
 
-import logging, sys, os, getopt, threadpool, threading, re
-from collections import Iterator
-from optimizeimage import NetworkError, ImageOptimizer
-from imagemark import MarkCheckFactory, ImageFormatError
+import logging, sys, os, getopt, threadpool, threading, re, queue, \
+    unittest, tempfile, shutil, time, collections
+from optimizeimage import NetworkError, ImageOptimizer, create_session, \
+    TINIFY_SHRINK_URL, AuthTokenError, TokenExhaustedError, RetryPolicy, \
+    CircuitBreaker
+from imagemark import MarkCheckFactory, ImageFormatError, sniff_image, \
+    sniff_images, split_image_info
+from optimizecache import OptimizeCache, file_hash, NOT_HASHED
+from tokenpool import TokenPool, NoValidTokenError
+import asyncoptimizer
 
 logging.basicConfig(level=logging.INFO, format='%(levelname)s\t\t%(asctime)s'
                     + '\t\tOptimzeMain\t%(message)s')
 
-local_reader = threading.local()
+_ignore_list = []
+
+# session shared by the workers and the url to upload images to
+_session = None
+_shrink_url = TINIFY_SHRINK_URL
+
+# OptimizeCache shared by the workers, None for no cache
+_cache = None
+
+# TokenPool shared by the workers
+_tokens = None
+
+# RetryPolicy of the requests, None for the default one
+_retry_policy = None
+
+# CircuitBreaker shared by the workers
+_breaker = CircuitBreaker()
 
 _const_mark = b'mark&tiny'
 
+# default capacity of the queue between the directory walk and the workers
+_QUEUE_SIZE = 1024
+
+# marks the end of the directory walk in the work queue
+_WALK_DONE = object()
+
 class PathFilter(object):
 
     def __init__(self, regular_list):
@@ -46,13 +74,54 @@ class PathFilter(object):
         return False
 
 
-class TokenReader(Iterator):
+def iter_all_files(start_directory, verifier):
+    """
+    walk the directory with os.scandir and yield files lazily, ignored
+    directories are pruned before they are entered
+    :param start_directory: the directory
+    :param verifier: PathFilter of the ignored file and directory names
+    :return: generator of file paths
+    """
+    directories = [start_directory]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logging.error("scan %s error: %s" % (directory, e))
+            continue
+        sub_directories = []
+        for entry in entries:
+            if verifier.filter(entry.name):
+                continue
+            try:
+                if entry.is_file():
+                    yield entry.path
+                elif entry.is_dir():
+                    sub_directories.append(entry.path)
+            except OSError as e:
+                logging.error("stat %s error: %s" % (entry.path, e))
+        # keep the order of the recursive walk: files first, then the
+        # sub directories in listing order
+        directories.extend(reversed(sub_directories))
+
+
+def _file_size(file_name):
+    try:
+        return os.path.getsize(file_name)
+    except OSError:
+        return 0
 
-    def __init__(self, token_list):
-        self._iter = iter(token_list)
 
-    def __next__(self):
-        return next(self._iter)
+def sort_by_size(files):
+    """
+    order the files largest first, so the big images are not left to the end
+    of the run for a single worker
+    :param files: iterable of file paths or ImageInfo
+    :return: list of the items
+    """
+    return sorted(files, key=lambda x: _file_size(split_image_info(x)[0]),
+                  reverse=True)
 
 
 def scan_all_file(start_directory):
@@ -61,90 +130,306 @@ def scan_all_file(start_directory):
     :param start_directory: the directory
     :return:
     """
-    verifier = PathFilter(_ignore_list)
+    return list(iter_all_files(start_directory, PathFilter(_ignore_list)))
 
-    file_list = []
-    file_list.extend([os.path.join(start_directory, x) for x in os.listdir(start_directory)
-                      if os.path.isfile(os.path.join(start_directory, x))
-                      and not verifier.filter(x)])
-    [file_list.extend(scan_all_file(os.path.join(start_directory, x))) for x in os.listdir(start_directory)
-     if os.path.isdir(os.path.join(start_directory, x))
-     and not verifier.filter(x)]
 
-    return file_list
+class WalkQueue(object):
+    """
+    bounded queue filled from an iterable of files by a background thread,
+    consumers can start before the iterable is exhausted
+    """
 
+    def __init__(self, files, maxsize=_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize)
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._fill, args=(files,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-def optimize_files(list):
+    def _fill(self, files):
+        try:
+            for x in files:
+                if not self._put(x):
+                    break
+        except BaseException as e:
+            logging.error("walk files error: %s" % e)
+        finally:
+            if not self._put(_WALK_DONE):
+                # cancelled, drop the pending files so the consumers blocked
+                # in get() still see the end of the walk
+                while True:
+                    try:
+                        self._queue.put_nowait(_WALK_DONE)
+                        break
+                    except queue.Full:
+                        try:
+                            self._queue.get_nowait()
+                        except queue.Empty:
+                            pass
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _WALK_DONE:
+                # hand the end mark over to the other consumers
+                self._queue.put_nowait(_WALK_DONE)
+                return
+            yield item
+
+    def cancel(self):
+        """
+        stop the walk, the consumers finish after their current file
+        :return:
+        """
+        self._cancelled.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+
+class WorkerStats(object):
     """
-    optimze file in directory path
-    :param directory: the directory
-    :return: NoneType
+    thread safe record of the files handled and the busy time of each worker
     """
 
-    local_reader.reader = TokenReader(_token_list)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._workers = collections.OrderedDict()
+
+    def record(self, seconds, worker=None):
+        """
+        record one handled file
+        :param seconds: time spent on the file
+        :param worker: worker name, the current thread name by default
+        :return:
+        """
+        if worker is None:
+            worker = threading.current_thread().name
+        with self._lock:
+            files, busy = self._workers.get(worker, (0, 0.0))
+            self._workers[worker] = (files + 1, busy + seconds)
+
+    def report(self):
+        """
+        :return: list of (worker, files, busy seconds, utilisation), the
+        utilisation is the busy time divided by the time since creation
+        """
+        elapsed = max(time.time() - self._start, 1e-9)
+        with self._lock:
+            return [(k, v[0], v[1], min(v[1] / elapsed, 1.0))
+                    for k, v in self._workers.items()]
+
+    def log_report(self):
+        for worker, files, busy, utilisation in self.report():
+            logging.info("%s: %d files, busy %.2fs, utilisation %.1f%%"
+                         % (worker, files, busy, utilisation * 100))
+
+
+def _sniff(origin_file):
+    """
+    :return: ImageInfo of the file, raise ImageFormatError if it is not png or
+    jpg
+    """
+    info = sniff_image(origin_file, _const_mark)
+    if info.format is None:
+        raise ImageFormatError("unsupport image type: %s" % origin_file,
+                               _const_mark)
+    return info
+
+
+def _optimize_and_mark(origin_file, tokens):
+    """
+    upload the image which is not marked and mark the optimized one
+    :return: True if optimized, None if marking the optimized image fails
+    """
+    mark_sign = _const_mark
+    token = tokens.acquire()
+    uploader = ImageOptimizer(origin_file, token, _session, _shrink_url,
+                              _retry_policy, _breaker)
+    try:
+        uploader.optimizeImage()
+        opt_file = uploader.downloadFile()
+    except (AuthTokenError, TokenExhaustedError) as e:
+        tokens.report_failure(token, e.statusCode)
+        raise
+    except NetworkError:
+        tokens.report_failure(token)
+        raise
+    except BaseException:
+        tokens.release(token)
+        raise
+    tokens.report_success(token, uploader.compressionCount)
+    marker = MarkCheckFactory.get_marker(opt_file, mark_sign)
+    if marker.mark():
+        os.remove(origin_file)
+        os.rename(opt_file, origin_file)
+        return True
+    logging.error("mark file error: %s" % opt_file)
+    return None
+
+
+def optimize_file(origin_file, tokens, cache=None, info=None):
+    """
+    optimize and mark the file unless it is marked already, with a cache the
+    unchanged files are skipped and identical images are uploaded only once
+    :param origin_file: the file
+    :param tokens: TokenPool to take the token from
+    :param cache: OptimizeCache, can be None
+    :param info: ImageInfo of the file sniffed already, None to sniff it here
+    :return: True if the file is uploaded, raise ImageFormatError if it is
+    not png or jpg, AuthTokenError or TokenExhaustedError if the token can
+    not be used, other NetworkError if the image can not be optimized after
+    the retries, NoValidTokenError if there is no token to upload with
+    """
+    if cache is not None and cache.is_unchanged(origin_file):
+        return False
+    # only a few header bytes are read, the files which are not uploaded are
+    # never hashed
+    try:
+        if info is None:
+            info = _sniff(origin_file)
+    except ImageFormatError:
+        if cache is not None:
+            cache.record_file(origin_file, NOT_HASHED)
+        raise
+    if info.marked:
+        if cache is not None:
+            cache.record_file(origin_file, NOT_HASHED)
+        return False
+    if cache is None:
+        return bool(_optimize_and_mark(origin_file, tokens))
+
+    content_hash = file_hash(origin_file)
+    while True:
+        if cache.apply_result(content_hash, origin_file):
+            return False
+        event = cache.claim(content_hash)
+        if event is None:
+            break
+        # an identical image is being optimized by another worker
+        event.wait()
+    try:
+        optimized = _optimize_and_mark(origin_file, tokens)
+        if optimized:
+            cache.store_result(content_hash, origin_file)
+        return bool(optimized)
+    finally:
+        cache.release(content_hash)
+
+
+def optimize_files(files, stats=None):
+    """
+    optimze the files
+    :param files: iterable of file paths or ImageInfo of the files sniffed
+    already, a WalkQueue is cancelled when there are no valid tokens left
+    :param stats: WorkerStats to record the busy time of the worker, can be
+    None
+    :return: NoneType
+    """
 
-    token = next(local_reader.reader)
-    index = 0
-    while index < len(list):
+    source = files
+    files = iter(source)
+    item = next(files, None)
+    start = time.time()
+    while item is not None:
+        origin_file, info = split_image_info(item)
         try:
-            origin_file = list[index]
-            mark_sign = _const_mark
-
-            checker = MarkCheckFactory.get_checker(origin_file, mark_sign)
-
-            if not checker.has_mark():
-                uploader = ImageOptimizer(origin_file, token)
-                uploader.optimizeImage()
-                opt_file = uploader.downloadFile()
-                marker = MarkCheckFactory.get_marker(opt_file, mark_sign)
-                if marker.mark():
-                    os.remove(origin_file)
-                    os.rename(opt_file, origin_file)
-                else:
-                    logging.error("mark file error: %s" % opt_file)
-            index = index + 1
+            optimize_file(origin_file, _tokens, _cache, info)
+            if stats is not None:
+                stats.record(time.time() - start)
+            item = next(files, None)
+            start = time.time()
+        except (AuthTokenError, TokenExhaustedError) as e:
+            # the token state is updated, retry the file with another token
+            logging.debug("token fail %s" % e.message)
         except NetworkError as e:
-            logging.debug("current token invalid %s" % e)
-            token = next(local_reader.reader)
+            logging.error("optimize %s fail: %s" % (origin_file, e.message))
+            if stats is not None:
+                stats.record(time.time() - start)
+            item = next(files, None)
+            start = time.time()
+        except NoValidTokenError as e:
+            logging.error(e.message)
+            if isinstance(source, WalkQueue):
+                source.cancel()
+            return None
         except ImageFormatError as e:
             logging.debug("file type unknown: %s" % e)
-            index = index + 1
-        except StopIteration:
-            logging.error("not any valid tokens")
-            return None
+            if stats is not None:
+                stats.record(time.time() - start)
+            item = next(files, None)
+            start = time.time()
 
 
-def create_task_to_pool(pool, dir):
+def iter_unmarked_images(files, processes=None):
     """
-    Traverse all directory to create task and add to thread pool
-    :param pool: thread pool
-    :param dir: start directory
-    :return: NoneType
+    keep only the png and jpg images which are not marked
+    :param files: iterable of file paths
+    :param processes: check the files in a process pool of this size
+    :return: generator of ImageInfo, passed to the workers so the files are
+    not sniffed again
     """
-    all_files = scan_all_file(dir)
+    for x in sniff_images(files, _const_mark, processes):
+        if x.format is not None and not x.marked:
+            yield x
 
-    file_params = []
-    step = int(len(all_files) / len(pool.workers))
-    if step < 1:
-        step = 1
 
-    start = 0
-    end = start + step
+def create_file_queue(dir, queue_size=_QUEUE_SIZE, largest_first=False,
+                      processes=None):
+    """
+    walk the directory in background into a bounded queue
+    :param dir: start directory
+    :param queue_size: capacity of the queue
+    :param largest_first: walk the whole directory first and queue the
+    largest files first
+    :param processes: check the walked files in a process pool of this size
+    and queue only the images which are not marked, None to let the workers
+    check them
+    :return: the WalkQueue
+    """
+    all_files = iter_all_files(dir, PathFilter(_ignore_list))
+    if processes:
+        all_files = iter_unmarked_images(all_files, processes)
+    if largest_first:
+        all_files = sort_by_size(all_files)
+    return WalkQueue(all_files, queue_size)
 
-    try:
-        while end <= len(all_files):
-            file_params.append(all_files[start:end])
-            start = end
-            end = start + step
-    except:
-        pass
 
-    if start < len(all_files) - 1:
-        file_params.append(all_files[start:len(all_files)])
+def create_task_to_pool(pool, dir, queue_size=_QUEUE_SIZE, largest_first=False,
+                        stats=None, processes=None):
+    """
+    Walk the directory in background and let every worker of the thread pool
+    take files one by one from the bounded queue, uploading starts before the
+    walk ends
+    :param pool: thread pool
+    :param dir: start directory
+    :param queue_size: capacity of the queue between the walk and the workers
+    :param largest_first: walk the whole directory first and dispatch the
+    largest files first
+    :param stats: WorkerStats to record the busy time of every worker, can be
+    None
+    :param processes: check the images in a process pool of this size before
+    queueing them, None to let the workers check them
+    :return: the WalkQueue
+    """
+    files = create_file_queue(dir, queue_size, largest_first, processes)
 
     logging.debug("create task and add to pool, in dir : %s" % dir)
-    task = threadpool.makeRequests(optimize_files, file_params)
+    task = threadpool.makeRequests(optimize_files,
+                                   [([files, stats], None)]
+                                   * len(pool.workers))
     [pool.putRequest(x) for x in task]
+    return files
 
 
 def read_config_file(file_name):
@@ -157,31 +442,258 @@ def read_config_file(file_name):
         raise e
 
 
+class OptimizeMainTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        for x in ['a.png', 'sub/b.jpg', 'sub/deep/c.png', 'build/d.png',
+                  'sub/build/e.png', 'sub/f.txt']:
+            path = os.path.join(self._dir, x)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b'0')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_iter_all_files(self):
+        files = iter_all_files(self._dir, PathFilter(['build', r'.*\.txt']))
+        self.assertFalse(isinstance(files, list))
+        self.assertEqual(sorted(['a.png', 'sub/b.jpg', 'sub/deep/c.png']),
+                         sorted(os.path.relpath(x, self._dir)
+                                for x in files))
+
+    def test_walk_queue(self):
+        def walk():
+            for x in range(100):
+                yield x
+            # consumers have started before the walk is over
+            overlapped.append(started.wait(5))
+
+        started = threading.Event()
+        overlapped = []
+        files = WalkQueue(walk(), 4)
+        results = []
+
+        def consume():
+            for x in files:
+                started.set()
+                results.append(x)
+
+        workers = [threading.Thread(target=consume) for x in range(3)]
+        [x.start() for x in workers]
+        [x.join(5) for x in workers]
+        self.assertEqual(list(range(100)), sorted(results))
+        self.assertEqual([True], overlapped)
+
+    def test_walk_queue_cancel(self):
+        files = WalkQueue(iter(range(1000)), 4)
+        taken = [next(iter(files))]
+        files.cancel()
+        files.join(5)
+        taken.extend(files)
+        self.assertLess(len(taken), 10)
+
+    def test_sort_by_size(self):
+        for x, size in [('a.png', 30), ('sub/b.jpg', 10),
+                        ('sub/deep/c.png', 20)]:
+            with open(os.path.join(self._dir, x), 'wb') as f:
+                f.write(b'0' * size)
+        files = sort_by_size(iter_all_files(
+            self._dir, PathFilter(['build', r'.*\.txt'])))
+        self.assertEqual(['a.png', 'sub/deep/c.png', 'sub/b.jpg'],
+                         [os.path.relpath(x, self._dir) for x in files])
+
+    def test_iter_unmarked_images(self):
+        image = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'test_optimize_origin.png')
+        files = [os.path.join(self._dir, 'sub', x) for x in ['1.png', '2.png']]
+        [shutil.copyfile(image, x) for x in files]
+        MarkCheckFactory.get_marker(files[0], _const_mark).mark()
+        self.assertEqual([files[1]], [x.file_name for x in iter_unmarked_images(
+            iter_all_files(self._dir, PathFilter([])), 2)])
+
+    def test_worker_stats(self):
+        global _tokens
+        _tokens = TokenPool(['token'])
+        stats = WorkerStats()
+        pool = threadpool.ThreadPool(3)
+        try:
+            # none of the files is an image, every worker just takes files
+            # until the queue is drained
+            create_task_to_pool(pool, self._dir, 2, stats=stats)
+            pool.wait()
+        finally:
+            pool.dismissWorkers(3)
+            _tokens = None
+        report = stats.report()
+        self.assertEqual(6, sum(x[1] for x in report))
+        self.assertTrue(all(0 <= x[3] <= 1 for x in report))
+
+    def test_optimize_with_cache(self):
+        global _tokens, _cache, _shrink_url
+        import tinifyserver
+        server = tinifyserver.TinifyServer(tokens=['token']).start()
+        image = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'test_optimize_origin.png')
+        files = [os.path.join(self._dir, 'sub', x) for x in ['1.png', '2.png',
+                                                             '3.png']]
+        [shutil.copyfile(image, x) for x in files]
+        _tokens = TokenPool(['error_token', 'token'])
+        _shrink_url = server.shrink_url
+        _cache = OptimizeCache(os.path.join(self._dir, 'cache'))
+        pool = threadpool.ThreadPool(3)
+        try:
+            create_task_to_pool(pool, os.path.join(self._dir, 'sub'))
+            pool.wait()
+            # identical images are uploaded and downloaded once, after the
+            # upload with the invalid token
+            self.assertEqual(3, server.requests)
+            self.assertEqual('revoked', _tokens.state('error_token')[0])
+            for x in files:
+                self.assertTrue(_cache.is_unchanged(x))
+                self.assertTrue(MarkCheckFactory.get_checker(
+                    x, _const_mark).has_mark())
+
+            create_task_to_pool(pool, os.path.join(self._dir, 'sub'))
+            pool.wait()
+            self.assertEqual(3, server.requests)
+        finally:
+            pool.dismissWorkers(3)
+            _cache.close()
+            server.stop()
+            _tokens, _cache = None, None
+            _shrink_url = TINIFY_SHRINK_URL
+
+    def test_presniffed_queue(self):
+        global _tokens, _shrink_url, sniff_image
+        import tinifyserver
+        server = tinifyserver.TinifyServer(tokens=['token']).start()
+        image = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'test_optimize_origin.png')
+        files = [os.path.join(self._dir, 'sub', x) for x in ['1.png', '2.png']]
+        [shutil.copyfile(image, x) for x in files]
+        sniffed = []
+        origin_sniff = sniff_image
+        sniff_image = lambda *args: sniffed.append(args) or origin_sniff(*args)
+        _tokens = TokenPool(['token'])
+        _shrink_url = server.shrink_url
+        pool = threadpool.ThreadPool(2)
+        try:
+            create_task_to_pool(pool, os.path.join(self._dir, 'sub'),
+                                processes=2)
+            pool.wait()
+            # the workers take the ImageInfo checked by the process pool
+            self.assertEqual([], sniffed)
+            self.assertEqual(4, server.requests)
+            for x in files:
+                self.assertTrue(MarkCheckFactory.get_checker(
+                    x, _const_mark).has_mark())
+        finally:
+            pool.dismissWorkers(2)
+            server.stop()
+            sniff_image = origin_sniff
+            _tokens = None
+            _shrink_url = TINIFY_SHRINK_URL
+
+    def test_cache_skips_hashing(self):
+        global file_hash
+        image = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             'test_optimize_origin.png')
+        marked = os.path.join(self._dir, 'sub', 'marked.png')
+        shutil.copyfile(image, marked)
+        MarkCheckFactory.get_marker(marked, _const_mark).mark()
+        hashed = []
+        origin_hash = file_hash
+        file_hash = lambda x: hashed.append(x) or origin_hash(x)
+        cache = OptimizeCache(os.path.join(self._dir, 'cache'))
+        try:
+            with self.assertRaises(ImageFormatError):
+                optimize_file(os.path.join(self._dir, 'sub', 'f.txt'), None,
+                              cache)
+            self.assertFalse(optimize_file(marked, None, cache))
+            # neither the text file nor the marked image is read through
+            self.assertEqual([], hashed)
+            self.assertTrue(cache.is_unchanged(marked))
+        finally:
+            file_hash = origin_hash
+            cache.close()
+
+
 if __name__ == '__main__':
 
     _token_file = None
     _ignore_file = None
     _start_dir = None
+    _queue_size = _QUEUE_SIZE
+    _largest_first = False
+    _proxy = None
+    _concurrency = 0
+    _per_host = asyncoptimizer._PER_HOST
+    _cache_dir = None
+    _cache_size = None
+    _processes = None
+    _token_state = None
+    _token_limit = 0
+    _retries = None
 
     _token_list = []
     _ignore_list = []
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], "", ["token=", "ignore=",
-                                                      "path="])
-    except getopt.GetoptError as e:
+                                                      "path=", "queue-size=",
+                                                      "largest-first",
+                                                      "proxy=", "api-url=",
+                                                      "concurrency=",
+                                                      "per-host=", "cache=",
+                                                      "cache-size=",
+                                                      "processes=",
+                                                      "token-state=",
+                                                      "token-limit=",
+                                                      "retries="])
+        for opt, arg in opts:
+            if opt == '--token':
+                _token_file = arg
+            elif opt == '--ignore':
+                _ignore_file = arg
+            elif opt == '--path':
+                _start_dir = arg
+            elif opt == '--queue-size':
+                _queue_size = max(int(arg), 1)
+            elif opt == '--largest-first':
+                _largest_first = True
+            elif opt == '--proxy':
+                _proxy = arg
+            elif opt == '--api-url':
+                _shrink_url = arg
+            elif opt == '--concurrency':
+                _concurrency = max(int(arg), 1)
+            elif opt == '--per-host':
+                _per_host = max(int(arg), 0)
+            elif opt == '--cache':
+                _cache_dir = arg
+            elif opt == '--cache-size':
+                _cache_size = max(int(arg), 0) * 1024 * 1024
+            elif opt == '--processes':
+                _processes = max(int(arg), 1)
+            elif opt == '--token-state':
+                _token_state = arg
+            elif opt == '--token-limit':
+                _token_limit = max(int(arg), 0)
+            elif opt == '--retries':
+                _retries = max(int(arg), 0)
+    except (getopt.GetoptError, ValueError) as e:
         print("optimizemain.py --token=<tokenfile> [--path=<path>]" +
-              " [--ignore=<ignorefile>]")
+              " [--ignore=<ignorefile>] [--queue-size=<queueSize>]" +
+              " [--largest-first] [--proxy=<proxyUrl>] [--api-url=<url>]" +
+              " [--concurrency=<concurrency>] [--per-host=<perHost>]" +
+              " [--cache=<cacheDir>] [--cache-size=<cacheSizeMB>]" +
+              " [--processes=<processes>] [--token-state=<stateFile>]" +
+              " [--token-limit=<tokenLimit>] [--retries=<retries>]")
         sys.exit(1)
 
-    for opt, arg in opts:
-        if opt == '--token':
-            _token_file = arg
-        elif opt == '--ignore':
-            _ignore_file = arg
-        elif opt == '--path':
-            _start_dir = arg
-
     try:
         _token_list = read_config_file(_token_file)
     except BaseException as e:
@@ -202,11 +714,40 @@ if __name__ == '__main__':
         logging.error("path should be a valid directory")
         sys.exit(1)
 
-    pool = threadpool.ThreadPool(os.cpu_count())
-
-    create_task_to_pool(pool, _start_dir)
-
-    pool.wait()
+    _tokens = TokenPool(_token_list, _token_state, _token_limit)
+
+    if _retries is not None:
+        _retry_policy = RetryPolicy(_retries)
+
+    if _cache_dir:
+        _cache = OptimizeCache(_cache_dir) if _cache_size is None \
+            else OptimizeCache(_cache_dir, _cache_size)
+
+    _stats = WorkerStats()
+    if _concurrency:
+        if asyncoptimizer.aiohttp is None:
+            logging.error("aiohttp is required by --concurrency")
+            sys.exit(1)
+        asyncoptimizer.optimize_files_async(
+            create_file_queue(_start_dir, _queue_size, _largest_first,
+                              _processes),
+            _tokens, _concurrency, _per_host, _shrink_url, _proxy,
+            stats=_stats, cache=_cache, retry_policy=_retry_policy)
+    else:
+        pool = threadpool.ThreadPool(os.cpu_count())
+        _session = create_session(len(pool.workers), {'http': _proxy,
+                                                      'https': _proxy}
+                                  if _proxy else None)
+
+        create_task_to_pool(pool, _start_dir, _queue_size, _largest_first,
+                            _stats, _processes)
+
+        pool.wait()
+
+    _stats.log_report()
+    _tokens.save()
+    if _cache is not None:
+        _cache.close()
 
     logging.info('done')
 
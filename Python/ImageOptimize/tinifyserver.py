@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+a local stand-in for the tiny api server, used to test and benchmark the
+image optimizer without network and without spending api quota
+"""
+
+__author__ = 'Jiasheng Lee'
+
+
+import logging, sys, os, getopt, threading, socket, json, base64, time, re, \
+    itertools, tempfile, shutil, collections
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import requests
+import optimizeimage
+
+logging.basicConfig(level=logging.INFO, format='%(levelname)s\t\t%(asctime)s'
+                    + '\t\tTinifyServer\t%(message)s')
+
+_OUTPUT_PATH_PATTERN = re.compile(r'^/output/(\d+)$')
+
+# injected fault closing the connection without a response
+FAULT_DROP = 'drop'
+
+
+def _image_type(data):
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    return None
+
+
+class TinifyRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are written separately, do not let them wait for
+        # the delayed ack of the client on a kept alive connection
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.count_connection()
+
+    def _token(self):
+        auth = self.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            return None
+        try:
+            user_pass = base64.b64decode(auth[6:]).decode('UTF-8')
+        except (ValueError, UnicodeDecodeError):
+            return None
+        return user_pass.partition(':')[2]
+
+    def _send_json(self, code, data, headers=None):
+        body = json.dumps(data).encode('UTF-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _inject_fault(self):
+        """
+        :return: True if the request is answered by an injected fault
+        """
+        fault = self.server.next_fault()
+        if fault is None:
+            return False
+        status, headers, delay = fault
+        if delay:
+            time.sleep(delay)
+        if status == FAULT_DROP:
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return True
+        if status is None:
+            return False
+        self._send_json(status, {'error': 'Injected',
+                                 'message': 'injected fault'}, headers)
+        return True
+
+    def do_POST(self):
+        self.server.count_request()
+        body = self._read_body()
+        if self._inject_fault():
+            return
+        if self.path != '/shrink':
+            self._send_json(404, {'error': 'NotFound',
+                                  'message': 'unknown path'})
+            return
+        token = self._token()
+        if not self.server.is_valid_token(token):
+            self._send_json(401, {'error': 'Unauthorized',
+                                  'message': 'Credentials are invalid'})
+            return
+        image_type = _image_type(body)
+        if image_type is None:
+            self._send_json(415, {'error': 'Unsupported media type',
+                                  'message': 'File type is not supported'})
+            return
+
+        count = self.server.count_compression(token)
+        if count is None:
+            self._send_json(429, {'error': 'TooManyRequests',
+                                  'message': 'Your monthly limit has been '
+                                             'exceeded'})
+            return
+        output_id = self.server.store_output(body)
+        self._send_json(201, {
+            'input': {'size': len(body), 'type': image_type},
+            'output': {'size': len(body), 'type': image_type, 'ratio': 1.0}},
+            {'Location': '%s/output/%d' % (self.server.url, output_id),
+             'Compression-Count': str(count)})
+
+    def do_GET(self):
+        self.server.count_request()
+        if self._inject_fault():
+            return
+        match = _OUTPUT_PATH_PATTERN.match(self.path)
+        data = self.server.get_output(int(match.group(1))) if match else None
+        if data is None:
+            self._send_json(404, {'error': 'NotFound',
+                                  'message': 'unknown output'})
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', _image_type(data))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.server.write_output(self.wfile, data)
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s" % (self.address_string(), format % args))
+
+
+class TinifyServer(ThreadingMixIn, HTTPServer):
+    """
+    serve POST /shrink and GET /output/<id> like the tiny api, the output is
+    the uploaded image itself. Connections and requests are counted so the
+    client side connection reuse can be checked
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), tokens=None,
+                 connect_delay=0, chunk_size=None, chunk_delay=0,
+                 monthly_limit=0):
+        """
+        :param address: listen address, a random port on localhost by default
+        :param tokens: accepted tokens, None to accept any token
+        :param connect_delay: seconds to wait on every new connection, to
+        simulate the cost of a tcp and tls handshake
+        :param chunk_size: send the output in chunks of this size, None to
+        send it at once
+        :param chunk_delay: seconds to wait before every chunk, to simulate a
+        slow download
+        :param monthly_limit: compressions allowed per token, 0 for no limit
+        """
+        HTTPServer.__init__(self, address, TinifyRequestHandler)
+        self._lock = threading.Lock()
+        self._tokens = set(tokens) if tokens is not None else None
+        self._connect_delay = connect_delay
+        self._chunk_size = chunk_size
+        self._chunk_delay = chunk_delay
+        self._monthly_limit = monthly_limit
+        self._outputs = {}
+        self._output_ids = itertools.count(1)
+        self._faults = collections.deque()
+        self._compression_counts = {}
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address[:2]
+
+    @property
+    def shrink_url(self):
+        return self.url + '/shrink'
+
+    def start(self):
+        """
+        serve in a daemon thread
+        :return: self
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count_connection(self):
+        with self._lock:
+            self.connections += 1
+        if self._connect_delay:
+            time.sleep(self._connect_delay)
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def is_valid_token(self, token):
+        return token is not None and (self._tokens is None
+                                      or token in self._tokens)
+
+    def count_compression(self, token):
+        """
+        :return: compressions of the token including this one, None if the
+        monthly limit is exceeded
+        """
+        with self._lock:
+            count = self._compression_counts.get(token, 0) + 1
+            if self._monthly_limit and count > self._monthly_limit:
+                return None
+            self._compression_counts[token] = count
+            return count
+
+    def inject_fault(self, fault, count=1, headers=None, delay=0):
+        """
+        answer the next count requests with a fault
+        :param fault: status code to respond, FAULT_DROP to close the
+        connection without a response, None to respond normally after delay
+        :param count: number of requests
+        :param headers: headers of the fault response, like Retry-After
+        :param delay: seconds to wait before answering
+        :return: self
+        """
+        with self._lock:
+            self._faults.extend([(fault, headers, delay)] * count)
+        return self
+
+    def next_fault(self):
+        with self._lock:
+            return self._faults.popleft() if self._faults else None
+
+    def store_output(self, data):
+        with self._lock:
+            output_id = next(self._output_ids)
+            self._outputs[output_id] = data
+            return output_id
+
+    def write_output(self, wfile, data):
+        chunk_size = self._chunk_size or max(len(data), 1)
+        for x in range(0, len(data), chunk_size):
+            if self._chunk_delay:
+                time.sleep(self._chunk_delay)
+            wfile.write(data[x: x + chunk_size])
+            wfile.flush()
+
+    def get_output(self, output_id):
+        with self._lock:
+            return self._outputs.get(output_id)
+
+
+def benchmark_sessions(image_file, count=20, connect_delay=0.01):
+    """
+    optimize the image count times against a local TinifyServer, once with a
+    new connection per request and once with a shared session
+    :param image_file: png or jpg file, copied to a temporary directory
+    :param count: number of images to optimize in each run
+    :param connect_delay: simulated handshake cost in seconds
+    :return: dict of the connections and elapsed seconds of each run
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        files = []
+        for x in range(count):
+            files.append(os.path.join(tmp_dir, '%d%s'
+                                      % (x, os.path.splitext(image_file)[1])))
+            shutil.copyfile(image_file, files[-1])
+
+        result = {'images': count, 'connect_delay': connect_delay}
+        for name in ['per_request', 'shared_session']:
+            server = TinifyServer(connect_delay=connect_delay).start()
+            try:
+                # the requests module opens a new connection per request
+                session = optimizeimage.create_session() \
+                    if name == 'shared_session' else requests
+                start = time.time()
+                for x in files:
+                    optimizer = optimizeimage.ImageOptimizer(
+                        x, 'token', session=session,
+                        shrinkUrl=server.shrink_url)
+                    optimizer.optimizeImage()
+                    os.remove(optimizer.downloadFile())
+                result[name] = {'connections': server.connections,
+                                'requests': server.requests,
+                                'seconds': round(time.time() - start, 4)}
+            finally:
+                server.stop()
+        result['connections_saved_per_image'] = round(
+            (result['per_request']['connections']
+             - result['shared_session']['connections']) / count, 3)
+        return result
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+
+    _image_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                               'test_optimize_origin.png')
+    _count = 20
+    _connect_delay = 0.01
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "", ["image=", "count=",
+                                                      "connect-delay="])
+        for opt, arg in opts:
+            if opt == '--image':
+                _image_file = arg
+            elif opt == '--count':
+                _count = int(arg)
+            elif opt == '--connect-delay':
+                _connect_delay = float(arg)
+    except (getopt.GetoptError, ValueError):
+        print("tinifyserver.py [--image=<imageFile>] [--count=<count>]"
+              + " [--connect-delay=<seconds>]")
+        sys.exit(1)
+
+    print(json.dumps(benchmark_sessions(_image_file, _count, _connect_delay),
+                     indent=2))
+    sys.exit(0)
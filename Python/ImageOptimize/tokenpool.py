@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+process wide pool of the tiny api tokens, it tracks the state and the monthly
+compression count of every token and persists them between runs
+"""
+
+__author__ = 'Jiasheng Lee'
+
+
+import logging, os, json, time, threading, hashlib, tempfile, shutil, \
+    unittest
+
+VALID = 'valid'
+# the monthly limit is reached, valid again next month
+EXHAUSTED = 'exhausted'
+# the token is rejected by the server
+REVOKED = 'revoked'
+
+# compressions per month of a token, 0 for no limit. Paid accounts have no
+# fixed limit, so by default a token is exhausted only when the server
+# rejects it, a free account can set 500 to stop before that
+_MONTHLY_LIMIT = 0
+
+# status code of the server for invalid credentials and for the exceeded
+# monthly limit
+_STATUS_UNAUTHORIZED = 401
+_STATUS_TOO_MANY_REQUESTS = 429
+
+
+class NoValidTokenError(BaseException):
+    def __init__(self, message):
+        self._message = message
+
+    @property
+    def message(self):
+        return self._message
+
+
+def _month():
+    return time.strftime('%Y-%m')
+
+
+def _token_key(token):
+    # the state file does not keep the tokens themselves
+    return hashlib.sha256(token.encode('UTF-8')).hexdigest()[:16]
+
+
+class _TokenState(object):
+
+    def __init__(self, token):
+        self.token = token
+        self.state = VALID
+        self.count = 0
+        self.pending = 0
+        self.month = _month()
+
+
+class TokenPool(object):
+    """
+    thread safe pool handing out the least used valid token
+    """
+
+    def __init__(self, tokens, state_file=None, monthly_limit=_MONTHLY_LIMIT):
+        """
+        :param tokens: list of tokens
+        :param state_file: json file to load and save the token states, None
+        to keep them in memory only
+        :param monthly_limit: compressions per month of a token, 0 for no
+        limit
+        """
+        self._lock = threading.Lock()
+        self._state_file = state_file
+        self._monthly_limit = monthly_limit
+        self._tokens = [_TokenState(x) for x in tokens]
+        self._load()
+
+    def _load(self):
+        if not self._state_file or not os.path.isfile(self._state_file):
+            return
+        try:
+            with open(self._state_file, 'rt', encoding='UTF-8') as f:
+                states = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error("read %s error: %s" % (self._state_file, e))
+            return
+        month = _month()
+        for x in self._tokens:
+            saved = states.get(_token_key(x.token))
+            if not saved:
+                continue
+            x.state = saved.get('state', VALID)
+            if saved.get('month') == month:
+                x.count = saved.get('count', 0)
+            elif x.state == EXHAUSTED:
+                # a new month, the limit is reset
+                x.state = VALID
+            if x.state not in (VALID, EXHAUSTED, REVOKED):
+                x.state = VALID
+
+    def save(self):
+        """
+        write the token states to the state file
+        :return:
+        """
+        if not self._state_file:
+            return
+        with self._lock:
+            states = dict((_token_key(x.token), {
+                'state': x.state, 'count': x.count, 'month': x.month})
+                for x in self._tokens)
+        directory = os.path.dirname(os.path.abspath(self._state_file))
+        fd, tmp_file = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wt', encoding='UTF-8') as f:
+            json.dump(states, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self._state_file)
+
+    def _find(self, token):
+        for x in self._tokens:
+            if x.token == token:
+                return x
+        raise KeyError(token)
+
+    def acquire(self):
+        """
+        :return: the valid token with the least compressions including the
+        ones in flight, raise NoValidTokenError if there is none
+        """
+        with self._lock:
+            best = None
+            for x in self._tokens:
+                if x.state != VALID:
+                    continue
+                if self._monthly_limit and \
+                        x.count + x.pending >= self._monthly_limit:
+                    continue
+                if best is None or x.count + x.pending \
+                        < best.count + best.pending:
+                    best = x
+            if best is None:
+                raise NoValidTokenError('not any valid tokens')
+            best.pending += 1
+            return best.token
+
+    def release(self, token):
+        """
+        give back an acquired token which is not used
+        :param token: the token
+        :return:
+        """
+        with self._lock:
+            x = self._find(token)
+            x.pending = max(x.pending - 1, 0)
+
+    def report_success(self, token, compression_count=None):
+        """
+        :param token: the token
+        :param compression_count: the Compression-Count header of the
+        response, the compressions of the token this month
+        :return:
+        """
+        with self._lock:
+            x = self._find(token)
+            x.pending = max(x.pending - 1, 0)
+            x.count = compression_count if compression_count is not None \
+                else x.count + 1
+            x.month = _month()
+            if self._monthly_limit and x.count >= self._monthly_limit:
+                x.state = EXHAUSTED
+                logging.info("token %s... exhausted" % token[:4])
+
+    def report_failure(self, token, status_code=None):
+        """
+        :param token: the token
+        :param status_code: 401 if the token is rejected, 429 if its monthly
+        limit is exceeded, the token stays valid for other failures
+        :return:
+        """
+        with self._lock:
+            x = self._find(token)
+            x.pending = max(x.pending - 1, 0)
+            if x.state != VALID:
+                return
+            if status_code == _STATUS_UNAUTHORIZED:
+                x.state = REVOKED
+            elif status_code == _STATUS_TOO_MANY_REQUESTS:
+                x.state = EXHAUSTED
+            else:
+                return
+            logging.info("token %s... %s" % (token[:4], x.state))
+
+    def state(self, token):
+        with self._lock:
+            x = self._find(token)
+            return x.state, x.count
+
+
+class TokenPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._state_file = os.path.join(self._dir, 'tokens.json')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_least_used(self):
+        pool = TokenPool(['a', 'b'], monthly_limit=3)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual(['a', 'b'], sorted([first, second]))
+        pool.report_success('a', 2)
+        pool.report_success('b', 1)
+        self.assertEqual('b', pool.acquire())
+        pool.report_success('b', 3)
+        self.assertEqual((EXHAUSTED, 3), pool.state('b'))
+        self.assertEqual('a', pool.acquire())
+        # the only compression left of a is in flight
+        with self.assertRaises(NoValidTokenError):
+            pool.acquire()
+        pool.release('a')
+        self.assertEqual('a', pool.acquire())
+
+    def test_unlimited_by_default(self):
+        pool = TokenPool(['a'])
+        for x in range(1, 1001):
+            self.assertEqual('a', pool.acquire())
+            pool.report_success('a', x)
+        self.assertEqual((VALID, 1000), pool.state('a'))
+        # only a rejection from the server exhausts the token
+        pool.acquire()
+        pool.report_failure('a', 429)
+        self.assertEqual(EXHAUSTED, pool.state('a')[0])
+
+    def test_failure_and_persist(self):
+        pool = TokenPool(['a', 'b', 'c', 'd'], self._state_file)
+        for x, code in [('a', 401), ('b', 429), ('c', 503)]:
+            pool.report_failure(x, code)
+        pool.report_success('d', 10)
+        # a server error does not invalidate the token
+        self.assertEqual('c', pool.acquire())
+        pool.save()
+        with open(self._state_file, 'rt', encoding='UTF-8') as f:
+            self.assertNotIn('"a"', f.read())
+
+        pool = TokenPool(['a', 'b', 'c', 'd'], self._state_file)
+        self.assertEqual([REVOKED, EXHAUSTED, VALID, VALID],
+                         [pool.state(x)[0] for x in 'abcd'])
+        self.assertEqual(10, pool.state('d')[1])
+
+        # exhausted tokens are valid again in a new month
+        with open(self._state_file, 'rt', encoding='UTF-8') as f:
+            states = json.load(f)
+        for x in states.values():
+            x['month'] = '2000-01'
+        with open(self._state_file, 'wt', encoding='UTF-8') as f:
+            json.dump(states, f)
+        pool = TokenPool(['a', 'b', 'c', 'd'], self._state_file)
+        self.assertEqual([(REVOKED, 0), (VALID, 0), (VALID, 0), (VALID, 0)],
+                         [pool.state(x) for x in 'abcd'])